@@ -0,0 +1,51 @@
+"""Run the DistanceMapBasedRegistration pipeline on a pair of labels.
+
+This script is run by SlicerProstateBenchmark.py inside Slicer:
+
+  Slicer --no-splash --no-main-window --python-script DistanceMapBasedRegistrationBenchmark.py \\
+    <fixed label> <moving label>
+
+It prints the time spent in the registration, and exits Slicer.
+"""
+
+import sys
+import time
+import logging
+
+import slicer
+
+
+def main(argv):
+  fixedLabelFileName, movingLabelFileName = argv[:2]
+
+  fixedLabel = slicer.util.loadLabelVolume(fixedLabelFileName)
+  fixedLabel.SetName('BenchmarkFixedLabel')
+  movingLabel = slicer.util.loadLabelVolume(movingLabelFileName)
+  movingLabel.SetName('BenchmarkMovingLabel')
+
+  affineTransform = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode')
+  bsplineTransform = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLBSplineTransformNode')
+
+  parameterNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScriptedModuleNode')
+  parameterNode.SetAttribute('FixedLabelNodeID', fixedLabel.GetID())
+  parameterNode.SetAttribute('MovingLabelNodeID', movingLabel.GetID())
+  parameterNode.SetAttribute('AffineTransformNodeID', affineTransform.GetID())
+  parameterNode.SetAttribute('BSplineTransformNodeID', bsplineTransform.GetID())
+  # time the preprocessing, not the labels cached by earlier runs
+  parameterNode.SetAttribute('UseCache', 'False')
+
+  from DistanceMapBasedRegistration import DistanceMapBasedRegistrationLogic
+  logic = DistanceMapBasedRegistrationLogic()
+
+  start = time.perf_counter()
+  logic.run(parameterNode)
+  print('Registration time: %f s' % (time.perf_counter() - start))
+
+
+try:
+  main(sys.argv[1:])
+  exitCode = 0
+except Exception:
+  logging.exception('DistanceMapBasedRegistration benchmark failed')
+  exitCode = 1
+slicer.app.exit(exitCode)
@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+"""Performance benchmark of the SlicerProstate modules.
+
+Runs the DWModeling models, SegmentationSmoothing, QuadEdgeSurfaceMesher and
+(if Slicer is available) the DistanceMapBasedRegistration pipeline on the
+bundled SampledPhantoms data and on synthetic inputs of increasing size, and
+records the wall time, the throughput and the peak memory of each run in a
+JSON file.
+
+Usage:
+
+  # run the benchmark, with the CLI executables found in the given directory
+  # (e.g., <extension build>/lib/Slicer-X.Y/cli-modules)
+  SlicerProstateBenchmark.py run --cli-path <dir> --output results.json
+
+  # if the CLIs need the Slicer environment, run them through the launcher
+  SlicerProstateBenchmark.py run --cli-path <dir> --launcher "<Slicer> --launch" \\
+    --slicer <Slicer> --output results.json
+
+  # compare with a stored baseline; exits with 1 if a regression is found
+  SlicerProstateBenchmark.py compare baseline.json results.json
+
+The synthetic inputs are generated once in the working directory (see
+--work-dir) and reused by later runs, so that the results are comparable.
+"""
+
+import argparse
+import datetime
+import gzip
+import json
+import math
+import os
+import platform
+import random
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+
+BENCHMARK_FORMAT_VERSION = 1
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PHANTOM_DIR = os.path.join(SOURCE_DIR, 'DWModeling', 'Data', 'SampledPhantoms', '00943_SER18')
+
+DWMODELING_MODELS = ['MonoExponential', 'BiExponential', 'Kurtosis', 'StretchedExponential', 'Gamma']
+# output of each model that is written, so that the fit is not skipped
+DWMODELING_MODEL_OUTPUTS = {
+  'MonoExponential': '--adcMonoExpDiff',
+  'BiExponential': '--slowDiff',
+  'Kurtosis': '--kurtosis',
+  'StretchedExponential': '--ddc',
+  'Gamma': '--k'
+  }
+DWI_BVALUES = [0, 50, 100, 200, 400, 800, 1200, 1600]
+
+# (name, size) of the synthetic inputs
+DWI_SIZES = [('small', (64, 64, 12)), ('medium', (128, 128, 20)), ('large', (256, 256, 32))]
+LABEL_SIZES = [('small', (96, 96, 16)), ('medium', (192, 192, 24)), ('large', (384, 384, 32))]
+# thick-slice spacing of the synthetic labels, as in the prostate MRI
+LABEL_SPACING = (0.6, 0.6, 3.0)
+
+
+#
+# NRRD input and output
+#
+
+NRRD_TYPES = {
+  'unsigned char': 'B', 'uchar': 'B', 'uint8': 'B',
+  'short': 'h', 'int16': 'h', 'signed short': 'h',
+  'unsigned short': 'H', 'ushort': 'H', 'uint16': 'H',
+  'int': 'i', 'int32': 'i', 'float': 'f', 'double': 'd'
+  }
+
+
+def writeNrrd(fileName, values, typeName, sizes, spacing, kinds=None, fields=None):
+  """Write the values (an array.array, fastest axis first) as a gzip
+  compressed NRRD file"""
+  dimension = len(sizes)
+  spatialSizes = sizes[-3:]
+  directions = ['(%r,0,0)' % spacing[0], '(0,%r,0)' % spacing[1], '(0,0,%r)' % spacing[2]]
+  if dimension == 4:
+    directions = ['none'] + directions
+  header = [
+    'NRRD0004',
+    'type: ' + typeName,
+    'dimension: %d' % dimension,
+    'space: left-posterior-superior',
+    'sizes: ' + ' '.join(str(s) for s in sizes),
+    'space directions: ' + ' '.join(directions),
+    'kinds: ' + ' '.join(kinds or ['domain'] * dimension),
+    'endian: little',
+    'encoding: gzip',
+    'space origin: (%r,%r,%r)' % tuple(-0.5 * spatialSizes[i] * spacing[i] for i in range(3))
+    ]
+  for key, value in (fields or []):
+    header.append('%s:=%s' % (key, value))
+  if sys.byteorder != 'little':
+    values = array(values.typecode, values)
+    values.byteswap()
+  with open(fileName, 'wb') as f:
+    f.write(('\n'.join(header) + '\n\n').encode('ascii'))
+    f.write(gzip.compress(values.tobytes(), compresslevel=1))
+
+
+def readNrrd(fileName):
+  """Read a NRRD file with raw or gzip encoding, returning the header fields
+  and the values as an array.array"""
+  with open(fileName, 'rb') as f:
+    content = f.read()
+  headerEnd = content.index(b'\n\n')
+  fields = {}
+  for line in content[:headerEnd].decode('latin-1').splitlines()[1:]:
+    if line.startswith('#') or ':' not in line:
+      continue
+    key, value = line.split(':', 1)
+    fields[key.strip()] = value.lstrip('=').strip()
+  data = content[headerEnd + 2:]
+  if fields.get('encoding') in ('gzip', 'gz'):
+    data = gzip.decompress(data)
+  elif fields.get('encoding') != 'raw':
+    raise ValueError('Unsupported NRRD encoding in ' + fileName)
+  values = array(NRRD_TYPES[fields['type']])
+  values.frombytes(data)
+  if fields.get('endian', 'little') != sys.byteorder and values.itemsize > 1:
+    values.byteswap()
+  return fields, values
+
+
+#
+# Synthetic inputs
+#
+
+def ellipsoidMask(size, fraction=0.35):
+  """Mask of an ellipsoid centered in the image, with semi-axes that are the
+  given fraction of the image size"""
+  nx, ny, nz = size
+  mask = array('B', bytes(nx * ny * nz))
+  for z in range(nz):
+    dz = (z - 0.5 * (nz - 1)) / (fraction * nz)
+    for y in range(ny):
+      dy = (y - 0.5 * (ny - 1)) / (fraction * ny)
+      r2 = 1. - dz * dz - dy * dy
+      if r2 <= 0:
+        continue
+      halfWidth = int(fraction * nx * math.sqrt(r2))
+      start = (z * ny + y) * nx + max(0, nx // 2 - halfWidth)
+      stop = (z * ny + y) * nx + min(nx, nx // 2 + halfWidth)
+      mask[start:stop] = array('B', b'\x01' * (stop - start))
+  return mask
+
+
+def makeDWI(directory, name, size):
+  """Bi-exponential decay with smoothly varying parameters and Rician-like
+  noise inside an ellipsoid; returns the file names of the image and the
+  mask"""
+  imageFileName = os.path.join(directory, name + '-dwi.nrrd')
+  maskFileName = os.path.join(directory, name + '-dwi-label.nrrd')
+  if os.path.exists(imageFileName) and os.path.exists(maskFileName):
+    return imageFileName, maskFileName
+
+  nx, ny, nz = size
+  nb = len(DWI_BVALUES)
+  rng = random.Random(0)
+  mask = ellipsoidMask(size)
+  values = array('h', bytes(2 * nb * nx * ny * nz))
+  for z in range(nz):
+    for y in range(ny):
+      for x in range(nx):
+        voxel = (z * ny + y) * nx + x
+        if mask[voxel]:
+          scale = 800.
+          slowDiff = 0.0006 + 0.0012 * x / nx
+          fastDiff = 0.01 + 0.02 * y / ny
+          fraction = 0.05 + 0.2 * z / max(1, nz - 1)
+        else:
+          scale, slowDiff, fastDiff, fraction = 20., 0.003, 0.003, 0.
+        for i, b in enumerate(DWI_BVALUES):
+          signal = scale * ((1 - fraction) * math.exp(-b * slowDiff) + fraction * math.exp(-b * fastDiff))
+          noisy = math.hypot(signal + rng.gauss(0, 10.), rng.gauss(0, 10.))
+          values[voxel * nb + i] = int(round(noisy))
+
+  spacing = (1.0, 1.0, 4.0)
+  writeNrrd(imageFileName, values, 'short', [nb, nx, ny, nz], spacing,
+            kinds=['list', 'domain', 'domain', 'domain'],
+            fields=[('MultiVolume.FrameIdentifyingDICOMTagName', 'B-value'),
+                    ('MultiVolume.FrameIdentifyingDICOMTagUnits', 'mm2/s'),
+                    ('MultiVolume.FrameLabels', ','.join('%.1f' % b for b in DWI_BVALUES)),
+                    ('MultiVolume.NumberOfFrames', str(nb))])
+  writeNrrd(maskFileName, mask, 'unsigned char', [nx, ny, nz], spacing)
+  return imageFileName, maskFileName
+
+
+def makeLabel(directory, name, size, offset=(0, 0, 0)):
+  """Thick-slice label of an ellipsoid, optionally shifted by the given
+  number of voxels"""
+  fileName = os.path.join(directory, '%s-label-%d-%d-%d.nrrd' % ((name,) + tuple(offset)))
+  if os.path.exists(fileName):
+    return fileName
+  nx, ny, nz = size
+  mask = ellipsoidMask(size)
+  shifted = array('B', bytes(nx * ny * nz))
+  for z in range(nz):
+    sz = z - offset[2]
+    if sz < 0 or sz >= nz:
+      continue
+    for y in range(ny):
+      sy = y - offset[1]
+      if sy < 0 or sy >= ny:
+        continue
+      for x in range(max(0, offset[0]), min(nx, nx + offset[0])):
+        shifted[(z * ny + y) * nx + x] = mask[(sz * ny + sy) * nx + x - offset[0]]
+  writeNrrd(fileName, shifted, 'unsigned char', [nx, ny, nz], LABEL_SPACING)
+  return fileName
+
+
+def countNonZero(fileName):
+  return sum(1 for v in readNrrd(fileName)[1] if v)
+
+
+def countVoxels(fileName):
+  fields = readNrrd(fileName)[0]
+  count = 1
+  for s in fields['sizes'].split():
+    count *= int(s)
+  return count
+
+
+def countPlyFaces(fileName):
+  """Number of faces from the (ASCII) header of a PLY file"""
+  with open(fileName, 'rb') as f:
+    for line in f:
+      line = line.decode('latin-1').strip()
+      if line.startswith('element face'):
+        return int(line.split()[2])
+      if line == 'end_header':
+        break
+  return None
+
+
+#
+# Running the benchmarks
+#
+
+def runProcess(command, logFileName):
+  """Run the command, returning the wall time, the peak resident memory of
+  the process in MB (None if not available) and the output"""
+  peakMemory = None
+  with open(logFileName, 'w') as log:
+    log.write(' '.join(command) + '\n')
+    log.flush()
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+    if hasattr(os, 'wait4'):
+      # resource usage of this child only; with a launcher this is the
+      # largest of the launcher and the processes it waited for
+      status, usage = os.wait4(process.pid, 0)[1:]
+      returnCode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+      peakMemory = usage.ru_maxrss / (1024. * 1024.) if sys.platform == 'darwin' else usage.ru_maxrss / 1024.
+    else:
+      returnCode = process.wait()
+    wallTime = time.perf_counter() - start
+
+  with open(logFileName) as log:
+    output = log.read()
+  if returnCode != 0:
+    raise RuntimeError('Command failed (see %s): %s' % (logFileName, ' '.join(command)))
+  return wallTime, peakMemory, output
+
+
+class BenchmarkRunner(object):
+
+  def __init__(self, args):
+    self.args = args
+    self.launcher = shlex.split(args.launcher) if args.launcher else []
+    self.workDir = os.path.abspath(args.work_dir)
+    self.outputDir = tempfile.mkdtemp(prefix='SlicerProstateBenchmark-')
+    self.results = []
+    if not os.path.isdir(self.workDir):
+      os.makedirs(self.workDir)
+
+  def cli(self, name):
+    executable = os.path.join(self.args.cli_path, name)
+    if sys.platform == 'win32' and not executable.endswith('.exe'):
+      executable += '.exe'
+    return self.launcher + [executable]
+
+  def selected(self, name):
+    return not self.args.filter or re.search(self.args.filter, name)
+
+  def measure(self, name, component, command, count, countUnit, size, getCount=None, timePattern=None):
+    """Run the command the requested number of times and store the median
+    wall time and the largest peak memory. If timePattern is given, the time
+    it matches in the output is used instead of the wall time of the
+    process, so that the startup of the application is not measured."""
+    if not self.selected(name):
+      return
+    print('Running %s' % name)
+    wallTimes = []
+    peakMemory = None
+    logFileName = os.path.join(self.outputDir, re.sub(r'[^\w.-]', '_', name) + '.log')
+    for repetition in range(self.args.repetitions):
+      try:
+        wallTime, memory, output = runProcess(command, logFileName)
+      except (RuntimeError, OSError) as e:
+        # keep the other benchmarks going, the failure is reported as a
+        # regression by compare
+        print('  FAILED: %s' % e)
+        self.results.append({
+          'name': name,
+          'component': component,
+          'size': list(size) if size else None,
+          'count': None,
+          'countUnit': countUnit,
+          'wallTime': None,
+          'wallTimes': wallTimes,
+          'rate': None,
+          'peakMemoryMB': peakMemory,
+          'error': str(e)
+          })
+        return
+      if timePattern:
+        reportedTime = re.search(timePattern, output)
+        if reportedTime:
+          wallTime = float(reportedTime.group(1))
+        else:
+          print('  WARNING: time not reported, using the wall time of the process')
+      wallTimes.append(wallTime)
+      # prefer the peak memory reported by the CLI itself, which excludes
+      # the launcher
+      reported = re.search(r'Peak resident memory: ([0-9.eE+-]+) MB', output)
+      if reported:
+        memory = float(reported.group(1))
+      if memory is not None:
+        peakMemory = max(peakMemory or 0., memory)
+    if getCount:
+      count = getCount()
+    wallTimes.sort()
+    medianTime = wallTimes[len(wallTimes) // 2]
+    result = {
+      'name': name,
+      'component': component,
+      'size': list(size) if size else None,
+      'count': count,
+      'countUnit': countUnit,
+      'wallTime': medianTime,
+      'wallTimes': wallTimes,
+      'rate': count / medianTime if count and medianTime > 0 else None,
+      'peakMemoryMB': peakMemory
+      }
+    print('  %.3f s, %s %s/s, %s MB' % (medianTime, '%.0f' % result['rate'] if result['rate'] else '-',
+                                        countUnit, '%.1f' % peakMemory if peakMemory else '-'))
+    self.results.append(result)
+
+  def runDWModeling(self):
+    cases = []
+    # the bundled phantom is small, and is fitted everywhere
+    phantom = os.path.join(PHANTOM_DIR, 'Input', '00943_SER18.nrrd')
+    if os.path.exists(phantom):
+      cases.append(('phantom', None, phantom, None))
+    for sizeName, size in DWI_SIZES[:self.args.max_sizes]:
+      imageFileName, maskFileName = makeDWI(self.workDir, sizeName, size)
+      cases.append((sizeName, size, imageFileName, maskFileName))
+
+    for caseName, size, imageFileName, maskFileName in cases:
+      if maskFileName:
+        maskedVoxels = countNonZero(maskFileName)
+      else:
+        # the first axis of the image is the list of b-values
+        maskedVoxels = countVoxels(imageFileName) // int(readNrrd(imageFileName)[0]['sizes'].split()[0])
+      for model in DWMODELING_MODELS:
+        outputFileName = os.path.join(self.outputDir, 'DWModeling-%s-%s.nrrd' % (model, caseName))
+        command = self.cli('DWModeling') + ['--model', model]
+        if maskFileName:
+          command += ['--mask', maskFileName]
+        command += [DWMODELING_MODEL_OUTPUTS[model], outputFileName, imageFileName]
+        if self.args.threads:
+          command += ['--threads', str(self.args.threads)]
+        self.measure('DWModeling/%s/%s' % (model, caseName), 'DWModeling',
+                     command, maskedVoxels, 'voxels', size)
+
+  def runSegmentationSmoothing(self):
+    for sizeName, size in LABEL_SIZES[:self.args.max_sizes]:
+      labelFileName = makeLabel(self.workDir, sizeName, size)
+      outputFileName = os.path.join(self.outputDir, 'SegmentationSmoothing-%s.nrrd' % sizeName)
+      command = self.cli('SegmentationSmoothing') + [labelFileName, outputFileName]
+      self.measure('SegmentationSmoothing/%s' % sizeName, 'SegmentationSmoothing',
+                   command, countVoxels(labelFileName), 'voxels', size)
+
+  def runQuadEdgeSurfaceMesher(self):
+    for sizeName, size in LABEL_SIZES[:self.args.max_sizes]:
+      labelFileName = makeLabel(self.workDir, sizeName, size)
+      outputFileName = os.path.join(self.outputDir, 'QuadEdgeSurfaceMesher-%s.ply' % sizeName)
+      command = self.cli('QuadEdgeSurfaceMesher') + [labelFileName, outputFileName]
+      self.measure('QuadEdgeSurfaceMesher/%s' % sizeName, 'QuadEdgeSurfaceMesher',
+                   command, None, 'cells', size, getCount=lambda: countPlyFaces(outputFileName))
+
+  def runDistanceMapBasedRegistration(self):
+    if not self.args.slicer:
+      print('Skipping DistanceMapBasedRegistration: Slicer executable not specified (--slicer)')
+      return
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'DistanceMapBasedRegistrationBenchmark.py')
+    for sizeName, size in LABEL_SIZES[:self.args.max_sizes]:
+      fixedFileName = makeLabel(self.workDir, sizeName, size)
+      # the moving label is shifted by 5% of the size in-plane and a slice
+      movingFileName = makeLabel(self.workDir, sizeName, size,
+                                 offset=(size[0] // 20, -size[1] // 20, 1))
+      command = [self.args.slicer, '--no-splash', '--no-main-window',
+                 '--python-script', script, fixedFileName, movingFileName]
+      self.measure('DistanceMapBasedRegistration/%s' % sizeName, 'DistanceMapBasedRegistration',
+                   command, countVoxels(fixedFileName), 'voxels', size,
+                   timePattern=r'Registration time: ([0-9.eE+-]+) s')
+
+  def run(self):
+    self.runDWModeling()
+    self.runSegmentationSmoothing()
+    self.runQuadEdgeSurfaceMesher()
+    self.runDistanceMapBasedRegistration()
+
+
+def getEnvironment(args):
+  environment = {
+    'platform': platform.platform(),
+    'machine': platform.machine(),
+    'processor': platform.processor(),
+    'cpuCount': os.cpu_count(),
+    'hostname': platform.node(),
+    'python': platform.python_version(),
+    'cliPath': os.path.abspath(args.cli_path),
+    'slicer': args.slicer,
+    'threads': args.threads
+    }
+  try:
+    environment['sourceRevision'] = subprocess.check_output(
+      ['git', 'rev-parse', 'HEAD'], cwd=SOURCE_DIR, universal_newlines=True).strip()
+  except (OSError, subprocess.CalledProcessError):
+    pass
+  return environment
+
+
+def runCommand(args):
+  runner = BenchmarkRunner(args)
+  runner.run()
+  report = {
+    'formatVersion': BENCHMARK_FORMAT_VERSION,
+    'created': datetime.datetime.now().isoformat(),
+    'environment': getEnvironment(args),
+    'repetitions': args.repetitions,
+    'results': runner.results
+    }
+  with open(args.output, 'w') as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+  print('Results written to %s (logs and outputs in %s)' % (args.output, runner.outputDir))
+  failures = [r['name'] for r in runner.results if r.get('error')]
+  if failures:
+    print('%d benchmark(s) failed: %s' % (len(failures), ', '.join(failures)))
+    return 1
+  return 0
+
+
+def compareCommand(args):
+  with open(args.baseline) as f:
+    baseline = json.load(f)
+  with open(args.current) as f:
+    current = json.load(f)
+
+  baselineResults = dict((r['name'], r) for r in baseline['results'])
+  regressions = []
+  print('%-45s %10s %10s %8s %10s %10s' % ('Benchmark', 'Base (s)', 'Now (s)', 'Change',
+                                           'Base (MB)', 'Now (MB)'))
+  for result in current['results']:
+    reference = baselineResults.get(result['name'])
+    if result.get('error'):
+      regressions.append((result['name'], ['FAILED']))
+      print('%-45s REGRESSION(FAILED) %s' % (result['name'], result['error']))
+      continue
+    if not reference or reference.get('error'):
+      print('%-45s %10s %10.3f' % (result['name'], '-', result['wallTime']))
+      continue
+    timeChange = result['wallTime'] / reference['wallTime'] - 1. if reference['wallTime'] else 0.
+    flags = []
+    # very short runs are dominated by the startup time and noise
+    if timeChange > args.tolerance and result['wallTime'] - reference['wallTime'] > args.min_time:
+      flags.append('TIME')
+    if reference.get('peakMemoryMB') and result.get('peakMemoryMB'):
+      if result['peakMemoryMB'] > reference['peakMemoryMB'] * (1. + args.memory_tolerance):
+        flags.append('MEMORY')
+    if flags:
+      regressions.append((result['name'], flags))
+    print('%-45s %10.3f %10.3f %+7.1f%% %10s %10s %s' % (
+      result['name'], reference['wallTime'], result['wallTime'], 100. * timeChange,
+      '%.1f' % reference['peakMemoryMB'] if reference.get('peakMemoryMB') else '-',
+      '%.1f' % result['peakMemoryMB'] if result.get('peakMemoryMB') else '-',
+      ' '.join('REGRESSION(%s)' % flag for flag in flags)))
+
+  missing = set(baselineResults) - set(r['name'] for r in current['results'])
+  for name in sorted(missing):
+    regressions.append((name, ['MISSING']))
+    print('%-45s REGRESSION(MISSING) missing from the current results' % name)
+
+  if regressions:
+    print('%d regression(s) found' % len(regressions))
+    return 1
+  print('No regressions found')
+  return 0
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  subparsers = parser.add_subparsers(dest='command')
+
+  runParser = subparsers.add_parser('run', help='run the benchmarks')
+  runParser.add_argument('--cli-path', required=True,
+                         help='directory containing the DWModeling, SegmentationSmoothing and QuadEdgeSurfaceMesher executables')
+  runParser.add_argument('--launcher', default='',
+                         help='command prepended to the CLI command lines, e.g. "<Slicer> --launch"')
+  runParser.add_argument('--slicer', default='',
+                         help='Slicer executable used to run the DistanceMapBasedRegistration pipeline (skipped if not given)')
+  runParser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'SlicerProstateBenchmarkData'),
+                         help='directory where the synthetic inputs are generated and reused')
+  runParser.add_argument('--output', default='SlicerProstateBenchmark.json', help='JSON result file')
+  runParser.add_argument('--repetitions', type=int, default=3,
+                         help='number of runs of each benchmark; the median wall time is reported')
+  runParser.add_argument('--max-sizes', type=int, default=len(DWI_SIZES),
+                         help='number of synthetic input sizes to run, from the smallest')
+  runParser.add_argument('--threads', type=int, default=0,
+                         help='number of threads of DWModeling (0: all cores)')
+  runParser.add_argument('--filter', default='', help='regular expression selecting the benchmarks by name')
+
+  compareParser = subparsers.add_parser('compare', help='compare the results with a baseline')
+  compareParser.add_argument('baseline', help='baseline JSON result file')
+  compareParser.add_argument('current', help='current JSON result file')
+  compareParser.add_argument('--tolerance', type=float, default=0.1,
+                             help='relative increase of the wall time reported as a regression')
+  compareParser.add_argument('--memory-tolerance', type=float, default=0.2,
+                             help='relative increase of the peak memory reported as a regression')
+  compareParser.add_argument('--min-time', type=float, default=0.05,
+                             help='absolute increase of the wall time (s) below which no regression is reported')
+
+  args = parser.parse_args(argv)
+  if args.command == 'run':
+    return runCommand(args)
+  elif args.command == 'compare':
+    return compareCommand(args)
+  parser.print_help()
+  return 2
+
+
+if __name__ == '__main__':
+  sys.exit(main())
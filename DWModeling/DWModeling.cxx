@@ -1,14 +1,39 @@
 #include "itkImageFileWriter.h"
-#include "itkImageDuplicator.h"
 #include "itkMetaDataObject.h"
 #include "itkLevenbergMarquardtOptimizer.h"
 #include "itkArray.h"
+#include "itkMultiThreaderBase.h"
+#include "itkTimeProbe.h"
+#include "itkImageIOFactory.h"
+#include "itkExtractImageFilter.h"
+#include "itksys/SystemTools.hxx"
+
+#include <algorithm>
+#include <cmath>
+#include <atomic>
+#include <fstream>
+#include <memory>
+#include <sstream>
+
+#if defined(_WIN32)
+#ifndef NOMINMAX
+#define NOMINMAX
+#endif
+#include <windows.h>
+#include <psapi.h>
+#else
+#include <sys/resource.h>
+#endif
 
 
 #include "itkPluginUtilities.h"
 //#include "lmcurve.h"
 
+// The fitting engine is also built, without the CLI, into the
+// DWModelingFitter library
+#ifndef DWMODELING_FITTER_LIBRARY
 #include "DWModelingCLP.h"
+#endif
 #include "itkImageRegionIteratorWithIndex.h"
 #include "itkImageRegionConstIteratorWithIndex.h"
 
@@ -421,10 +446,100 @@ public:
     return measure;
   }
 
-  //Not going to be used
-  void GetDerivative( const ParametersType & /* parameters*/,
-                      DerivativeType  & /*derivative*/ ) const
+  // Jacobian of the residuals returned by GetValue(), organized as
+  // derivative[parameter][value]. Since the residual is Y-f, each entry is
+  // the negated partial derivative of the model function.
+  void GetDerivative( const ParametersType & parameters,
+                      DerivativeType  & derivative ) const
   {
+    derivative.SetSize(GetNumberOfParameters(), RangeDimension);
+
+    switch(modelType){
+    case BiExponential:{
+      double scale = parameters[0],
+          fraction = parameters[1],
+          slowDiff = parameters[2],
+          fastDiff = parameters[3];
+
+      for(unsigned i=0;i<RangeDimension;i++)
+        {
+        double slowDecay = exp(-1.*X[i]*slowDiff);
+        double fastDecay = exp(-1.*X[i]*fastDiff);
+        derivative[0][i] = -((1-fraction)*slowDecay+fraction*fastDecay);
+        derivative[1][i] = -scale*(fastDecay-slowDecay);
+        derivative[2][i] = scale*(1-fraction)*X[i]*slowDecay;
+        derivative[3][i] = scale*fraction*X[i]*fastDecay;
+        }
+      break;
+    }
+    case Kurtosis:{
+      double scale = parameters[0],
+          kurtosis = parameters[1],
+          kurtosisDiff = parameters[2];
+
+      for(unsigned i=0;i<RangeDimension;i++)
+        {
+        double b = X[i];
+        double decay = exp(-1.*b*kurtosisDiff+((b*b)*(kurtosisDiff*kurtosisDiff)*kurtosis/6));
+        derivative[0][i] = -decay;
+        derivative[1][i] = -scale*decay*(b*b)*(kurtosisDiff*kurtosisDiff)/6;
+        derivative[2][i] = -scale*decay*(-b+(b*b)*kurtosisDiff*kurtosis/3);
+        }
+      break;
+    }
+    case MonoExponential:{
+      double scale = parameters[0],
+          adc = parameters[1];
+
+      for(unsigned i=0;i<RangeDimension;i++)
+        {
+        double decay = exp(-1.*X[i]*adc);
+        derivative[0][i] = -decay;
+        derivative[1][i] = scale*X[i]*decay;
+        }
+      break;
+    }
+    case StretchedExponential:{
+      double scale = parameters[0],
+        DDC = parameters[1],
+        alpha = parameters[2];
+
+      for(unsigned i=0;i<RangeDimension;i++){
+        double bD = X[i]*DDC;
+        double decay, dDDC = 0, dAlpha = 0;
+        if(bD > 0){
+          double bDAlpha = pow(bD, alpha);
+          decay = exp(-bDAlpha);
+          // d/dDDC (bD)^alpha = alpha*(bD)^alpha/DDC
+          dDDC = scale*decay*alpha*bDAlpha/DDC;
+          dAlpha = scale*decay*bDAlpha*log(bD);
+        } else {
+          // the limits of both derivatives at b=0 are 0
+          decay = 1;
+        }
+        derivative[0][i] = -decay;
+        derivative[1][i] = dDDC;
+        derivative[2][i] = dAlpha;
+      }
+      break;
+    }
+    case Gamma:
+    {
+      double scale = parameters[0],
+        k = parameters[1], theta = parameters[2];
+
+      for(unsigned i=0;i<RangeDimension;i++){
+        double base = 1+X[i]*theta;
+        double decay = pow(base, -k);
+        derivative[0][i] = -decay;
+        derivative[1][i] = scale*decay*log(base);
+        derivative[2][i] = scale*k*X[i]*decay/base;
+      }
+      break;
+    }
+    default:
+      abort(); // not implemented
+    }
   }
 
   unsigned int GetNumberOfParameters(void) const
@@ -494,9 +609,10 @@ typedef itk::Image<MapVolumePixelType, 3>                    MapVolumeType;
 typedef itk::ImageFileReader<MaskVolumeType>                 MaskVolumeReaderType;
 typedef itk::ImageFileWriter<MapVolumeType>                  MapWriterType;
 typedef itk::ImageFileWriter<VectorVolumeType>               FittedVolumeWriterType;
+typedef itk::ExtractImageFilter<VectorVolumeType, VectorVolumeType> VectorVolumeExtractorType;
+typedef itk::ExtractImageFilter<MaskVolumeType, MaskVolumeType>     MaskVolumeExtractorType;
 
 typedef itk::Image<float,VectorVolumeDimension> OutputVolumeType;
-typedef itk::ImageDuplicator<VectorVolumeType> DuplicatorType;
 typedef itk::ImageFileWriter< MapVolumeType> MapVolumeWriterType;
 
 typedef itk::ImageRegionConstIterator<VectorVolumeType> InputVectorVolumeIteratorType;
@@ -504,14 +620,1434 @@ typedef itk::ImageRegionIterator<VectorVolumeType> OutputVectorVolumeIteratorTyp
 typedef itk::ImageRegionConstIterator<MaskVolumeType> MaskVolumeIteratorType;
 typedef itk::ImageRegionIterator<MapVolumeType> MapVolumeIteratorType;
 
-void SaveMap(MapVolumeType::Pointer map, std::string fileName){
-  MapWriterType::Pointer writer = MapWriterType::New();
-  writer->SetInput(map);
+// Allocate a zero-initialized image with the geometry of the reference,
+// holding the voxels of the given region. The largest possible region is
+// that of the reference, so that in the streaming mode a slab can be pasted
+// into the output file.
+template <class TImage>
+typename TImage::Pointer AllocateImage(const itk::ImageBase<3> *reference,
+                                       const VectorVolumeRegionType &region,
+                                       unsigned numberOfComponents = 1){
+  typename TImage::Pointer image = TImage::New();
+  image->CopyInformation(reference);
+  image->SetNumberOfComponentsPerPixel(numberOfComponents);
+  image->SetBufferedRegion(region);
+  image->SetRequestedRegion(region);
+  image->Allocate(true);
+  return image;
+}
+
+// Peak resident set size of the process, in megabytes
+double GetPeakResidentMemoryMB(){
+#if defined(_WIN32)
+  PROCESS_MEMORY_COUNTERS counters;
+  if(!GetProcessMemoryInfo(GetCurrentProcess(), &counters, sizeof(counters)))
+    return 0;
+  return counters.PeakWorkingSetSize/(1024.*1024.);
+#else
+  struct rusage usage;
+  if(getrusage(RUSAGE_SELF, &usage))
+    return 0;
+#if defined(__APPLE__)
+  // reported in bytes on macOS
+  return usage.ru_maxrss/(1024.*1024.);
+#else
+  // reported in kilobytes on Linux
+  return usage.ru_maxrss/1024.;
+#endif
+#endif
+}
+
+// Compression of the output files, see outputCompression in the CLI
+// description
+enum OutputCompression {
+  CompressionDefault = 0,
+  CompressionNone = 1,
+  CompressionFast = 2,
+  CompressionMax = 3
+};
+
+// Writer of the image to the file. The ImageIO is created here rather than
+// when the writer is updated, so that writers prepared in the main thread
+// can be run concurrently.
+template <class TImage>
+itk::ProcessObject::Pointer CreateWriter(TImage *image, const std::string &fileName,
+                                         OutputCompression compression){
+  typedef itk::ImageFileWriter<TImage> WriterType;
+  typename WriterType::Pointer writer = WriterType::New();
+  writer->SetInput(image);
   writer->SetFileName(fileName.c_str());
-  writer->SetUseCompression(1);
-  writer->Update();
+  itk::ImageIOBase::Pointer io = itk::ImageIOFactory::CreateImageIO(
+        fileName.c_str(), itk::IOFileModeEnum::WriteMode);
+  if(io)
+    writer->SetImageIO(io);
+  switch(compression){
+    case CompressionNone:
+      writer->SetUseCompression(0);
+      break;
+    case CompressionFast:
+      writer->SetUseCompression(1);
+      writer->SetCompressionLevel(1);
+      break;
+    case CompressionMax:
+      // clamped by the ImageIO to the highest level it supports
+      writer->SetUseCompression(1);
+      writer->SetCompressionLevel(100);
+      break;
+    default:
+      writer->SetUseCompression(1);
+  }
+  return writer.GetPointer();
+}
+
+// Update the writers, several at a time. Compression is single threaded,
+// so writing the outputs concurrently rather than one after the other
+// divides the time spent writing by up to the number of outputs.
+void RunWriters(const std::vector<itk::ProcessObject::Pointer> &writers, unsigned numberOfThreads){
+  if(writers.empty())
+    return;
+  std::vector<std::string> errors(writers.size());
+
+  itk::MultiThreaderBase::Pointer threader = itk::MultiThreaderBase::New();
+  threader->SetMaximumNumberOfThreads(numberOfThreads);
+  threader->SetNumberOfWorkUnits(std::min<unsigned>(numberOfThreads, writers.size()));
+
+  threader->ParallelizeArray(0, writers.size(),
+    [&writers, &errors](itk::SizeValueType i)
+    {
+      try {
+        writers[i]->Update();
+      } catch (itk::ExceptionObject &exc) {
+        errors[i] = exc.GetDescription();
+      }
+    },
+    nullptr);
+
+  for(unsigned i=0;i<errors.size();i++){
+    if(errors[i].size())
+      itkGenericExceptionMacro(<< errors[i]);
+  }
+}
+
+// Copy the maps into the components of a single vector image
+VectorVolumeType::Pointer CombineMaps(const std::vector<MapVolumeType::Pointer> &maps){
+  const unsigned numberOfComponents = maps.size();
+  VectorVolumeType::Pointer combined = AllocateImage<VectorVolumeType>(maps[0],
+    maps[0]->GetBufferedRegion(), numberOfComponents);
+  const itk::SizeValueType numberOfVoxels = maps[0]->GetBufferedRegion().GetNumberOfPixels();
+  VectorVolumePixelType *combinedBuffer = combined->GetBufferPointer();
+  for(unsigned c=0;c<numberOfComponents;c++){
+    const MapVolumePixelType *mapBuffer = maps[c]->GetBufferPointer();
+    for(itk::SizeValueType v=0;v<numberOfVoxels;v++)
+      combinedBuffer[v*numberOfComponents+c] = mapBuffer[v];
+  }
+  return combined;
+}
+
+// Methods available to fit the model at each voxel, see fitMethod in the
+// CLI description
+enum FitMethod {
+  FitMethodLM = 0,
+  FitMethodLogLinear = 1,
+  FitMethodLogLinearThenLM = 2,
+  FitMethodDictionary = 3,
+  FitMethodDictionaryThenLM = 4
+};
+
+// Initial parameters of the iterative fit at each voxel, see
+// initializationMode in the CLI description
+enum InitializationMode {
+  InitializationGlobal = 0,
+  InitializationNeighbour = 1,
+  InitializationCoarse = 2
+};
+
+// Solve the n x n (n<=3) linear system a*x = y by Gaussian elimination with
+// partial pivoting. Returns false if the system is singular.
+bool SolveLinearSystem(double a[3][3], double y[3], int n, double x[3])
+{
+  for(int col=0;col<n;col++){
+    int pivot = col;
+    for(int row=col+1;row<n;row++)
+      if(fabs(a[row][col]) > fabs(a[pivot][col]))
+        pivot = row;
+    if(fabs(a[pivot][col]) < 1e-30)
+      return false;
+    if(pivot != col){
+      for(int k=0;k<n;k++)
+        std::swap(a[col][k], a[pivot][k]);
+      std::swap(y[col], y[pivot]);
+    }
+    for(int row=col+1;row<n;row++){
+      double factor = a[row][col]/a[col][col];
+      for(int k=col;k<n;k++)
+        a[row][k] -= factor*a[col][k];
+      y[row] -= factor*y[col];
+    }
+  }
+  for(int row=n-1;row>=0;row--){
+    double value = y[row];
+    for(int k=row+1;k<n;k++)
+      value -= a[row][k]*x[k];
+    x[row] = value/a[row][row];
+  }
+  return true;
+}
+
+// Closed-form fit of the models that are (approximately) linear in the
+// logarithm of the signal:
+//  MonoExponential: log(S) = log(S0) - b*ADC
+//  Kurtosis:        log(S) = log(S0) - b*D + b^2*D^2*K/6
+// The weighted least squares problem is solved with weights S^2, which
+// compensate for the amplification of noise by the logarithm. The parameters
+// are returned in the order used by DecayCostFunction. Returns false if the
+// signal is not positive or the solution is not physically meaningful.
+bool FitLogLinear(DecayCostFunction::Model modelType, const float *b,
+                  const float *y, int n, DecayCostFunction::ParametersType &parameters)
+{
+  const int numberOfCoefficients = (modelType == DecayCostFunction::Kurtosis) ? 3 : 2;
+
+  // normal equations of the weighted problem, columns of the design matrix
+  // are 1, b and b^2
+  double ata[3][3] = {{0,0,0},{0,0,0},{0,0,0}}, aty[3] = {0,0,0};
+  for(int i=0;i<n;i++){
+    if(y[i] <= 0)
+      return false;
+    double w = double(y[i])*y[i];
+    double logY = log(double(y[i]));
+    double row[3] = {1., b[i], double(b[i])*b[i]};
+    for(int r=0;r<numberOfCoefficients;r++){
+      aty[r] += w*row[r]*logY;
+      for(int c=0;c<numberOfCoefficients;c++)
+        ata[r][c] += w*row[r]*row[c];
+    }
+  }
+
+  double coefficients[3];
+  if(!SolveLinearSystem(ata, aty, numberOfCoefficients, coefficients))
+    return false;
+
+  switch(modelType){
+    case DecayCostFunction::MonoExponential:
+      // a flat or rising signal has no positive ADC
+      if(-coefficients[1] <= 0)
+        return false;
+      parameters[0] = exp(coefficients[0]);
+      parameters[1] = -coefficients[1];
+      return true;
+    case DecayCostFunction::Kurtosis:{
+      double diffusion = -coefficients[1];
+      if(diffusion <= 0)
+        return false;
+      parameters[0] = exp(coefficients[0]);
+      parameters[1] = 6.*coefficients[2]/(diffusion*diffusion);
+      parameters[2] = diffusion;
+      return true;
+    }
+    default:
+      return false;
+  }
+}
+
+// Axis of the parameter grid of a signal dictionary
+struct DictionaryAxis
+{
+  // index of the parameter in DecayCostFunction::ParametersType
+  unsigned parameter;
+  double minimum, maximum;
+  // logarithmic spacing of the values
+  bool logarithmic;
+  std::vector<double> values;
+};
+
+// Grid of the shape parameters (all parameters but the scale) of a model,
+// with resolution values along each axis
+std::vector<DictionaryAxis> GetDictionaryAxes(DecayCostFunction::Model modelType, unsigned resolution)
+{
+  // parameter, minimum, maximum, logarithmic
+  std::vector<DictionaryAxis> axes;
+  switch(modelType){
+    case DecayCostFunction::MonoExponential:
+      axes.push_back({1, 1e-5, 5e-3, false, {}}); // ADC
+      break;
+    case DecayCostFunction::BiExponential:
+      axes.push_back({1, 0., 1., false, {}}); // fast diffusion fraction
+      axes.push_back({2, 1e-5, 3e-3, false, {}}); // slow diffusion
+      axes.push_back({3, 3e-3, 1e-1, true, {}}); // fast diffusion
+      break;
+    case DecayCostFunction::Kurtosis:
+      axes.push_back({1, 0., 3., false, {}}); // kurtosis
+      axes.push_back({2, 1e-4, 5e-3, false, {}}); // kurtosis diffusion
+      break;
+    case DecayCostFunction::StretchedExponential:
+      axes.push_back({1, 1e-5, 5e-3, false, {}}); // DDC
+      axes.push_back({2, 0.1, 1., false, {}}); // alpha
+      break;
+    case DecayCostFunction::Gamma:
+      axes.push_back({1, 0.1, 20., true, {}}); // k
+      axes.push_back({2, 1e-5, 1e-2, true, {}}); // theta
+      break;
+    default:
+      abort();
+  }
+
+  for(unsigned a=0;a<axes.size();a++){
+    DictionaryAxis &axis = axes[a];
+    axis.values.resize(resolution);
+    for(unsigned i=0;i<resolution;i++){
+      double t = resolution > 1 ? double(i)/(resolution-1) : 0.;
+      if(axis.logarithmic)
+        axis.values[i] = axis.minimum*pow(axis.maximum/axis.minimum, t);
+      else
+        axis.values[i] = axis.minimum+t*(axis.maximum-axis.minimum);
+    }
+  }
+  return axes;
+}
+
+// Table of the signal of a model over a grid of its shape parameters, for
+// the selected b-values. The entries are normalized to unit norm, so that
+// the entry matching a signal best in the least squares sense is the one
+// with the largest inner product, and the scale follows in closed form.
+// This avoids evaluating the model per voxel, which is costly for the
+// models that call pow().
+class SignalDictionary
+{
+public:
+  SignalDictionary(DecayCostFunction::Model modelType, unsigned resolution,
+                   const float *bValues, int numberOfValues)
+    : m_ModelType(modelType), m_NumberOfValues(numberOfValues),
+      m_BValues(bValues, bValues+numberOfValues)
+  {
+    m_Axes = GetDictionaryAxes(modelType, resolution);
+    m_NumberOfEntries = 1;
+    for(unsigned a=0;a<m_Axes.size();a++)
+      m_NumberOfEntries *= m_Axes[a].values.size();
+  }
+
+  unsigned long GetNumberOfEntries() const { return m_NumberOfEntries; }
+
+  // Key identifying the table: the model, the grid and the b-values
+  std::string GetKey() const
+  {
+    std::ostringstream key;
+    key.precision(9);
+    key << "DWModelingDictionary 1 model " << m_ModelType;
+    for(unsigned a=0;a<m_Axes.size();a++)
+      key << " axis " << m_Axes[a].parameter << " " << m_Axes[a].minimum << " " << m_Axes[a].maximum
+          << " " << m_Axes[a].logarithmic << " " << m_Axes[a].values.size();
+    key << " b";
+    for(int i=0;i<m_NumberOfValues;i++)
+      key << " " << m_BValues[i];
+    return key.str();
+  }
+
+  // Name of the cache file of the table in the given directory
+  std::string GetCacheFileName(const std::string &directory) const
+  {
+    // FNV-1a hash of the key
+    const std::string key = GetKey();
+    unsigned long long hash = 14695981039346656037ULL;
+    for(size_t i=0;i<key.size();i++){
+      hash ^= (unsigned char)key[i];
+      hash *= 1099511628211ULL;
+    }
+    std::ostringstream fileName;
+    fileName << directory << "/DWModelingDictionary-" << m_ModelType << "-"
+             << std::hex << hash << ".bin";
+    return fileName.str();
+  }
+
+  void Compute()
+  {
+    DecayCostFunction::Pointer costFunction = DecayCostFunction::New();
+    costFunction->SetModelType(m_ModelType);
+    costFunction->SetX(&m_BValues[0], m_NumberOfValues);
+    costFunction->SetNumberOfValues(m_NumberOfValues);
+
+    m_Entries.resize(m_NumberOfEntries*m_NumberOfValues);
+    m_Norms.resize(m_NumberOfEntries);
+
+    DecayCostFunction::ParametersType parameters = costFunction->GetInitialValue();
+    for(unsigned long e=0;e<m_NumberOfEntries;e++){
+      GetEntryParameters(e, parameters);
+      DecayCostFunction::MeasureType signal = costFunction->GetFittedVector(parameters);
+      double norm = 0;
+      for(int i=0;i<m_NumberOfValues;i++)
+        norm += double(signal[i])*signal[i];
+      norm = sqrt(norm);
+      // entries that are not finite or vanish never match
+      if(!std::isfinite(norm) || norm == 0)
+        norm = 0;
+      m_Norms[e] = norm;
+      for(int i=0;i<m_NumberOfValues;i++)
+        m_Entries[e*m_NumberOfValues+i] = norm > 0 ? signal[i]/norm : 0;
+    }
+  }
+
+  // Read the table from the cache file; returns false if the file does not
+  // exist or does not hold this table
+  bool Load(const std::string &fileName)
+  {
+    std::ifstream file(fileName.c_str(), std::ios::binary);
+    if(!file)
+      return false;
+    std::string key;
+    if(!std::getline(file, key, '\0') || key != GetKey())
+      return false;
+    m_Entries.resize(m_NumberOfEntries*m_NumberOfValues);
+    m_Norms.resize(m_NumberOfEntries);
+    file.read(reinterpret_cast<char*>(&m_Norms[0]), m_Norms.size()*sizeof(float));
+    file.read(reinterpret_cast<char*>(&m_Entries[0]), m_Entries.size()*sizeof(float));
+    return bool(file);
+  }
+
+  // Write the table to the cache file. The file is written under a
+  // temporary name first, so that concurrent runs never read a partial
+  // table.
+  bool Save(const std::string &fileName) const
+  {
+    std::ostringstream temporaryFileName;
+    temporaryFileName << fileName << "." << itksys::SystemTools::GetCurrentDateTime("%Y%m%d%H%M%S")
+                      << "." << this << ".tmp";
+    {
+      std::ofstream file(temporaryFileName.str().c_str(), std::ios::binary);
+      if(!file)
+        return false;
+      const std::string key = GetKey();
+      file.write(key.c_str(), key.size()+1);
+      file.write(reinterpret_cast<const char*>(&m_Norms[0]), m_Norms.size()*sizeof(float));
+      file.write(reinterpret_cast<const char*>(&m_Entries[0]), m_Entries.size()*sizeof(float));
+      if(!file)
+        return false;
+    }
+    return bool(itksys::SystemTools::RenameFile(temporaryFileName.str(), fileName));
+  }
+
+  // Find the entry that matches the signal y best. The parameters of the
+  // entry and the scale are stored in parameters, the sum of squared
+  // residuals in SSerr. Returns false if no entry matches.
+  bool Match(const float *y, DecayCostFunction::ParametersType &parameters, double &SSerr) const
+  {
+    double signalNorm2 = 0;
+    for(int i=0;i<m_NumberOfValues;i++)
+      signalNorm2 += double(y[i])*y[i];
+
+    long bestEntry = -1;
+    float bestProduct = 0;
+    const float *entry = &m_Entries[0];
+    for(unsigned long e=0;e<m_NumberOfEntries;e++, entry+=m_NumberOfValues){
+      float product = 0;
+      for(int i=0;i<m_NumberOfValues;i++)
+        product += entry[i]*y[i];
+      if(product > bestProduct){
+        bestProduct = product;
+        bestEntry = e;
+      }
+    }
+    if(bestEntry < 0)
+      return false;
+
+    GetEntryParameters(bestEntry, parameters);
+    parameters[0] = bestProduct/m_Norms[bestEntry];
+    SSerr = std::max(0., signalNorm2-double(bestProduct)*bestProduct);
+    return true;
+  }
+
+private:
+  void GetEntryParameters(unsigned long entry, DecayCostFunction::ParametersType &parameters) const
+  {
+    parameters[0] = 1;
+    for(unsigned a=0;a<m_Axes.size();a++){
+      const unsigned long n = m_Axes[a].values.size();
+      parameters[m_Axes[a].parameter] = m_Axes[a].values[entry%n];
+      entry /= n;
+    }
+  }
+
+  DecayCostFunction::Model m_ModelType;
+  int m_NumberOfValues;
+  std::vector<float> m_BValues;
+  std::vector<DictionaryAxis> m_Axes;
+  unsigned long m_NumberOfEntries;
+  // entries normalized to unit norm, and their norms at unit scale
+  std::vector<float> m_Entries;
+  std::vector<float> m_Norms;
+};
+
+// One of the models fitted at every voxel
+struct FittingModel
+{
+  DecayCostFunction::Model modelType;
+  DecayCostFunction::ParametersType initialValue;
+  unsigned numberOfMaps;
+  FitMethod fitMethod;
+  // table used by the dictionary fit methods, shared by all threads
+  std::shared_ptr<const SignalDictionary> dictionary;
+  std::vector<MapVolumeType::Pointer> parameterMapVector;
+};
+
+// State shared by all fitting threads. Images are allocated before the
+// threads are started; every voxel is visited by exactly one thread, so the
+// outputs can be written without locking.
+struct FittingJob
+{
+  VectorVolumeType::Pointer inputVectorVolume;
+  MaskVolumeType::Pointer maskVolume;
+
+  // models in the order requested by the user; the fitted volume and the
+  // error maps are computed for the first one
+  std::vector<FittingModel> models;
+  VectorVolumeType::Pointer fittedVolume;
+  MapVolumeType::Pointer rsqrMap, ssdFittedMap, ssdMap, csFittedMap, csMap;
+
+  // index of the MonoExponential model in models, or -1
+  int monoExponentialModel;
+  // initialize the other models from the mono-exponential fit of the voxel
+  bool warmStart;
+  InitializationMode initializationMode;
+  // estimate the Jacobian by finite differences instead of using
+  // DecayCostFunction::GetDerivative()
+  bool useNumericalJacobian;
+
+  // all b-values, and those selected for fitting
+  std::vector<float> bValues;
+  const float *bValuesPtr;
+  const bool *bValuesMask;
+  int bValuesTotal, bValuesSelected;
+
+  // pre-screening of the voxels before fitting: voxels with a b0 signal
+  // below minimumSNR times the noise level, and, if rejectNonMonotone is
+  // set, those whose signal increases with the b-value by more than 3 times
+  // the noise level are not fitted. Disabled if noiseLevel is 0.
+  double noiseLevel;
+  float minimumSNR;
+  bool rejectNonMonotone;
+  // components of the input in the order of increasing b-value; the first
+  // one is the b0 frame
+  std::vector<unsigned> bValueOrder;
+  // FitStatus of every voxel, if requested
+  MaskVolumeType::Pointer fitStatusMap;
+};
+
+// Values of the fit status map
+enum FitStatus {
+  // outside of the mask, or zero signal at the first b-value
+  FitStatusNotFitted = 0,
+  FitStatusFitted = 1,
+  // skipped by the pre-screening
+  FitStatusLowSNR = 2,
+  FitStatusNonMonotone = 3,
+  // the optimizer of at least one model stopped before convergence
+  FitStatusNotConverged = 4,
+  // at least one model could not be fitted log-linearly or by dictionary
+  // matching
+  FitStatusFailed = 5
+};
+
+// Number of voxels skipped by the pre-screening
+struct ScreeningStatistics
+{
+  ScreeningStatistics() : numberOfLowSNRVoxels(0), numberOfNonMonotoneVoxels(0) {}
+
+  unsigned long numberOfLowSNRVoxels;
+  unsigned long numberOfNonMonotoneVoxels;
+};
+
+struct FittingThreadStatistics
+{
+  FittingThreadStatistics() : numberOfChunks(0), numberOfVoxels(0),
+    numberOfFailedVoxels(0), numberOfNonConvergedVoxels(0), numberOfEvaluations(0),
+    numberOfIterations(0), numberOfSeededFits(0), elapsedTime(0) {}
+
+  unsigned long numberOfChunks;
+  unsigned long numberOfVoxels;
+  // fits of a model at a voxel that could not be done log-linearly or by
+  // dictionary matching
+  unsigned long numberOfFailedVoxels;
+  // voxels where the optimizer of at least one model did not converge
+  unsigned long numberOfNonConvergedVoxels;
+  // cost function evaluations and optimizer iterations summed over all
+  // voxels and models, including the coarse pre-fit
+  unsigned long numberOfEvaluations;
+  unsigned long numberOfIterations;
+  // fits initialized from a neighbour or a coarse block
+  unsigned long numberOfSeededFits;
+  double elapsedTime;
+};
+
+// Values of the parameter maps of a model for the fitted parameters, scaled
+// for the output. parameterValues holds one value per map.
+void GetParameterMapValues(DecayCostFunction::Model modelType,
+                           const DecayCostFunction::ParametersType &finalPosition,
+                           float *parameterValues)
+{
+  switch(modelType){
+    case DecayCostFunction::BiExponential:{
+      parameterValues[0] = finalPosition[0];
+      parameterValues[1] = finalPosition[1];
+      parameterValues[2] = finalPosition[2]*1e+6;
+      parameterValues[3] = finalPosition[3]*1e+6;
+      break;
+    }
+    case DecayCostFunction::Kurtosis:{
+      parameterValues[0] = finalPosition[0];
+      parameterValues[1] = finalPosition[1];
+      parameterValues[2] = finalPosition[2]*1e+6;
+      break;
+    }
+    case DecayCostFunction::MonoExponential:{
+      parameterValues[0] = finalPosition[0];
+      parameterValues[1] = finalPosition[1]*1e+6;
+      break;
+    }
+    case DecayCostFunction::StretchedExponential:{
+      parameterValues[0] = finalPosition[0];
+      parameterValues[1] = finalPosition[1]*1e+6; // DDC
+      parameterValues[2] = finalPosition[2]; // alpha
+      break;
+    }
+    case DecayCostFunction::Gamma:{
+      parameterValues[0] = finalPosition[0];
+      parameterValues[1] = finalPosition[1]; // k
+      parameterValues[2] = finalPosition[2]*1e+6; // theta
+      parameterValues[3] = (finalPosition[1]-1)*finalPosition[2]; // mode
+      break;
+    }
+
+  default: abort();
+  }
+}
+
+// Error measures of a fit, in the order of the error maps
+enum ErrorMeasure {
+  ErrorRSquared = 0,
+  ErrorSSDFitted = 1,
+  ErrorSSD = 2,
+  ErrorChiSquaredFitted = 3,
+  ErrorChiSquared = 4,
+  NumberOfErrorMeasures = 5
+};
+
+// Compute the error measures of a fit. The measures are calculated
+// separately for those b-values that were used in the fitting process
+// (imageValues and fittedValues, *Fitted measures) and for all of the
+// b-values available in the data (allValues and allFittedValues).
+// SSerrFitted is the sum of squared residuals reported by the optimizer, or
+// a negative value if it should be computed from the fitted values.
+void ComputeErrorMeasures(const float *imageValues, const float *fittedValues, unsigned bValuesSelected,
+                          const float *allValues, const float *allFittedValues, unsigned bValuesTotal,
+                          unsigned numberOfMaps, double SSerrFitted, double *errors)
+{
+  // see PkModeling/CLI/itkConcentrationToQuantitativeImageFilter.hxx:452
+  double sumSquaredDifferences = 0, sumSquaredDifferencesFitted = 0;
+  double sumSquared = 0.0, sumSquaredFitted = 0;
+  double sum = 0.0, sumFitted = 0;
+  double rSquared = 0.0;
+
+  for (unsigned int i=0; i < bValuesSelected; ++i){
+    sumFitted += imageValues[i];
+    sumSquaredFitted += (imageValues[i]*imageValues[i]);
+    sumSquaredDifferencesFitted += (imageValues[i]-fittedValues[i])*(imageValues[i]-fittedValues[i]);
+  }
+
+  for (unsigned int i=0; i < bValuesTotal; ++i){
+    sum += allValues[i];
+    sumSquared += (allValues[i]*allValues[i]);
+    sumSquaredDifferences += (allValues[i]-allFittedValues[i])*(allValues[i]-allFittedValues[i]);
+  }
+
+  if(SSerrFitted < 0)
+    SSerrFitted = sumSquaredDifferencesFitted;
+
+  double SStotFitted = sumSquaredFitted - sumFitted*sumFitted/(double)bValuesSelected;
+
+  rSquared = 1.0 - (SSerrFitted / SStotFitted);
+
+  double chiSquaredNormFitted = sumSquaredDifferencesFitted/((double)bValuesSelected-numberOfMaps);
+  double chiSquaredNorm = sumSquaredDifferences/((double)bValuesTotal-numberOfMaps);
+
+  errors[ErrorRSquared] = rSquared;
+  errors[ErrorSSDFitted] = sumSquaredDifferencesFitted;
+  errors[ErrorSSD] = sumSquaredDifferences;
+  errors[ErrorChiSquaredFitted] = 2.*sqrt(chiSquaredNormFitted);
+  errors[ErrorChiSquared] = 2.*sqrt(chiSquaredNorm);
+}
+
+// Store the parameters of a model, and for the first model also the fitted
+// values and the error measures, for a voxel in the output images of the
+// job. Only the outputs that were allocated (i.e., requested by the user)
+// are computed. SSerrFitted is the sum of squared residuals reported by the
+// optimizer, or a negative value if it should be computed from the fitted
+// values.
+void StoreVoxelResults(const FittingJob &job, unsigned modelIndex,
+                       const DecayCostFunction *costFunction,
+                       const VectorVolumeType::IndexType &index,
+                       const VectorVolumeType::PixelType &vectorVoxel,
+                       const DecayCostFunction::ParametersType &finalPosition,
+                       double SSerrFitted,
+                       const float *imageValuesPtr, float *fittedValuesPtr)
+{
+  const FittingModel &model = job.models[modelIndex];
+  const int bValuesSelected = job.bValuesSelected;
+  const unsigned numberOfMaps = model.numberOfMaps;
+
+  // parameter maps, scaled for the output
+  float parameterValues[5];
+  GetParameterMapValues(model.modelType, finalPosition, parameterValues);
+
+  for(unsigned i=0;i<numberOfMaps;i++){
+    if(model.parameterMapVector[i])
+      model.parameterMapVector[i]->SetPixel(index, parameterValues[i]);
+  }
+
+  if(modelIndex != 0)
+    return;
+
+  const bool needFittedErrors = job.rsqrMap || job.ssdFittedMap || job.csFittedMap;
+  const bool needErrors = job.ssdMap || job.csMap;
+  if(!job.fittedVolume && !needFittedErrors && !needErrors)
+    return;
+
+  // fitted vector for all input b-values
+  VectorVolumeType::PixelType fittedVoxel(vectorVoxel.GetSize());
+  for(int i=0;i<fittedVoxel.GetSize();i++){
+    fittedVoxel[i] = costFunction->GetFittedValue(finalPosition, job.bValues[i]);
+  }
+
+  if(job.fittedVolume)
+    job.fittedVolume->SetPixel(index, fittedVoxel);
+
+  if(!needFittedErrors && !needErrors)
+    return;
+
+  // fitted values for the b-values used in fitting only
+  for(int i=0;i<bValuesSelected;i++){
+    fittedValuesPtr[i] = costFunction->GetFittedValue(finalPosition,job.bValuesPtr[i]);
+  }
+
+  double errors[NumberOfErrorMeasures];
+  ComputeErrorMeasures(imageValuesPtr, fittedValuesPtr, bValuesSelected,
+                       vectorVoxel.GetDataPointer(), fittedVoxel.GetDataPointer(), vectorVoxel.GetSize(),
+                       numberOfMaps, SSerrFitted, errors);
+
+  if(job.rsqrMap)
+    job.rsqrMap->SetPixel(index, errors[ErrorRSquared]);
+  if(job.ssdFittedMap)
+    job.ssdFittedMap->SetPixel(index, errors[ErrorSSDFitted]);
+  if(job.ssdMap)
+    job.ssdMap->SetPixel(index, errors[ErrorSSD]);
+  if(job.csMap)
+    job.csMap->SetPixel(index, errors[ErrorChiSquared]);
+  if(job.csFittedMap)
+    job.csFittedMap->SetPixel(index, errors[ErrorChiSquaredFitted]);
+}
+
+// Cost function and optimizer used by a thread to fit one of the models
+struct ModelFitter
+{
+  DecayCostFunction::Pointer costFunction;
+  itk::LevenbergMarquardtOptimizer::Pointer optimizer;
+};
+
+ModelFitter CreateModelFitter(const FittingJob &job, const FittingModel &model)
+{
+  ModelFitter fitter;
+  fitter.costFunction = DecayCostFunction::New();
+  fitter.costFunction->SetModelType(model.modelType);
+  fitter.costFunction->SetInitialValues(model.initialValue);
+  fitter.costFunction->SetX(job.bValuesPtr, job.bValuesSelected);
+  fitter.costFunction->SetNumberOfValues(job.bValuesSelected);
+
+  fitter.optimizer = itk::LevenbergMarquardtOptimizer::New();
+  fitter.optimizer->SetCostFunction(fitter.costFunction);
+  if(job.useNumericalJacobian)
+    fitter.optimizer->UseCostFunctionGradientOff();
+  else
+    fitter.optimizer->UseCostFunctionGradientOn();
+
+  itk::LevenbergMarquardtOptimizer::InternalOptimizerType *vnlOptimizer = fitter.optimizer->GetOptimizer();
+  vnlOptimizer->set_f_tolerance(1e-4f);
+  vnlOptimizer->set_g_tolerance(1e-4f);
+  vnlOptimizer->set_x_tolerance(1e-5f);
+  vnlOptimizer->set_epsilon_function(1e-9f);
+  // the dictionary match is refined with a few iterations only
+  vnlOptimizer->set_max_function_evals(model.fitMethod == FitMethodDictionaryThenLM ? 30 : 200);
+
+  return fitter;
+}
+
+// Initialize the parameters of a model from the mono-exponential fit of the
+// voxel. The apparent diffusion coefficient seeds the (slow) diffusion
+// coefficient of the other models; the remaining parameters keep their
+// initial values.
+void WarmStartParameters(DecayCostFunction::Model modelType,
+                         double scale, double adc,
+                         DecayCostFunction::ParametersType &parameters)
+{
+  if(scale <= 0 || adc <= 0)
+    return;
+
+  parameters[0] = scale;
+  switch(modelType){
+    case DecayCostFunction::BiExponential:
+      parameters[2] = adc; // slow diffusion
+      break;
+    case DecayCostFunction::Kurtosis:
+      parameters[2] = adc; // kurtosis diffusion
+      break;
+    case DecayCostFunction::StretchedExponential:
+      parameters[1] = adc; // DDC
+      break;
+    case DecayCostFunction::Gamma:
+      // mean of the gamma distribution of diffusivities is k*theta
+      if(parameters[1] > 0)
+        parameters[2] = adc/parameters[1];
+      break;
+    default:
+      break;
+  }
 }
 
+// Fit one of the models to the signal imageValuesPtr (for the selected
+// b-values), starting from initialValue. SSerrFitted is set to the sum of
+// squared residuals reported by the optimizer, or to a negative value if it
+// should be computed from the fitted values. converged is cleared if the
+// optimizer stopped before meeting its convergence criteria. Returns false
+// if the signal could not be fitted.
+bool FitModel(const FittingJob &job, unsigned modelIndex, const ModelFitter &fitter,
+              DecayCostFunction::ParametersType initialValue,
+              const float *imageValuesPtr,
+              DecayCostFunction::ParametersType &finalPosition, double &SSerrFitted,
+              bool &converged, FittingThreadStatistics &statistics)
+{
+  const FittingModel &model = job.models[modelIndex];
+  const int bValuesSelected = job.bValuesSelected;
+  converged = true;
+
+  if(model.fitMethod == FitMethodDictionary || model.fitMethod == FitMethodDictionaryThenLM){
+    DecayCostFunction::ParametersType dictionaryValue = initialValue;
+    double dictionarySSerr;
+    if(model.dictionary->Match(imageValuesPtr, dictionaryValue, dictionarySSerr)){
+      if(model.fitMethod == FitMethodDictionary){
+        finalPosition = dictionaryValue;
+        SSerrFitted = dictionarySSerr;
+        return true;
+      }
+      // seed the iterative refinement
+      initialValue = dictionaryValue;
+    } else if(model.fitMethod == FitMethodDictionary){
+      statistics.numberOfFailedVoxels++;
+      return false;
+    }
+  } else if(model.fitMethod != FitMethodLM){
+    DecayCostFunction::ParametersType logLinearValue = initialValue;
+    if(FitLogLinear(model.modelType, job.bValuesPtr, imageValuesPtr, bValuesSelected, logLinearValue)){
+      if(model.fitMethod == FitMethodLogLinear){
+        finalPosition = logLinearValue;
+        SSerrFitted = -1;
+        return true;
+      }
+      // seed the iterative refinement
+      initialValue = logLinearValue;
+    } else if(model.fitMethod == FitMethodLogLinear){
+      statistics.numberOfFailedVoxels++;
+      return false;
+    }
+  }
+
+  fitter.costFunction->SetY(imageValuesPtr,bValuesSelected);
+
+  try {
+    fitter.optimizer->SetInitialPosition(initialValue);
+    fitter.optimizer->StartOptimization();
+  } catch(itk::ExceptionObject &e) {
+    std::cerr << " Exception caught: " << e << std::endl;
+  }
+
+  itk::LevenbergMarquardtOptimizer::InternalOptimizerType *vnlOptimizer = fitter.optimizer->GetOptimizer();
+  statistics.numberOfEvaluations += vnlOptimizer->get_num_evaluations();
+  statistics.numberOfIterations += vnlOptimizer->get_num_iterations();
+
+  const int failureCode = vnlOptimizer->get_failure_code();
+  converged = failureCode >= vnl_nonlinear_minimizer::CONVERGED_FTOL
+    && failureCode <= vnl_nonlinear_minimizer::CONVERGED_GTOL;
+
+  finalPosition = fitter.optimizer->GetCurrentPosition();
+  double rmsFitted = vnlOptimizer->get_end_error();
+  SSerrFitted = rmsFitted*rmsFitted*bValuesSelected;
+  return true;
+}
+
+// Per-thread state used to fit all models of the job to a signal, and the
+// results of the last fit
+struct SignalFitter
+{
+  std::vector<ModelFitter> fitters;
+  // the mono-exponential model is fitted first, so that it can seed the
+  // other models
+  std::vector<unsigned> fittingOrder;
+
+  // per model, the fitted parameters (empty if the fit failed), the sum
+  // of squared residuals and whether the optimizer converged
+  std::vector<DecayCostFunction::ParametersType> positions;
+  std::vector<double> SSerr;
+  std::vector<char> converged;
+};
+
+SignalFitter CreateSignalFitter(const FittingJob &job)
+{
+  SignalFitter fitter;
+  for(unsigned m=0;m<job.models.size();m++)
+    fitter.fitters.push_back(CreateModelFitter(job, job.models[m]));
+
+  if(job.monoExponentialModel >= 0)
+    fitter.fittingOrder.push_back(job.monoExponentialModel);
+  for(unsigned m=0;m<job.models.size();m++)
+    if(int(m) != job.monoExponentialModel)
+      fitter.fittingOrder.push_back(m);
+
+  fitter.positions.resize(job.models.size());
+  fitter.SSerr.resize(job.models.size());
+  fitter.converged.resize(job.models.size());
+  return fitter;
+}
+
+// Check that parameters fitted to another signal can initialize a fit
+bool IsUsableSeed(const DecayCostFunction::ParametersType &seed)
+{
+  if(!seed.size())
+    return false;
+  for(unsigned i=0;i<seed.size();i++)
+    if(!std::isfinite(seed[i]))
+      return false;
+  return true;
+}
+
+// Fit all models of the job to the signal imageValues. scale is the initial
+// signal scale. seeds, if not null, holds for each model the parameters
+// used to initialize the fit (empty if not available); otherwise the global
+// initial values are used, optionally warm-started from the mono-exponential
+// fit. The results are left in fitter.positions and fitter.SSerr.
+void FitAllModels(const FittingJob &job, SignalFitter &fitter, float scale,
+                  const float *imageValues,
+                  const std::vector<DecayCostFunction::ParametersType> *seeds,
+                  FittingThreadStatistics &statistics)
+{
+  DecayCostFunction::ParametersType monoExponentialValue(2);
+  bool haveMonoExponentialValue = false;
+  if(job.warmStart && job.monoExponentialModel < 0){
+    // closed-form estimate when the mono-exponential model is not requested
+    haveMonoExponentialValue = FitLogLinear(DecayCostFunction::MonoExponential,
+      job.bValuesPtr, imageValues, job.bValuesSelected, monoExponentialValue);
+  }
+
+  for(unsigned k=0;k<fitter.fittingOrder.size();k++){
+    const unsigned m = fitter.fittingOrder[k];
+    DecayCostFunction::ParametersType initialValue = job.models[m].initialValue;
+    if(seeds && IsUsableSeed((*seeds)[m])){
+      // copy, since seeds may alias fitter.positions
+      initialValue = DecayCostFunction::ParametersType((*seeds)[m]);
+      statistics.numberOfSeededFits++;
+    } else {
+      initialValue[0] = scale;
+      if(haveMonoExponentialValue)
+        WarmStartParameters(job.models[m].modelType, monoExponentialValue[0],
+                            monoExponentialValue[1], initialValue);
+    }
+
+    bool converged;
+    const bool fitted = FitModel(job, m, fitter.fitters[m], initialValue, imageValues,
+                                 fitter.positions[m], fitter.SSerr[m], converged, statistics);
+    fitter.converged[m] = converged;
+    if(fitted){
+      if(int(m) == job.monoExponentialModel && job.warmStart){
+        monoExponentialValue = fitter.positions[m];
+        haveMonoExponentialValue = true;
+      }
+    } else {
+      fitter.positions[m] = DecayCostFunction::ParametersType();
+    }
+  }
+}
+
+// Voxel of the masked voxel index: its image index, used to store the
+// results, and the offset of its first component in the input buffer
+struct MaskedVoxel
+{
+  VectorVolumeType::IndexType index;
+  itk::OffsetValueType offset;
+};
+
+// number of voxels handed out to a thread at a time
+const unsigned long MaskedVoxelChunkSize = 64;
+
+// Pre-screening of the signal of a voxel, see FittingJob
+FitStatus ScreenSignal(const FittingJob &job, const float *signal)
+{
+  const double b0 = signal[job.bValueOrder[0]];
+  if(b0 < job.minimumSNR*job.noiseLevel)
+    return FitStatusLowSNR;
+  if(job.rejectNonMonotone){
+    const double tolerance = 3.*job.noiseLevel;
+    double minimum = b0;
+    for(unsigned i=1;i<job.bValueOrder.size();i++){
+      const double value = signal[job.bValueOrder[i]];
+      if(value > minimum+tolerance)
+        return FitStatusNonMonotone;
+      minimum = std::min(minimum, value);
+    }
+  }
+  return FitStatusFitted;
+}
+
+// Collect the voxels of the buffered input region that are inside the mask,
+// have a non-zero first value and pass the pre-screening, in image order.
+// Only these voxels are visited by the fitting threads. The fit status of
+// the voxels skipped by the pre-screening is set here.
+void BuildMaskedVoxelIndex(const FittingJob &job, std::vector<MaskedVoxel> &voxels,
+                           ScreeningStatistics &screening)
+{
+  voxels.clear();
+
+  const unsigned int numberOfComponents = job.inputVectorVolume->GetNumberOfComponentsPerPixel();
+  const float *inputBuffer = job.inputVectorVolume->GetBufferPointer();
+  const bool screen = job.noiseLevel > 0;
+
+  MaskVolumeIteratorType mvIt(job.maskVolume, job.inputVectorVolume->GetBufferedRegion());
+  for(mvIt.GoToBegin(); !mvIt.IsAtEnd(); ++mvIt){
+    if(!mvIt.Get())
+      continue;
+    MaskedVoxel voxel;
+    voxel.index = mvIt.GetIndex();
+    voxel.offset = job.inputVectorVolume->ComputeOffset(voxel.index)*numberOfComponents;
+    if(!inputBuffer[voxel.offset])
+      continue;
+    if(screen){
+      const FitStatus status = ScreenSignal(job, inputBuffer+voxel.offset);
+      if(status != FitStatusFitted){
+        if(status == FitStatusLowSNR)
+          screening.numberOfLowSNRVoxels++;
+        else
+          screening.numberOfNonMonotoneVoxels++;
+        if(job.fitStatusMap)
+          job.fitStatusMap->SetPixel(voxel.index, status);
+        continue;
+      }
+    }
+    voxels.push_back(voxel);
+  }
+}
+
+// Add the non-zero values of the b0 frame in the buffered region of the
+// image, taking every stride-th voxel, to the sample used to estimate the
+// noise level
+void SampleBackground(const VectorVolumeType *image, unsigned b0Component,
+                      unsigned long stride, std::vector<float> &sample)
+{
+  const unsigned int numberOfComponents = image->GetNumberOfComponentsPerPixel();
+  const itk::SizeValueType numberOfVoxels = image->GetBufferedRegion().GetNumberOfPixels();
+  const float *buffer = image->GetBufferPointer()+b0Component;
+  for(itk::SizeValueType v=0;v<numberOfVoxels;v+=stride){
+    if(buffer[v*numberOfComponents] > 0)
+      sample.push_back(buffer[v*numberOfComponents]);
+  }
+}
+
+// Estimate the standard deviation of the noise from the background of the
+// b0 frame. In the background the magnitude signal follows a Rayleigh
+// distribution, whose mode is the standard deviation of the noise; it is
+// found as the peak of the histogram of the lower half of the values,
+// assuming that the background is darker than any tissue. Returns 0 if the
+// sample is empty.
+double EstimateNoiseLevel(std::vector<float> &sample)
+{
+  if(sample.empty())
+    return 0;
+  std::vector<float>::iterator median = sample.begin()+sample.size()/2;
+  std::nth_element(sample.begin(), median, sample.end());
+  const double upper = *median;
+  if(upper <= 0)
+    return 0;
+
+  const unsigned numberOfBins = 100;
+  std::vector<unsigned long> histogram(numberOfBins, 0);
+  for(std::vector<float>::const_iterator it=sample.begin();it!=median;++it)
+    histogram[std::min<unsigned>(numberOfBins-1, unsigned(*it/upper*numberOfBins))]++;
+  const unsigned peak = std::max_element(histogram.begin(), histogram.end())-histogram.begin();
+  return (peak+.5)*upper/numberOfBins;
+}
+
+// Grow the bounding box given by lower and upper (inclusive) to contain the
+// non-zero voxels of the buffered region of the mask
+void UpdateMaskBounds(const MaskVolumeType *mask,
+                      MaskVolumeType::IndexType &lower, MaskVolumeType::IndexType &upper)
+{
+  MaskVolumeIteratorType mvIt(mask, mask->GetBufferedRegion());
+  for(mvIt.GoToBegin(); !mvIt.IsAtEnd(); ++mvIt){
+    if(!mvIt.Get())
+      continue;
+    const MaskVolumeType::IndexType index = mvIt.GetIndex();
+    for(unsigned d=0;d<3;d++){
+      lower[d] = std::min(lower[d], index[d]);
+      upper[d] = std::max(upper[d], index[d]);
+    }
+  }
+}
+
+// in-plane size of the blocks of voxels fitted by the coarse initialization
+const unsigned CoarseInitializationBlockSize = 4;
+
+// Parameters fitted to the mean signal of the masked voxels in blocks of
+// CoarseInitializationBlockSize x CoarseInitializationBlockSize x 1 voxels
+struct CoarseInitialization
+{
+  VectorVolumeRegionType region;
+  itk::SizeValueType blocksX, blocksY;
+  // per block, per model the fitted parameters (empty if not fitted)
+  std::vector<std::vector<DecayCostFunction::ParametersType> > parameters;
+
+  unsigned long GetBlock(const VectorVolumeType::IndexType &index) const
+  {
+    const itk::SizeValueType x = (index[0]-region.GetIndex(0))/CoarseInitializationBlockSize;
+    const itk::SizeValueType y = (index[1]-region.GetIndex(1))/CoarseInitializationBlockSize;
+    const itk::SizeValueType z = index[2]-region.GetIndex(2);
+    return (z*blocksY+y)*blocksX+x;
+  }
+};
+
+// Average the signal of the masked voxels over the blocks and fit all
+// models to the mean signal of each block, using the given number of
+// threads
+void ComputeCoarseInitialization(const FittingJob &job, const std::vector<MaskedVoxel> &voxels,
+                                 unsigned numberOfThreads,
+                                 std::vector<FittingThreadStatistics> &threadStatistics,
+                                 CoarseInitialization &coarse)
+{
+  coarse.region = job.inputVectorVolume->GetBufferedRegion();
+  coarse.blocksX = (coarse.region.GetSize(0)+CoarseInitializationBlockSize-1)/CoarseInitializationBlockSize;
+  coarse.blocksY = (coarse.region.GetSize(1)+CoarseInitializationBlockSize-1)/CoarseInitializationBlockSize;
+  const unsigned long numberOfBlocks = coarse.blocksX*coarse.blocksY*coarse.region.GetSize(2);
+
+  coarse.parameters.clear();
+  coarse.parameters.resize(numberOfBlocks);
+
+  // sums of the signal for the selected b-values, and of the first value
+  // that initializes the scale, over the blocks that contain masked voxels
+  const int bValuesSelected = job.bValuesSelected;
+  std::vector<unsigned long> blocks;
+  std::vector<unsigned long> blockSlot(numberOfBlocks, 0);
+  std::vector<double> signalSum, scaleSum;
+  std::vector<unsigned> voxelCount;
+
+  const float *inputBuffer = job.inputVectorVolume->GetBufferPointer();
+  for(unsigned long v=0;v<voxels.size();v++){
+    const unsigned long block = coarse.GetBlock(voxels[v].index);
+    if(!blockSlot[block]){
+      blocks.push_back(block);
+      blockSlot[block] = blocks.size();
+      signalSum.resize(signalSum.size()+bValuesSelected, 0.);
+      scaleSum.push_back(0.);
+      voxelCount.push_back(0);
+    }
+    const unsigned long slot = blockSlot[block]-1;
+    const float *voxel = inputBuffer+voxels[v].offset;
+    int j = 0;
+    for(int i=0;i<job.bValuesTotal;i++){
+      if(job.bValuesMask[i])
+        signalSum[slot*bValuesSelected+j++] += voxel[i];
+    }
+    scaleSum[slot] += voxel[0];
+    voxelCount[slot]++;
+  }
+
+  std::atomic<unsigned long> nextBlock(0);
+
+  itk::MultiThreaderBase::Pointer threader = itk::MultiThreaderBase::New();
+  threader->SetMaximumNumberOfThreads(numberOfThreads);
+  threader->SetNumberOfWorkUnits(numberOfThreads);
+
+  threader->ParallelizeArray(0, numberOfThreads,
+    [&](itk::SizeValueType threadId)
+    {
+      SignalFitter fitter = CreateSignalFitter(job);
+      std::vector<float> imageValues(bValuesSelected);
+      for(unsigned long slot = nextBlock++; slot < blocks.size(); slot = nextBlock++){
+        for(int i=0;i<bValuesSelected;i++)
+          imageValues[i] = signalSum[slot*bValuesSelected+i]/voxelCount[slot];
+        FitAllModels(job, fitter, scaleSum[slot]/voxelCount[slot], &imageValues[0],
+                     nullptr, threadStatistics[threadId]);
+        coarse.parameters[blocks[slot]] = fitter.positions;
+      }
+    },
+    nullptr);
+}
+
+// Body of a single fitting thread. Chunks of the masked voxel index are
+// handed out through the shared nextChunk counter, so that the work is
+// balanced regardless of how the mask is distributed in the image. Each
+// thread owns its cost function and optimizer, which makes the result
+// independent of the number of threads.
+void FitVoxels(const FittingJob &job, const std::vector<MaskedVoxel> &voxels,
+               const CoarseInitialization *coarse,
+               std::atomic<unsigned long> &nextChunk, FittingThreadStatistics &statistics)
+{
+  itk::TimeProbe clock;
+  clock.Start();
+
+  SignalFitter fitter = CreateSignalFitter(job);
+  std::vector<float> imageValues(job.bValuesSelected), fittedValues(job.bValuesSelected);
+
+  // voxels are read directly from the buffer of the vector image, and
+  // wrapped into a pixel without copying
+  const unsigned int numberOfComponents = job.inputVectorVolume->GetNumberOfComponentsPerPixel();
+  float *inputBuffer = job.inputVectorVolume->GetBufferPointer();
+
+  const unsigned long numberOfChunks = (voxels.size()+MaskedVoxelChunkSize-1)/MaskedVoxelChunkSize;
+
+  for(unsigned long chunk = nextChunk++; chunk < numberOfChunks; chunk = nextChunk++){
+    const unsigned long chunkEnd = std::min<unsigned long>((chunk+1)*MaskedVoxelChunkSize, voxels.size());
+    for(unsigned long v = chunk*MaskedVoxelChunkSize; v < chunkEnd; v++){
+      const VectorVolumeType::PixelType vectorVoxel(inputBuffer+voxels[v].offset, numberOfComponents, false);
+
+      // use only those values that were requested by the user; the signal
+      // is shared by all models
+      const float* imageVector = vectorVoxel.GetDataPointer();
+      int j = 0;
+      for(int i=0;i<job.bValuesTotal;i++){
+        if(job.bValuesMask[i]){
+          imageValues[j++] = imageVector[i];
+        }
+      }
+
+      // the preceding voxel of the chunk was fitted by this thread; it is
+      // used as a seed if it is the neighbour along the first axis
+      const std::vector<DecayCostFunction::ParametersType> *seeds = nullptr;
+      if(job.initializationMode == InitializationNeighbour){
+        if(v > chunk*MaskedVoxelChunkSize){
+          const VectorVolumeType::IndexType &previous = voxels[v-1].index;
+          if(previous[0]+1 == voxels[v].index[0] && previous[1] == voxels[v].index[1]
+              && previous[2] == voxels[v].index[2])
+            seeds = &fitter.positions;
+        }
+      } else if(coarse) {
+        seeds = &coarse->parameters[coarse->GetBlock(voxels[v].index)];
+      }
+
+      FitAllModels(job, fitter, vectorVoxel[0], &imageValues[0], seeds, statistics);
+
+      FitStatus status = FitStatusFitted;
+      for(unsigned m=0;m<job.models.size();m++){
+        if(fitter.positions[m].size())
+          StoreVoxelResults(job, m, fitter.fitters[m].costFunction, voxels[v].index, vectorVoxel,
+                            fitter.positions[m], fitter.SSerr[m], &imageValues[0], &fittedValues[0]);
+        else
+          status = FitStatusFailed;
+        if(!fitter.converged[m] && status == FitStatusFitted)
+          status = FitStatusNotConverged;
+      }
+      if(status == FitStatusNotConverged)
+        statistics.numberOfNonConvergedVoxels++;
+      if(job.fitStatusMap)
+        job.fitStatusMap->SetPixel(voxels[v].index, status);
+      statistics.numberOfVoxels++;
+    }
+    statistics.numberOfChunks++;
+  }
+
+  clock.Stop();
+  statistics.elapsedTime += clock.GetTotal();
+}
+
+// Fit all masked voxels of the job using the given number of threads.
+// Statistics are accumulated over repeated calls.
+void RunFittingThreads(const FittingJob &job, unsigned numberOfThreads,
+                       std::vector<FittingThreadStatistics> &threadStatistics,
+                       ScreeningStatistics &screening)
+{
+  std::vector<MaskedVoxel> voxels;
+  BuildMaskedVoxelIndex(job, voxels, screening);
+  if(voxels.empty())
+    return;
+
+  CoarseInitialization coarse;
+  if(job.initializationMode == InitializationCoarse)
+    ComputeCoarseInitialization(job, voxels, numberOfThreads, threadStatistics, coarse);
+  const CoarseInitialization *coarsePtr =
+    (job.initializationMode == InitializationCoarse) ? &coarse : nullptr;
+
+  std::atomic<unsigned long> nextChunk(0);
+
+  itk::MultiThreaderBase::Pointer threader = itk::MultiThreaderBase::New();
+  threader->SetMaximumNumberOfThreads(numberOfThreads);
+  threader->SetNumberOfWorkUnits(numberOfThreads);
+
+  threader->ParallelizeArray(0, numberOfThreads,
+    [&job, &voxels, coarsePtr, &nextChunk, &threadStatistics](itk::SizeValueType threadId)
+    {
+      FitVoxels(job, voxels, coarsePtr, nextChunk, threadStatistics[threadId]);
+    },
+    nullptr);
+}
+
+// File names of the outputs requested by the user; an empty name means that
+// the output is neither allocated nor computed, unless the combined maps
+// are requested, which include all parameter and error maps
+struct OutputFileNames
+{
+  // for each model, one name per parameter map
+  std::vector<std::vector<std::string> > parameterMaps;
+  std::string rsqr, ssdFitted, ssd, csFitted, cs;
+  std::string fittedVolume;
+  std::string combinedMaps;
+  std::string fitStatus;
+};
+
+// Names of the parameter maps of the model, which label the components of
+// the combined maps. The scale map (index 0) is never output.
+std::vector<std::string> GetParameterMapNames(DecayCostFunction::Model modelType)
+{
+  std::vector<std::string> names(1);
+  switch(modelType){
+    case DecayCostFunction::BiExponential:
+      names.push_back("FastDiffusionFraction");
+      names.push_back("SlowDiffusion");
+      names.push_back("FastDiffusion");
+      break;
+    case DecayCostFunction::Kurtosis:
+      names.push_back("Kurtosis");
+      names.push_back("KurtosisDiffusion");
+      break;
+    case DecayCostFunction::MonoExponential:
+      names.push_back("ADC");
+      break;
+    case DecayCostFunction::StretchedExponential:
+      names.push_back("DDC");
+      names.push_back("Alpha");
+      break;
+    case DecayCostFunction::Gamma:
+      names.push_back("K");
+      names.push_back("Theta");
+      names.push_back("Mode");
+      break;
+    default:abort();
+  }
+  return names;
+}
+
+// Allocate the requested outputs of the job for the given region.
+// mapReference and fittedReference provide the geometry of the parameter
+// maps and of the fitted volume, respectively.
+void AllocateOutputs(FittingJob &job, const OutputFileNames &fileNames,
+                     const itk::ImageBase<3> *mapReference,
+                     const VectorVolumeType *fittedReference,
+                     const VectorVolumeRegionType &region)
+{
+  const bool allMaps = fileNames.combinedMaps.size() > 0;
+  // the combined maps include the error maps of a single model only
+  const bool allErrorMaps = allMaps && job.models.size() == 1;
+  for(unsigned m=0;m<job.models.size();m++){
+    FittingModel &model = job.models[m];
+    model.parameterMapVector.clear();
+    model.parameterMapVector.resize(model.numberOfMaps);
+    for(unsigned i=0;i<model.numberOfMaps;i++){
+      if(fileNames.parameterMaps[m][i].size() || (allMaps && i>0))
+        model.parameterMapVector[i] = AllocateImage<MapVolumeType>(mapReference, region);
+    }
+  }
+
+  job.rsqrMap = (allErrorMaps || fileNames.rsqr.size()) ? AllocateImage<MapVolumeType>(mapReference, region) : nullptr;
+  job.ssdFittedMap = (allErrorMaps || fileNames.ssdFitted.size()) ? AllocateImage<MapVolumeType>(mapReference, region) : nullptr;
+  job.ssdMap = (allErrorMaps || fileNames.ssd.size()) ? AllocateImage<MapVolumeType>(mapReference, region) : nullptr;
+  job.csFittedMap = (allErrorMaps || fileNames.csFitted.size()) ? AllocateImage<MapVolumeType>(mapReference, region) : nullptr;
+  job.csMap = (allErrorMaps || fileNames.cs.size()) ? AllocateImage<MapVolumeType>(mapReference, region) : nullptr;
+
+  job.fitStatusMap = fileNames.fitStatus.size() ? AllocateImage<MaskVolumeType>(mapReference, region) : nullptr;
+
+  job.fittedVolume = nullptr;
+  if(fileNames.fittedVolume.size())
+    job.fittedVolume = AllocateImage<VectorVolumeType>(fittedReference, region,
+      fittedReference->GetNumberOfComponentsPerPixel());
+}
+
+// Writer of a single output in the streaming mode. If the ImageIO for the
+// output file supports streamed writing, every slab is pasted into the file
+// as soon as it has been fitted, uncompressed. Otherwise the slabs are accumulated in a
+// single image that is written once all slabs are done.
+template <class TImage>
+class StreamedOutput
+{
+public:
+  typedef typename TImage::Pointer ImagePointer;
+  typedef itk::ImageFileWriter<TImage> WriterType;
+
+  StreamedOutput(const std::string &fileName, const itk::ImageBase<3> *reference,
+                 const itk::MetaDataDictionary &dictionary, OutputCompression compression)
+    : m_FileName(fileName), m_Reference(reference), m_Dictionary(dictionary),
+      m_Compression(compression)
+  {
+    itk::ImageIOBase::Pointer io = itk::ImageIOFactory::CreateImageIO(
+          fileName.c_str(), itk::IOFileModeEnum::WriteMode);
+    m_PasteSlabs = io && io->CanStreamWrite();
+    if(m_PasteSlabs){
+      // slabs are pasted into a new file, which cannot be compressed
+      itksys::SystemTools::RemoveFile(fileName);
+      if(compression == CompressionFast || compression == CompressionMax)
+        std::cout << "WARNING: " << fileName << " is written in slabs and will not be compressed" << std::endl;
+    } else {
+      std::cout << "WARNING: the format of " << fileName << " does not support streamed writing,"
+                << " the output will be kept in memory until all slabs are fitted" << std::endl;
+    }
+  }
+
+  // Image that receives the output values for the slab
+  ImagePointer GetSlabImage(const VectorVolumeRegionType &slab)
+  {
+    if(m_PasteSlabs || !m_Image)
+      m_Image = AllocateImage<TImage>(m_Reference,
+        m_PasteSlabs ? slab : m_Reference->GetLargestPossibleRegion(),
+        m_Reference->GetNumberOfComponentsPerPixel());
+    return m_Image;
+  }
+
+  void WriteSlab(const VectorVolumeRegionType &slab)
+  {
+    if(!m_PasteSlabs)
+      return;
+    itk::ImageIORegion ioRegion(3);
+    itk::ImageIORegionAdaptor<3>::Convert(slab, ioRegion,
+      m_Reference->GetLargestPossibleRegion().GetIndex());
+
+    typename WriterType::Pointer writer = WriterType::New();
+    m_Image->SetMetaDataDictionary(m_Dictionary);
+    writer->SetInput(m_Image);
+    writer->SetFileName(m_FileName.c_str());
+    writer->SetIORegion(ioRegion);
+    writer->Update();
+    m_Image = nullptr;
+  }
+
+  // Writer of the accumulated image, or null if the slabs were pasted
+  itk::ProcessObject::Pointer CreateFinalWriter()
+  {
+    if(m_PasteSlabs)
+      return nullptr;
+    m_Image->SetMetaDataDictionary(m_Dictionary);
+    itk::ProcessObject::Pointer writer = CreateWriter<TImage>(m_Image, m_FileName, m_Compression);
+    m_Image = nullptr;
+    return writer;
+  }
+
+private:
+  std::string m_FileName;
+  const itk::ImageBase<3> *m_Reference;
+  itk::MetaDataDictionary m_Dictionary;
+  OutputCompression m_Compression;
+  bool m_PasteSlabs;
+  ImagePointer m_Image;
+};
+
+#ifndef DWMODELING_FITTER_LIBRARY
 // Use an anonymous namespace to keep class types and function names
 // from colliding when module is used as shared object module.  Every
 // thing should be in an anonymous namespace except for the module
@@ -526,21 +2062,51 @@ int main( int argc, char * argv[])
     return -1;
   }
 
+  // In the streaming mode only the image information is read here, and
+  // the voxels are read slab by slab
+  const bool streaming = memoryBudget > 0;
+
+  if(streaming && combinedMapsFileName.size()){
+    std::cerr << "ERROR: Combined maps can not be written in the streaming mode!" << std::endl;
+    return -1;
+  }
+
+  OutputCompression compression;
+  if(outputCompression == "Default")
+    compression = CompressionDefault;
+  else if(outputCompression == "None")
+    compression = CompressionNone;
+  else if(outputCompression == "Fast")
+    compression = CompressionFast;
+  else if(outputCompression == "Max")
+    compression = CompressionMax;
+  else {
+    std::cerr << "ERROR: Unknown output compression specified!" << std::endl;
+    return -1;
+  }
+
   //Read VectorVolume
   VectorVolumeReaderType::Pointer multiVolumeReader
     = VectorVolumeReaderType::New();
   multiVolumeReader->SetFileName(imageName.c_str() );
-  multiVolumeReader->Update();
+  if(streaming)
+    multiVolumeReader->UpdateOutputInformation();
+  else
+    multiVolumeReader->Update();
   VectorVolumeType::Pointer inputVectorVolume = multiVolumeReader->GetOutput();
 
   // Read mask
+  MaskVolumeReaderType::Pointer maskReader;
   MaskVolumeType::Pointer maskVolume;
   if(maskName != ""){
-    MaskVolumeReaderType::Pointer maskReader = MaskVolumeReaderType::New();
+    maskReader = MaskVolumeReaderType::New();
     maskReader->SetFileName(maskName.c_str());
-    maskReader->Update();
+    if(streaming)
+      maskReader->UpdateOutputInformation();
+    else
+      maskReader->Update();
     maskVolume = maskReader->GetOutput();
-  } else {
+  } else if(!streaming) {
     maskVolume = MaskVolumeType::New();
     maskVolume->SetRegions(inputVectorVolume->GetLargestPossibleRegion());
     maskVolume->CopyInformation(inputVectorVolume);
@@ -555,7 +2121,7 @@ int main( int argc, char * argv[])
   // Trigger times
   std::vector<float> bValues;
   // list of b-values to be passed to the optimizer
-  float *bValuesPtr, *imageValuesPtr, *fittedValuesPtr;
+  float *bValuesPtr;
   // "true" for the b-value and measurement pair to be used in fitting
   bool *bValuesMask;
   int bValuesTotal, bValuesSelected;
@@ -601,8 +2167,6 @@ int main( int argc, char * argv[])
     }
 
     bValuesPtr = new float[bValuesSelected];
-    imageValuesPtr = new float[bValuesSelected];
-    fittedValuesPtr = new float[bValuesSelected];
     int j = 0;
     std::cout << "Will use the following b-values: ";
     for(int i=0;i<bValuesTotal;i++){
@@ -619,350 +2183,541 @@ int main( int argc, char * argv[])
     return EXIT_FAILURE;
   }
 
-  // allocate output maps
-  DecayCostFunction::Model modelType;
-  std::vector<MapVolumeType::Pointer> parameterMapVector;
-  std::vector<MapVolumeIteratorType> parameterMapItVector;
-
-  if(modelName == "BiExponential")
-    modelType = DecayCostFunction::BiExponential;
-  else if(modelName == "MonoExponential")
-    modelType = DecayCostFunction::MonoExponential;
-  else if(modelName == "Kurtosis")
-    modelType = DecayCostFunction::Kurtosis;
-  else if(modelName == "StretchedExponential")
-    modelType = DecayCostFunction::StretchedExponential;
-  else if(modelName == "Gamma")
-    modelType = DecayCostFunction::Gamma;
+  FitMethod method;
+  if(fitMethod == "LM")
+    method = FitMethodLM;
+  else if(fitMethod == "LogLinear")
+    method = FitMethodLogLinear;
+  else if(fitMethod == "LogLinearThenLM")
+    method = FitMethodLogLinearThenLM;
+  else if(fitMethod == "Dictionary")
+    method = FitMethodDictionary;
+  else if(fitMethod == "DictionaryThenLM")
+    method = FitMethodDictionaryThenLM;
   else {
-    std::cerr << "ERROR: Unknown model type specified!" << std::endl;
+    std::cerr << "ERROR: Unknown fit method specified!" << std::endl;
     return -1;
   }
 
-  DecayCostFunction::Pointer costFunction = DecayCostFunction::New();
-  costFunction->SetModelType(modelType);
-
-  // set initial parameters model-dependent
-  DecayCostFunction::ParametersType initialValue = costFunction->GetInitialValue();
-  if(modelName == "BiExponential"){
-    initialValue[0] = biExpInitParameters[0];
-    initialValue[1] = biExpInitParameters[1];
-    initialValue[2] = biExpInitParameters[2];
-    initialValue[3] = biExpInitParameters[3];
-  } else if(modelName == "MonoExponential") {
-    initialValue[0] = monoExpInitParameters[0];
-    initialValue[1] = monoExpInitParameters[1];
-  } else if(modelName == "Kurtosis") {
-    initialValue[0] = kurtosisInitParameters[0];
-    initialValue[1] = kurtosisInitParameters[1];
-    initialValue[2] = kurtosisInitParameters[2];
-  } else if(modelName == "StretchedExponential") {
-    initialValue[0] = stretchedExpInitParameters[0];
-    initialValue[1] = stretchedExpInitParameters[1];
-    initialValue[2] = stretchedExpInitParameters[2];
-  } else if(modelName == "Gamma") {
-    initialValue[0] = gammaInitParameters[0];
-    initialValue[1] = gammaInitParameters[1];
-    initialValue[2] = gammaInitParameters[2];
-  }
-
-  costFunction->SetInitialValues(initialValue);
+  InitializationMode initialization;
+  if(initializationMode == "Global")
+    initialization = InitializationGlobal;
+  else if(initializationMode == "Neighbour")
+    initialization = InitializationNeighbour;
+  else if(initializationMode == "Coarse")
+    initialization = InitializationCoarse;
+  else {
+    std::cerr << "ERROR: Unknown initialization mode specified!" << std::endl;
+    return -1;
+  }
 
-  unsigned numberOfMaps;
-  if(modelName == "Gamma") {
-    // include computed mode map as output
-    numberOfMaps = costFunction->GetNumberOfParameters()+1;
-  } else {
-    numberOfMaps = costFunction->GetNumberOfParameters();
-  }
-  parameterMapVector.resize(numberOfMaps);
-
-  for(int i=0;i<numberOfMaps;i++){
-    parameterMapVector[i] = MapVolumeType::New();
-    parameterMapVector[i]->SetRegions(maskVolume->GetLargestPossibleRegion());
-    parameterMapVector[i]->Allocate();
-    parameterMapVector[i]->FillBuffer(0);
-    // note mask is initialized even if not passed by the user
-    parameterMapVector[i]->CopyInformation(maskVolume);
-    parameterMapVector[i]->FillBuffer(0);
-
-    parameterMapItVector.push_back(
-          MapVolumeIteratorType(parameterMapVector[i],parameterMapVector[i]->GetLargestPossibleRegion()));
-    parameterMapItVector[i].GoToBegin();
-  }
-
-  // Fitted values and error measure volumes are calculated independently of the model
-  MapVolumeType::Pointer rsqrMap = MapVolumeType::New();
-  rsqrMap->SetRegions(maskVolume->GetLargestPossibleRegion());
-  rsqrMap->Allocate();
-  rsqrMap->FillBuffer(0);
-  rsqrMap->CopyInformation(maskVolume);
-  rsqrMap->FillBuffer(0);
-
-  MapVolumeType::Pointer ssdFittedMap = MapVolumeType::New();
-  ssdFittedMap->SetRegions(maskVolume->GetLargestPossibleRegion());
-  ssdFittedMap->Allocate();
-  ssdFittedMap->FillBuffer(0);
-  ssdFittedMap->CopyInformation(maskVolume);
-  ssdFittedMap->FillBuffer(0);
-
-  MapVolumeType::Pointer ssdMap = MapVolumeType::New();
-  ssdMap->SetRegions(maskVolume->GetLargestPossibleRegion());
-  ssdMap->Allocate();
-  ssdMap->FillBuffer(0);
-  ssdMap->CopyInformation(maskVolume);
-  ssdMap->FillBuffer(0);
-
-  MapVolumeType::Pointer csFittedMap = MapVolumeType::New();
-  csFittedMap->SetRegions(maskVolume->GetLargestPossibleRegion());
-  csFittedMap->Allocate();
-  csFittedMap->FillBuffer(0);
-  csFittedMap->CopyInformation(maskVolume);
-  csFittedMap->FillBuffer(0);
-
-  MapVolumeType::Pointer csMap = MapVolumeType::New();
-  csMap->SetRegions(maskVolume->GetLargestPossibleRegion());
-  csMap->Allocate();
-  csMap->FillBuffer(0);
-  csMap->CopyInformation(maskVolume);
-  csMap->FillBuffer(0);
-
-  DuplicatorType::Pointer dup = DuplicatorType::New();
-  dup->SetInputImage(inputVectorVolume);
-  dup->Update();
-  VectorVolumeType::Pointer fittedVolume = dup->GetOutput();
-  VectorVolumeType::PixelType zero = VectorVolumeType::PixelType(bValues.size());
-  for(int i=0;i<bValues.size();i++)
-    zero[i] = 0;
-  fittedVolume->FillBuffer(zero);
-
-  InputVectorVolumeIteratorType vvIt(inputVectorVolume, inputVectorVolume->GetLargestPossibleRegion());
-  OutputVectorVolumeIteratorType fittedIt(fittedVolume, fittedVolume->GetLargestPossibleRegion());
-
-  MaskVolumeIteratorType mvIt(maskVolume, maskVolume->GetLargestPossibleRegion());
-  MapVolumeIteratorType rsqrIt(rsqrMap, rsqrMap->GetLargestPossibleRegion());
-  MapVolumeIteratorType ssdFittedIt(ssdFittedMap,ssdFittedMap->GetLargestPossibleRegion());
-  MapVolumeIteratorType ssdIt(ssdMap,ssdMap->GetLargestPossibleRegion());
-  MapVolumeIteratorType csFittedIt(csFittedMap,csFittedMap->GetLargestPossibleRegion());
-  MapVolumeIteratorType csIt(csMap,csMap->GetLargestPossibleRegion());
-
-  itk::LevenbergMarquardtOptimizer::Pointer optimizer = itk::LevenbergMarquardtOptimizer::New();
-
-  int cnt = 0;
-
-  for(vvIt.GoToBegin();!vvIt.IsAtEnd();++vvIt){
-    //if(cnt>10)
-    //  break;
-    VectorVolumeType::IndexType index = vvIt.GetIndex();
-    VectorVolumeType::PixelType vectorVoxel = vvIt.Get();
-    VectorVolumeType::PixelType fittedVoxel(vectorVoxel.GetSize());
-    for(int i=0;i<fittedVoxel.GetSize();i++)
-      fittedVoxel[i] = 0;
-
-    if(mvIt.Get() && vectorVoxel[0]){
-      //cnt++;
-
-      // use only those values that were requested by the user
-      costFunction->SetX(bValuesPtr, bValuesSelected);
-      const float* imageVector = const_cast<float*>(vectorVoxel.GetDataPointer());
-      int j = 0;
-      for(int i=0;i<bValuesTotal;i++){
-        if(bValuesMask[i]){
-          imageValuesPtr[j++] = imageVector[i];
-        }
-      }
+  // the models listed with --models, or the single selected model
+  std::vector<std::string> modelNames = models;
+  if(modelNames.empty())
+    modelNames.push_back(modelName);
+
+  // the fitted volume and the quality of fit maps are computed for a single
+  // model
+  if(modelNames.size() > 1 && (fittedVolumeFileName.size() || rsqrVolumeFileName.size()
+      || ssdFittedVolumeFileName.size() || ssdVolumeFileName.size()
+      || csFittedVolumeFileName.size() || csVolumeFileName.size())){
+    std::cerr << "ERROR: The fitted volume and the quality of fit maps are not available when several models are fitted!" << std::endl;
+    return -1;
+  }
 
-      int numberOfSelectedPoints = j;
-      costFunction->SetNumberOfValues(numberOfSelectedPoints);
+  OutputFileNames outputFileNames;
+  FittingJob job;
+  job.monoExponentialModel = -1;
+
+  // set up the models and their output maps
+  for(unsigned m=0;m<modelNames.size();m++){
+    FittingModel model;
+
+    if(modelNames[m] == "BiExponential")
+      model.modelType = DecayCostFunction::BiExponential;
+    else if(modelNames[m] == "MonoExponential")
+      model.modelType = DecayCostFunction::MonoExponential;
+    else if(modelNames[m] == "Kurtosis")
+      model.modelType = DecayCostFunction::Kurtosis;
+    else if(modelNames[m] == "StretchedExponential")
+      model.modelType = DecayCostFunction::StretchedExponential;
+    else if(modelNames[m] == "Gamma")
+      model.modelType = DecayCostFunction::Gamma;
+    else {
+      std::cerr << "ERROR: Unknown model type specified: " << modelNames[m] << std::endl;
+      return -1;
+    }
 
-      costFunction->SetY(imageValuesPtr,bValuesSelected);
+    for(unsigned k=0;k<job.models.size();k++){
+      if(job.models[k].modelType == model.modelType){
+        std::cerr << "ERROR: Model " << modelNames[m] << " is specified more than once!" << std::endl;
+        return -1;
+      }
+    }
 
-      DecayCostFunction::ParametersType initialValue = costFunction->GetInitialValue();
-      initialValue[0] = vectorVoxel[0];
-      DecayCostFunction::MeasureType temp = costFunction->GetValue(initialValue);
-      optimizer->UseCostFunctionGradientOff();
-      optimizer->SetCostFunction(costFunction);
+    model.fitMethod = method;
+    if((method == FitMethodLogLinear || method == FitMethodLogLinearThenLM)
+        && model.modelType != DecayCostFunction::MonoExponential
+        && model.modelType != DecayCostFunction::Kurtosis){
+      if(modelNames.size() == 1){
+        std::cerr << "ERROR: Log-linear fitting is only available for the MonoExponential and Kurtosis models!" << std::endl;
+        return -1;
+      }
+      std::cout << "WARNING: Log-linear fitting is not available for the " << modelNames[m]
+                << " model, Levenberg-Marquardt fitting will be used" << std::endl;
+      model.fitMethod = FitMethodLM;
+    }
 
-      itk::LevenbergMarquardtOptimizer::InternalOptimizerType *vnlOptimizer = optimizer->GetOptimizer();
-      vnlOptimizer->set_f_tolerance(1e-4f);
-      vnlOptimizer->set_g_tolerance(1e-4f);
-      vnlOptimizer->set_x_tolerance(1e-5f);
-      vnlOptimizer->set_epsilon_function(1e-9f);
-      vnlOptimizer->set_max_function_evals(200);
+    DecayCostFunction::Pointer costFunction = DecayCostFunction::New();
+    costFunction->SetModelType(model.modelType);
+
+    // set initial parameters model-dependent
+    DecayCostFunction::ParametersType initialValue = costFunction->GetInitialValue();
+    switch(model.modelType){
+      case DecayCostFunction::BiExponential:
+        initialValue[0] = biExpInitParameters[0];
+        initialValue[1] = biExpInitParameters[1];
+        initialValue[2] = biExpInitParameters[2];
+        initialValue[3] = biExpInitParameters[3];
+        break;
+      case DecayCostFunction::MonoExponential:
+        initialValue[0] = monoExpInitParameters[0];
+        initialValue[1] = monoExpInitParameters[1];
+        break;
+      case DecayCostFunction::Kurtosis:
+        initialValue[0] = kurtosisInitParameters[0];
+        initialValue[1] = kurtosisInitParameters[1];
+        initialValue[2] = kurtosisInitParameters[2];
+        break;
+      case DecayCostFunction::StretchedExponential:
+        initialValue[0] = stretchedExpInitParameters[0];
+        initialValue[1] = stretchedExpInitParameters[1];
+        initialValue[2] = stretchedExpInitParameters[2];
+        break;
+      case DecayCostFunction::Gamma:
+        initialValue[0] = gammaInitParameters[0];
+        initialValue[1] = gammaInitParameters[1];
+        initialValue[2] = gammaInitParameters[2];
+        break;
+      default:abort();
+    }
 
-      try {
-        optimizer->SetInitialPosition(initialValue);
-        optimizer->StartOptimization();
-      } catch(itk::ExceptionObject &e) {
-        std::cerr << " Exception caught: " << e << std::endl;
-      }
+    costFunction->SetInitialValues(initialValue);
+    model.initialValue = costFunction->GetInitialValue();
 
-      itk::LevenbergMarquardtOptimizer::ParametersType finalPosition;
+    if(model.modelType == DecayCostFunction::Gamma) {
+      // include computed mode map as output
+      model.numberOfMaps = costFunction->GetNumberOfParameters()+1;
+    } else {
+      model.numberOfMaps = costFunction->GetNumberOfParameters();
+    }
+    // output file names for each of the parameter maps; the scale map is
+    // never saved
+    std::vector<std::string> parameterMapFileNames(model.numberOfMaps);
+    switch(model.modelType){
+      case DecayCostFunction::BiExponential:
+        parameterMapFileNames[1] = fastDiffFractionMapFileName;
+        parameterMapFileNames[2] = slowDiffMapFileName;
+        parameterMapFileNames[3] = fastDiffMapFileName;
+        break;
+      case DecayCostFunction::Kurtosis:
+        parameterMapFileNames[1] = kurtosisMapFileName;
+        parameterMapFileNames[2] = kurtosisDiffMapFileName;
+        break;
+      case DecayCostFunction::MonoExponential:
+        parameterMapFileNames[1] = adcMapFileName;
+        break;
+      case DecayCostFunction::StretchedExponential:
+        parameterMapFileNames[1] = DDCMapFileName;
+        parameterMapFileNames[2] = alphaMapFileName;
+        break;
+      case DecayCostFunction::Gamma:
+        parameterMapFileNames[1] = kMapFileName;
+        parameterMapFileNames[2] = thetaMapFileName;
+        parameterMapFileNames[3] = modeMapFileName;
+        break;
+      default:abort();
+    }
 
-      // fitted vector for all input b-values
-      finalPosition = optimizer->GetCurrentPosition();
-      for(int i=0;i<fittedVoxel.GetSize();i++){
-        fittedVoxel[i] = costFunction->GetFittedValue(finalPosition, bValues[i]);
+    if(model.fitMethod == FitMethodDictionary || model.fitMethod == FitMethodDictionaryThenLM){
+      std::shared_ptr<SignalDictionary> dictionary(new SignalDictionary(model.modelType,
+        dictionaryResolution, bValuesPtr, bValuesSelected));
+      std::string cacheFileName;
+      if(dictionaryCacheDirectory.size()){
+        itksys::SystemTools::MakeDirectory(dictionaryCacheDirectory);
+        cacheFileName = dictionary->GetCacheFileName(dictionaryCacheDirectory);
       }
-
-      // fitted values for the b-values used in fitting only
-      for(int i=0;i<bValuesSelected;i++){
-        fittedValuesPtr[i] = costFunction->GetFittedValue(finalPosition,bValuesPtr[i]);
+      itk::TimeProbe dictionaryClock;
+      dictionaryClock.Start();
+      if(cacheFileName.size() && dictionary->Load(cacheFileName)){
+        std::cout << "Loaded the " << modelNames[m] << " dictionary from " << cacheFileName;
+      } else {
+        dictionary->Compute();
+        std::cout << "Computed the " << modelNames[m] << " dictionary";
+        if(cacheFileName.size() && !dictionary->Save(cacheFileName))
+          std::cout << " (WARNING: could not write " << cacheFileName << ")";
       }
+      dictionaryClock.Stop();
+      std::cout << ": " << dictionary->GetNumberOfEntries() << " entries, "
+                << dictionaryClock.GetTotal() << " s" << std::endl;
+      model.dictionary = dictionary;
+    }
 
-      //std::cout << std::endl;
-      fittedIt.Set(fittedVoxel);
-      //std::cout << "Fitted voxel: " << fittedVoxel << " params: " << finalPosition << std::endl;
-      switch(modelType){
-        case DecayCostFunction::BiExponential:{
-          parameterMapItVector[0].Set(finalPosition[0]);
-          parameterMapItVector[1].Set(finalPosition[1]);
-          parameterMapItVector[2].Set(finalPosition[2]*1e+6);
-          parameterMapItVector[3].Set(finalPosition[3]*1e+6);
-          break;
-        }
-        case DecayCostFunction::Kurtosis:{
-          parameterMapItVector[0].Set(finalPosition[0]);
-          parameterMapItVector[1].Set(finalPosition[1]);
-          parameterMapItVector[2].Set(finalPosition[2]*1e+6);
-          break;
-        }
-        case DecayCostFunction::MonoExponential:{
-          parameterMapItVector[0].Set(finalPosition[0]);
-          parameterMapItVector[1].Set(finalPosition[1]*1e+6);
-          break;
-        }
-        case DecayCostFunction::StretchedExponential:{
-          parameterMapItVector[0].Set(finalPosition[0]);
-          parameterMapItVector[1].Set(finalPosition[1]*1e+6); // DDC
-          parameterMapItVector[2].Set(finalPosition[2]); // alpha
-          break;
-        }
-        case DecayCostFunction::Gamma:{
-          parameterMapItVector[0].Set(finalPosition[0]);
-          parameterMapItVector[1].Set(finalPosition[1]); // k
-          parameterMapItVector[2].Set(finalPosition[2]*1e+6); // theta
-          parameterMapItVector[3].Set((finalPosition[1]-1)*finalPosition[2]); // mode
-          break;
-        }
+    if(model.modelType == DecayCostFunction::MonoExponential)
+      job.monoExponentialModel = job.models.size();
+    job.models.push_back(model);
+    outputFileNames.parameterMaps.push_back(parameterMapFileNames);
+  }
 
-      default: abort();
-      }
+  outputFileNames.rsqr = rsqrVolumeFileName;
+  outputFileNames.ssdFitted = ssdFittedVolumeFileName;
+  outputFileNames.ssd = ssdVolumeFileName;
+  outputFileNames.csFitted = csFittedVolumeFileName;
+  outputFileNames.cs = csVolumeFileName;
+  outputFileNames.fittedVolume = fittedVolumeFileName;
+  outputFileNames.combinedMaps = combinedMapsFileName;
+  outputFileNames.fitStatus = fitStatusFileName;
+
+  job.inputVectorVolume = inputVectorVolume;
+  job.maskVolume = maskVolume;
+  job.warmStart = warmStart;
+  job.initializationMode = initialization;
+  job.useNumericalJacobian = numericalJacobian;
+  job.bValues = bValues;
+  job.bValuesPtr = bValuesPtr;
+  job.bValuesMask = bValuesMask;
+  job.bValuesTotal = bValuesTotal;
+  job.bValuesSelected = bValuesSelected;
+
+  job.bValueOrder.resize(bValuesTotal);
+  for(int i=0;i<bValuesTotal;i++)
+    job.bValueOrder[i] = i;
+  std::stable_sort(job.bValueOrder.begin(), job.bValueOrder.end(),
+    [&bValues](unsigned a, unsigned b){ return bValues[a] < bValues[b]; });
+  job.minimumSNR = minimumSNR;
+  job.rejectNonMonotone = rejectNonMonotone;
+  job.noiseLevel = 0;
+  job.fitStatusMap = nullptr;
+  // the noise level is estimated below if not given
+  const bool screeningEnabled = minimumSNR > 0 || rejectNonMonotone;
+  if(screeningEnabled)
+    job.noiseLevel = noiseLevel;
+
+  // fit the voxels in parallel
+  unsigned threadsToUse = numberOfThreads;
+  if(numberOfThreads <= 0)
+    threadsToUse = itk::MultiThreaderBase::GetGlobalDefaultNumberOfThreads();
+
+  std::vector<FittingThreadStatistics> threadStatistics(threadsToUse);
+  ScreeningStatistics screeningStatistics;
+
+  // the background of the b0 frame is sampled to estimate the noise level,
+  // taking about a million voxels
+  const unsigned long backgroundStride = std::max<unsigned long>(1,
+    inputVectorVolume->GetLargestPossibleRegion().GetNumberOfPixels()/1000000);
+  std::vector<float> backgroundSample;
+
+  itk::TimeProbe fittingClock;
+
+  if(!streaming){
+    // only the outputs requested by the user are allocated and computed
+    // (note mask is initialized even if not passed by the user)
+    AllocateOutputs(job, outputFileNames, maskVolume, inputVectorVolume,
+                    maskVolume->GetLargestPossibleRegion());
+
+    if(screeningEnabled && job.noiseLevel <= 0){
+      SampleBackground(inputVectorVolume, job.bValueOrder[0], backgroundStride, backgroundSample);
+      job.noiseLevel = EstimateNoiseLevel(backgroundSample);
+      std::cout << "Estimated noise level: " << job.noiseLevel << std::endl;
+    }
 
-      // initialize the rsqr map
-      // see PkModeling/CLI/itkConcentrationToQuantitativeImageFilter.hxx:452
-      {
-        // Error measures are calculated separately for those b-values that were
-        // used in the fitting process (*Fitted) and for all of the b-values
-        // available in the data
-        double rmsFitted = optimizer->GetOptimizer()->get_end_error();
-        double SSerrFitted = rmsFitted*rmsFitted*bValuesSelected;
-        double SSerr = 0;
-        double sumSquaredDifferences = 0, sumSquaredDifferencesFitted = 0;
-        double sumSquared = 0.0, sumSquaredFitted = 0;
-        double sum = 0.0, sumFitted = 0;
-        double rSquared = 0.0;
-
-        for (unsigned int i=0; i < bValuesSelected; ++i){
-          sumFitted += imageValuesPtr[i];
-          sumSquaredFitted += (imageValuesPtr[i]*imageValuesPtr[i]);
-          sumSquaredDifferencesFitted += (imageValuesPtr[i]-fittedValuesPtr[i])*(imageValuesPtr[i]-fittedValuesPtr[i]);
-        }
+    fittingClock.Start();
+    RunFittingThreads(job, threadsToUse, threadStatistics, screeningStatistics);
+    fittingClock.Stop();
 
-        for (unsigned int i=0; i < vectorVoxel.GetSize(); ++i){
-          sum += vectorVoxel[i];
-          sumSquared += (vectorVoxel[i]*vectorVoxel[i]);
-          sumSquaredDifferences += (vectorVoxel[i]-fittedVoxel[i])*(vectorVoxel[i]-fittedVoxel[i]);
-        }
+    itk::TimeProbe writingClock;
+    writingClock.Start();
 
-        double SStotFitted = sumSquaredFitted - sumFitted*sumFitted/(double)bValuesSelected;
-        double SStot = sumSquared - sum*sum/(double)vectorVoxel.GetSize();
+    std::vector<itk::ProcessObject::Pointer> writers;
+    for(unsigned m=0;m<job.models.size();m++){
+      for(unsigned i=0;i<job.models[m].numberOfMaps;i++){
+        if(outputFileNames.parameterMaps[m][i].size())
+          writers.push_back(CreateWriter<MapVolumeType>(job.models[m].parameterMapVector[i],
+            outputFileNames.parameterMaps[m][i], compression));
+      }
+    }
 
-        rSquared = 1.0 - (SSerrFitted / SStotFitted);
+    const std::string errorMapNames[] = {"RSquared", "SSDFitted", "SSD", "ChiSquaredFitted", "ChiSquared"};
+    const std::string errorMapFileNames[] = {rsqrVolumeFileName, ssdFittedVolumeFileName,
+      ssdVolumeFileName, csFittedVolumeFileName, csVolumeFileName};
+    MapVolumeType::Pointer errorMaps[] = {job.rsqrMap, job.ssdFittedMap,
+      job.ssdMap, job.csFittedMap, job.csMap};
+    for(unsigned i=0;i<5;i++){
+      if(errorMapFileNames[i].size())
+        writers.push_back(CreateWriter<MapVolumeType>(errorMaps[i], errorMapFileNames[i], compression));
+    }
 
-        double chiSquaredNormFitted = sumSquaredDifferencesFitted/((double)bValuesSelected-numberOfMaps);
-        double chiSquaredNorm = sumSquaredDifferences/((double)vectorVoxel.GetSize()-numberOfMaps);
-        double chiSquaredFitted = 2.*sqrt(chiSquaredNormFitted);
-        double chiSquared = 2.*sqrt(chiSquaredNorm);
+    if(fittedVolumeFileName.size()){
+      job.fittedVolume->SetMetaDataDictionary(inputVectorVolume->GetMetaDataDictionary());
+      writers.push_back(CreateWriter<VectorVolumeType>(job.fittedVolume, fittedVolumeFileName, compression));
+    }
 
-        rsqrIt.Set(rSquared);
-        ssdFittedIt.Set(sumSquaredDifferencesFitted);
-        ssdIt.Set(sumSquaredDifferences);
-        csIt.Set(chiSquared);
-        csFittedIt.Set(chiSquaredFitted);
+    if(fitStatusFileName.size())
+      writers.push_back(CreateWriter<MaskVolumeType>(job.fitStatusMap, fitStatusFileName, compression));
+
+    // All parameter and error maps in a single file, with one component per
+    // map. It is never compressed, so that the detached payload of a .nhdr
+    // file can be memory mapped by the tools reading it.
+    if(combinedMapsFileName.size()){
+      std::vector<MapVolumeType::Pointer> maps;
+      std::string componentNames;
+      for(unsigned m=0;m<job.models.size();m++){
+        std::vector<std::string> names = GetParameterMapNames(job.models[m].modelType);
+        for(unsigned i=1;i<job.models[m].numberOfMaps;i++){
+          maps.push_back(job.models[m].parameterMapVector[i]);
+          componentNames += (componentNames.size() ? ";" : "") + modelNames[m] + "." + names[i];
+        }
       }
+      for(unsigned i=0;i<5 && job.models.size()==1;i++){
+        maps.push_back(errorMaps[i]);
+        componentNames += ";" + errorMapNames[i];
+      }
+      VectorVolumeType::Pointer combinedMaps = CombineMaps(maps);
+      itk::EncapsulateMetaData<std::string>(combinedMaps->GetMetaDataDictionary(),
+        "DWModeling.ComponentNames", componentNames);
+      writers.push_back(CreateWriter<VectorVolumeType>(combinedMaps, combinedMapsFileName, CompressionNone));
     }
 
-    for(int i=0;i<numberOfMaps;i++){
-      ++parameterMapItVector[i];
+    RunWriters(writers, threadsToUse);
+    writingClock.Stop();
+    std::cout << "Wrote " << writers.size() << " outputs in " << writingClock.GetTotal() << " s" << std::endl;
+  } else {
+    const itk::ImageBase<3> *mapReference = maskReader ?
+      static_cast<const itk::ImageBase<3>*>(maskReader->GetOutput()) : inputVectorVolume.GetPointer();
+    const VectorVolumeRegionType largestRegion = inputVectorVolume->GetLargestPossibleRegion();
+    const unsigned numberOfComponents = inputVectorVolume->GetNumberOfComponentsPerPixel();
+
+    // Size the slabs so that the input (as read and as extracted), the
+    // mask and the requested outputs of a slab fit within the budget
+    double bytesPerVoxel = 2.*numberOfComponents*sizeof(VectorVolumePixelType) + sizeof(MaskVolumePixelType);
+    for(unsigned m=0;m<job.models.size();m++)
+      for(unsigned i=0;i<job.models[m].numberOfMaps;i++)
+        if(outputFileNames.parameterMaps[m][i].size())
+          bytesPerVoxel += sizeof(MapVolumePixelType);
+    const std::string errorMapFileNames[] = {rsqrVolumeFileName, ssdFittedVolumeFileName,
+      ssdVolumeFileName, csFittedVolumeFileName, csVolumeFileName};
+    for(unsigned i=0;i<5;i++)
+      if(errorMapFileNames[i].size())
+        bytesPerVoxel += sizeof(MapVolumePixelType);
+    if(fittedVolumeFileName.size())
+      bytesPerVoxel += numberOfComponents*sizeof(VectorVolumePixelType);
+    if(fitStatusFileName.size())
+      bytesPerVoxel += sizeof(MaskVolumePixelType);
+
+    const double bytesPerSlice = bytesPerVoxel*largestRegion.GetSize(0)*largestRegion.GetSize(1);
+    unsigned long slabThickness = static_cast<unsigned long>(memoryBudget*1024.*1024./bytesPerSlice);
+    slabThickness = std::max(slabThickness, 1UL);
+    slabThickness = std::min(slabThickness, static_cast<unsigned long>(largestRegion.GetSize(2)));
+    std::cout << "Streaming mode: fitting slabs of " << slabThickness << " slices" << std::endl;
+
+    // Readers that can not read a region of the file load the whole image;
+    // it is then kept in memory rather than re-read for every slab
+    if(multiVolumeReader->GetImageIO()->CanStreamRead())
+      multiVolumeReader->ReleaseDataFlagOn();
+    else
+      std::cout << "WARNING: the format of " << imageName << " does not support streamed reading,"
+                << " the whole image will be loaded" << std::endl;
+    if(maskReader && maskReader->GetImageIO()->CanStreamRead())
+      maskReader->ReleaseDataFlagOn();
+
+    std::vector<std::vector<StreamedOutput<MapVolumeType>*> > parameterMapOutputs(job.models.size());
+    for(unsigned m=0;m<job.models.size();m++){
+      parameterMapOutputs[m].resize(job.models[m].numberOfMaps);
+      for(unsigned i=0;i<job.models[m].numberOfMaps;i++)
+        if(outputFileNames.parameterMaps[m][i].size())
+          parameterMapOutputs[m][i] = new StreamedOutput<MapVolumeType>(outputFileNames.parameterMaps[m][i],
+            mapReference, itk::MetaDataDictionary(), compression);
+    }
+    std::vector<StreamedOutput<MapVolumeType>*> errorMapOutputs(5);
+    for(unsigned i=0;i<5;i++)
+      if(errorMapFileNames[i].size())
+        errorMapOutputs[i] = new StreamedOutput<MapVolumeType>(errorMapFileNames[i],
+          mapReference, itk::MetaDataDictionary(), compression);
+    StreamedOutput<VectorVolumeType> *fittedVolumeOutput = nullptr;
+    if(fittedVolumeFileName.size())
+      fittedVolumeOutput = new StreamedOutput<VectorVolumeType>(fittedVolumeFileName,
+        inputVectorVolume, inputVectorVolume->GetMetaDataDictionary(), compression);
+    StreamedOutput<MaskVolumeType> *fitStatusOutput = nullptr;
+    if(fitStatusFileName.size())
+      fitStatusOutput = new StreamedOutput<MaskVolumeType>(fitStatusFileName,
+        mapReference, itk::MetaDataDictionary(), compression);
+
+    VectorVolumeExtractorType::Pointer inputExtractor = VectorVolumeExtractorType::New();
+    inputExtractor->SetInput(multiVolumeReader->GetOutput());
+    inputExtractor->SetDirectionCollapseToSubmatrix();
+    MaskVolumeExtractorType::Pointer maskExtractor = MaskVolumeExtractorType::New();
+    if(maskReader){
+      maskExtractor->SetInput(maskReader->GetOutput());
+      maskExtractor->SetDirectionCollapseToSubmatrix();
     }
-    ++rsqrIt;++mvIt;++fittedIt;
-    ++ssdFittedIt;++ssdIt;
-    ++csFittedIt;++csIt;
-  }
 
-  switch(modelType){
-    case DecayCostFunction::BiExponential:{
-      if(fastDiffFractionMapFileName.size())
-        SaveMap(parameterMapVector[1], fastDiffFractionMapFileName);
-      if(slowDiffMapFileName.size())
-        SaveMap(parameterMapVector[2], slowDiffMapFileName);
-      if(fastDiffMapFileName.size())
-        SaveMap(parameterMapVector[3], fastDiffMapFileName);
-      break;
+    // Only the bounding box of the mask is read from the input. The mask is
+    // scanned slab by slab first to find it.
+    VectorVolumeRegionType workRegion = largestRegion;
+    if(maskReader){
+      MaskVolumeType::IndexType lower, upper;
+      lower.Fill(itk::NumericTraits<itk::IndexValueType>::max());
+      upper.Fill(itk::NumericTraits<itk::IndexValueType>::NonpositiveMin());
+      for(unsigned long slabStart=0; slabStart<largestRegion.GetSize(2); slabStart+=slabThickness){
+        VectorVolumeRegionType slab = largestRegion;
+        slab.SetIndex(2, largestRegion.GetIndex(2)+slabStart);
+        slab.SetSize(2, std::min(slabThickness, largestRegion.GetSize(2)-slabStart));
+        maskExtractor->SetExtractionRegion(slab);
+        maskExtractor->Update();
+        UpdateMaskBounds(maskExtractor->GetOutput(), lower, upper);
+      }
+      if(lower[0] > upper[0]){
+        workRegion.SetSize(2, 0);
+      } else {
+        for(unsigned d=0;d<3;d++){
+          workRegion.SetIndex(d, lower[d]);
+          workRegion.SetSize(d, upper[d]-lower[d]+1);
+        }
+      }
+      std::cout << "Mask bounding box: " << workRegion << std::endl;
     }
-    case DecayCostFunction::Kurtosis:{
-      if(kurtosisMapFileName.size())
-        SaveMap(parameterMapVector[1], kurtosisMapFileName);
-      if(kurtosisDiffMapFileName.size())
-        SaveMap(parameterMapVector[2], kurtosisDiffMapFileName);
-      break;
+
+    // The noise level is estimated from the whole b0 frame, which is read
+    // slab by slab in an additional pass
+    if(screeningEnabled && job.noiseLevel <= 0){
+      for(unsigned long slabStart=0; slabStart<largestRegion.GetSize(2); slabStart+=slabThickness){
+        VectorVolumeRegionType slab = largestRegion;
+        slab.SetIndex(2, largestRegion.GetIndex(2)+slabStart);
+        slab.SetSize(2, std::min(slabThickness, largestRegion.GetSize(2)-slabStart));
+        inputExtractor->SetExtractionRegion(slab);
+        inputExtractor->Update();
+        SampleBackground(inputExtractor->GetOutput(), job.bValueOrder[0], backgroundStride, backgroundSample);
+      }
+      job.noiseLevel = EstimateNoiseLevel(backgroundSample);
+      std::cout << "Estimated noise level: " << job.noiseLevel << std::endl;
     }
-    case DecayCostFunction::MonoExponential:{
-      if(adcMapFileName.size())
-        SaveMap(parameterMapVector[1], adcMapFileName);
-      break;
+
+    for(unsigned m=0;m<job.models.size();m++)
+      job.models[m].parameterMapVector.resize(job.models[m].numberOfMaps);
+
+    fittingClock.Start();
+    for(unsigned long slabStart=0; slabStart<largestRegion.GetSize(2); slabStart+=slabThickness){
+      VectorVolumeRegionType slab = largestRegion;
+      slab.SetIndex(2, largestRegion.GetIndex(2)+slabStart);
+      slab.SetSize(2, std::min(slabThickness, largestRegion.GetSize(2)-slabStart));
+
+      // outputs of a slab outside of the mask bounding box are left zero
+      VectorVolumeRegionType slabWorkRegion = slab;
+      const bool fitSlab = workRegion.GetNumberOfPixels() && slabWorkRegion.Crop(workRegion);
+
+      if(fitSlab){
+        inputExtractor->SetExtractionRegion(slabWorkRegion);
+        inputExtractor->Update();
+        job.inputVectorVolume = inputExtractor->GetOutput();
+
+        if(maskReader){
+          maskExtractor->SetExtractionRegion(slabWorkRegion);
+          maskExtractor->Update();
+          job.maskVolume = maskExtractor->GetOutput();
+        } else {
+          job.maskVolume = AllocateImage<MaskVolumeType>(inputVectorVolume, slabWorkRegion);
+          job.maskVolume->FillBuffer(1);
+        }
+      }
+
+      for(unsigned m=0;m<job.models.size();m++)
+        for(unsigned i=0;i<job.models[m].numberOfMaps;i++)
+          job.models[m].parameterMapVector[i] = parameterMapOutputs[m][i] ?
+            parameterMapOutputs[m][i]->GetSlabImage(slab) : nullptr;
+      MapVolumeType::Pointer *errorMaps[] = {&job.rsqrMap, &job.ssdFittedMap,
+        &job.ssdMap, &job.csFittedMap, &job.csMap};
+      for(unsigned i=0;i<5;i++)
+        *errorMaps[i] = errorMapOutputs[i] ? errorMapOutputs[i]->GetSlabImage(slab) : nullptr;
+      job.fittedVolume = fittedVolumeOutput ? fittedVolumeOutput->GetSlabImage(slab) : nullptr;
+      job.fitStatusMap = fitStatusOutput ? fitStatusOutput->GetSlabImage(slab) : nullptr;
+
+      if(fitSlab)
+        RunFittingThreads(job, threadsToUse, threadStatistics, screeningStatistics);
+
+      for(unsigned m=0;m<job.models.size();m++)
+        for(unsigned i=0;i<job.models[m].numberOfMaps;i++)
+          if(parameterMapOutputs[m][i])
+            parameterMapOutputs[m][i]->WriteSlab(slab);
+      for(unsigned i=0;i<5;i++)
+        if(errorMapOutputs[i])
+          errorMapOutputs[i]->WriteSlab(slab);
+      if(fittedVolumeOutput)
+        fittedVolumeOutput->WriteSlab(slab);
+      if(fitStatusOutput)
+        fitStatusOutput->WriteSlab(slab);
     }
-    case DecayCostFunction::StretchedExponential:{
-      if(DDCMapFileName.size())
-        SaveMap(parameterMapVector[1], DDCMapFileName);
-      if(alphaMapFileName.size())
-        SaveMap(parameterMapVector[2], alphaMapFileName);
-      break;
+    fittingClock.Stop();
+
+    // outputs that could not be written slab by slab are written together
+    std::vector<itk::ProcessObject::Pointer> writers;
+    for(unsigned m=0;m<job.models.size();m++)
+      for(unsigned i=0;i<job.models[m].numberOfMaps;i++)
+        if(parameterMapOutputs[m][i]){
+          writers.push_back(parameterMapOutputs[m][i]->CreateFinalWriter());
+          delete parameterMapOutputs[m][i];
+        }
+    for(unsigned i=0;i<5;i++)
+      if(errorMapOutputs[i]){
+        writers.push_back(errorMapOutputs[i]->CreateFinalWriter());
+        delete errorMapOutputs[i];
+      }
+    if(fittedVolumeOutput){
+      writers.push_back(fittedVolumeOutput->CreateFinalWriter());
+      delete fittedVolumeOutput;
     }
-    case DecayCostFunction::Gamma:{
-      if(thetaMapFileName.size())
-        SaveMap(parameterMapVector[1], kMapFileName);
-      if(kMapFileName.size())
-        SaveMap(parameterMapVector[2], thetaMapFileName);
-      if(modeMapFileName.size())
-        SaveMap(parameterMapVector[3], modeMapFileName);
-      break;
+    if(fitStatusOutput){
+      writers.push_back(fitStatusOutput->CreateFinalWriter());
+      delete fitStatusOutput;
     }
-
-    default:abort();
+    writers.erase(std::remove(writers.begin(), writers.end(), itk::ProcessObject::Pointer()), writers.end());
+    RunWriters(writers, threadsToUse);
   }
 
-  if(rsqrVolumeFileName.size())
-    SaveMap(rsqrMap, rsqrVolumeFileName);
-
-  if(ssdFittedVolumeFileName.size())
-    SaveMap(ssdFittedMap, ssdFittedVolumeFileName);
-  if(ssdVolumeFileName.size())
-    SaveMap(ssdMap, ssdVolumeFileName);
-  if(csFittedVolumeFileName.size())
-    SaveMap(csFittedMap, csFittedVolumeFileName);
-  if(csVolumeFileName.size())
-    SaveMap(csMap, csVolumeFileName);
-
-  if(fittedVolumeFileName.size()){
-    FittedVolumeWriterType::Pointer writer = FittedVolumeWriterType::New();
-    fittedVolume->SetMetaDataDictionary(inputVectorVolume->GetMetaDataDictionary());
-    writer->SetInput(fittedVolume);
-    writer->SetFileName(fittedVolumeFileName.c_str());
-    writer->SetUseCompression(1);
-    writer->Update();
+  unsigned long voxelsFitted = 0, voxelsFailed = 0, voxelsNotConverged = 0;
+  unsigned long evaluations = 0, iterations = 0, seededFits = 0;
+  for(unsigned i=0;i<threadsToUse;i++){
+    std::cout << "Thread " << i << ": fitted " << threadStatistics[i].numberOfVoxels
+              << " voxels in " << threadStatistics[i].numberOfChunks << " chunks, "
+              << threadStatistics[i].elapsedTime << " s" << std::endl;
+    voxelsFitted += threadStatistics[i].numberOfVoxels;
+    voxelsFailed += threadStatistics[i].numberOfFailedVoxels;
+    voxelsNotConverged += threadStatistics[i].numberOfNonConvergedVoxels;
+    evaluations += threadStatistics[i].numberOfEvaluations;
+    iterations += threadStatistics[i].numberOfIterations;
+    seededFits += threadStatistics[i].numberOfSeededFits;
+  }
+  std::cout << "Fitted " << voxelsFitted << " voxels using " << threadsToUse
+            << " threads in " << fittingClock.GetTotal() << " s" << std::endl;
+  if(voxelsFailed)
+    std::cout << voxelsFailed << " model fits could not be done log-linearly or by dictionary matching" << std::endl;
+  if(screeningEnabled)
+    std::cout << "Skipped voxels: " << screeningStatistics.numberOfLowSNRVoxels << " below the minimum SNR, "
+              << screeningStatistics.numberOfNonMonotoneVoxels << " with a non-monotone decay" << std::endl;
+  std::cout << "Voxels where the optimizer did not converge: " << voxelsNotConverged << std::endl;
+  if(voxelsFitted && evaluations){
+    std::cout << "Average number of cost function evaluations per voxel: "
+              << double(evaluations)/voxelsFitted
+              << (numericalJacobian ? " (finite-difference Jacobian)" : " (analytic Jacobian)")
+              << std::endl;
+    std::cout << "Average number of iterations per voxel: "
+              << double(iterations)/voxelsFitted << std::endl;
   }
+  if(initialization != InitializationGlobal)
+    std::cout << "Fits initialized from " << (initialization == InitializationNeighbour ?
+                 "neighbour voxels: " : "coarse blocks: ") << seededFits << std::endl;
+
+  std::cout << "Peak resident memory: " << GetPeakResidentMemoryMB() << " MB" << std::endl;
 
   return EXIT_SUCCESS;
 }
+#endif
@@ -0,0 +1,246 @@
+// Fitting engine of the DWModeling CLI as a shared library with a C
+// interface, so that signals held in memory can be fitted without going
+// through NRRD files. See DWModelingFitter.py for the Python binding.
+
+#define DWMODELING_FITTER_LIBRARY
+#include "DWModeling.cxx"
+
+#include <limits>
+#include <mutex>
+
+#if defined(_WIN32)
+#define DWMODELINGFITTER_EXPORT __declspec(dllexport)
+#else
+#define DWMODELINGFITTER_EXPORT __attribute__((visibility("default")))
+#endif
+
+// Message of the last error of the calling thread
+static thread_local std::string DWModelingFitterLastError;
+
+static bool GetModelType(const char *modelName, DecayCostFunction::Model &modelType)
+{
+  const std::string name = modelName ? modelName : "";
+  if(name == "BiExponential")
+    modelType = DecayCostFunction::BiExponential;
+  else if(name == "MonoExponential")
+    modelType = DecayCostFunction::MonoExponential;
+  else if(name == "Kurtosis")
+    modelType = DecayCostFunction::Kurtosis;
+  else if(name == "StretchedExponential")
+    modelType = DecayCostFunction::StretchedExponential;
+  else if(name == "Gamma")
+    modelType = DecayCostFunction::Gamma;
+  else {
+    DWModelingFitterLastError = "Unknown model type specified: " + name;
+    return false;
+  }
+  return true;
+}
+
+static bool GetFitMethod(const char *fitMethodName, FitMethod &method)
+{
+  const std::string name = fitMethodName ? fitMethodName : "";
+  if(name == "LM")
+    method = FitMethodLM;
+  else if(name == "LogLinear")
+    method = FitMethodLogLinear;
+  else if(name == "LogLinearThenLM")
+    method = FitMethodLogLinearThenLM;
+  else if(name == "Dictionary")
+    method = FitMethodDictionary;
+  else if(name == "DictionaryThenLM")
+    method = FitMethodDictionaryThenLM;
+  else {
+    DWModelingFitterLastError = "Unknown fit method specified: " + name;
+    return false;
+  }
+  return true;
+}
+
+static unsigned GetNumberOfMaps(DecayCostFunction::Model modelType)
+{
+  DecayCostFunction::Pointer costFunction = DecayCostFunction::New();
+  costFunction->SetModelType(modelType);
+  // the mode map is computed in addition to the Gamma model parameters
+  return costFunction->GetNumberOfParameters() + (modelType == DecayCostFunction::Gamma ? 1 : 0);
+}
+
+extern "C" {
+
+// Message describing the last error of the calling thread
+DWMODELINGFITTER_EXPORT const char *DWModelingFitterGetLastError()
+{
+  return DWModelingFitterLastError.c_str();
+}
+
+// Number of parameter values returned per signal for the model, including
+// the scale, or 0 if the model is unknown
+DWMODELINGFITTER_EXPORT int DWModelingFitterGetNumberOfParameters(const char *modelName)
+{
+  DecayCostFunction::Model modelType;
+  if(!GetModelType(modelName, modelType))
+    return 0;
+  return GetNumberOfMaps(modelType);
+}
+
+// Name of a parameter of the model, in the order of the returned values
+DWMODELINGFITTER_EXPORT const char *DWModelingFitterGetParameterName(const char *modelName, int parameter)
+{
+  static const std::string scale = "Scale";
+  static std::vector<std::string> names[5];
+  DecayCostFunction::Model modelType;
+  if(!GetModelType(modelName, modelType) || parameter < 0 || parameter >= int(GetNumberOfMaps(modelType)))
+    return nullptr;
+  if(parameter == 0)
+    return scale.c_str();
+  // names of the components of the combined maps of the CLI; computed
+  // once per model and kept for the lifetime of the library
+  static std::mutex namesMutex;
+  std::lock_guard<std::mutex> lock(namesMutex);
+  if(names[modelType].empty())
+    names[modelType] = GetParameterMapNames(modelType);
+  return names[modelType][parameter].c_str();
+}
+
+// Number of error measures returned per signal
+DWMODELINGFITTER_EXPORT int DWModelingFitterGetNumberOfErrorMeasures()
+{
+  return NumberOfErrorMeasures;
+}
+
+// Fit the model to numberOfSignals signals of numberOfValues values each,
+// stored contiguously in signals, with the given b-values. For every signal,
+// parameters receives the values returned by
+// DWModelingFitterGetNumberOfParameters(), scaled as in the parameter maps of
+// the CLI, and errors (if not null) the R^2, SSD and chi squared measures in
+// the order of the error maps of the CLI. Signals that are zero at the first
+// b-value, as well as those that could not be fitted, are set to NaN.
+// initialParameters, if not null, replaces the initial values of the
+// parameters (without scaling, the scale being ignored). dictionaryResolution
+// is the grid resolution of the dictionary fit methods. numberOfThreads of 0
+// uses all available cores. Returns 0 on success, and -1 otherwise, with the
+// error message available from DWModelingFitterGetLastError().
+DWMODELINGFITTER_EXPORT int DWModelingFitterFitSignals(const float *signals, unsigned long numberOfSignals,
+                                                       int numberOfValues, const float *bValues,
+                                                       const char *modelName, const char *fitMethodName,
+                                                       const double *initialParameters,
+                                                       int dictionaryResolution, int numberOfThreads,
+                                                       float *parameters, float *errors)
+{
+  try {
+    FittingModel model;
+    FitMethod method;
+    if(!GetModelType(modelName, model.modelType) || !GetFitMethod(fitMethodName, method))
+      return -1;
+    if(numberOfValues < 2){
+      DWModelingFitterLastError = "Less than 2 values per signal, cannot do the fit";
+      return -1;
+    }
+    if((method == FitMethodLogLinear || method == FitMethodLogLinearThenLM)
+        && model.modelType != DecayCostFunction::MonoExponential
+        && model.modelType != DecayCostFunction::Kurtosis){
+      DWModelingFitterLastError = "Log-linear fitting is only available for the MonoExponential and Kurtosis models";
+      return -1;
+    }
+
+    DecayCostFunction::Pointer costFunction = DecayCostFunction::New();
+    costFunction->SetModelType(model.modelType);
+    if(initialParameters){
+      DecayCostFunction::ParametersType initialValue = costFunction->GetInitialValue();
+      for(unsigned i=1;i<initialValue.size();i++)
+        initialValue[i] = initialParameters[i];
+      costFunction->SetInitialValues(initialValue);
+    }
+    model.initialValue = costFunction->GetInitialValue();
+    model.numberOfMaps = GetNumberOfMaps(model.modelType);
+    model.fitMethod = method;
+    if(method == FitMethodDictionary || method == FitMethodDictionaryThenLM){
+      std::shared_ptr<SignalDictionary> dictionary(new SignalDictionary(model.modelType,
+        dictionaryResolution, bValues, numberOfValues));
+      dictionary->Compute();
+      model.dictionary = dictionary;
+    }
+
+    // all values of the signals are used in fitting
+    std::unique_ptr<bool[]> bValuesMask(new bool[numberOfValues]);
+    std::fill(bValuesMask.get(), bValuesMask.get()+numberOfValues, true);
+    FittingJob job;
+    job.models.push_back(model);
+    job.monoExponentialModel = model.modelType == DecayCostFunction::MonoExponential ? 0 : -1;
+    job.warmStart = false;
+    job.initializationMode = InitializationGlobal;
+    job.useNumericalJacobian = false;
+    job.bValues.assign(bValues, bValues+numberOfValues);
+    job.bValuesPtr = bValues;
+    job.bValuesMask = bValuesMask.get();
+    job.bValuesTotal = numberOfValues;
+    job.bValuesSelected = numberOfValues;
+    // signals are not pre-screened
+    job.noiseLevel = 0;
+    job.minimumSNR = 0;
+    job.rejectNonMonotone = false;
+    job.fitStatusMap = nullptr;
+
+    unsigned threadsToUse = numberOfThreads;
+    if(numberOfThreads <= 0)
+      threadsToUse = itk::MultiThreaderBase::GetGlobalDefaultNumberOfThreads();
+    const unsigned long numberOfChunks = (numberOfSignals+MaskedVoxelChunkSize-1)/MaskedVoxelChunkSize;
+    threadsToUse = std::max(1UL, std::min<unsigned long>(threadsToUse, numberOfChunks));
+
+    std::atomic<unsigned long> nextChunk(0);
+
+    itk::MultiThreaderBase::Pointer threader = itk::MultiThreaderBase::New();
+    threader->SetMaximumNumberOfThreads(threadsToUse);
+    threader->SetNumberOfWorkUnits(threadsToUse);
+
+    threader->ParallelizeArray(0, threadsToUse,
+      [&](itk::SizeValueType)
+      {
+        FittingThreadStatistics statistics;
+        SignalFitter fitter = CreateSignalFitter(job);
+        std::vector<float> fittedValues(numberOfValues);
+        const float nan = std::numeric_limits<float>::quiet_NaN();
+
+        for(unsigned long chunk = nextChunk++; chunk < numberOfChunks; chunk = nextChunk++){
+          const unsigned long chunkEnd = std::min<unsigned long>((chunk+1)*MaskedVoxelChunkSize, numberOfSignals);
+          for(unsigned long n = chunk*MaskedVoxelChunkSize; n < chunkEnd; n++){
+            const float *signal = signals+n*numberOfValues;
+            float *signalParameters = parameters+n*model.numberOfMaps;
+            float *signalErrors = errors ? errors+n*NumberOfErrorMeasures : nullptr;
+
+            if(signal[0])
+              FitAllModels(job, fitter, signal[0], signal, nullptr, statistics);
+            if(!signal[0] || !fitter.positions[0].size()){
+              std::fill(signalParameters, signalParameters+model.numberOfMaps, nan);
+              if(signalErrors)
+                std::fill(signalErrors, signalErrors+NumberOfErrorMeasures, nan);
+              continue;
+            }
+
+            GetParameterMapValues(model.modelType, fitter.positions[0], signalParameters);
+            if(!signalErrors)
+              continue;
+
+            for(int i=0;i<numberOfValues;i++)
+              fittedValues[i] = fitter.fitters[0].costFunction->GetFittedValue(fitter.positions[0], bValues[i]);
+            double signalErrorValues[NumberOfErrorMeasures];
+            ComputeErrorMeasures(signal, &fittedValues[0], numberOfValues,
+                                 signal, &fittedValues[0], numberOfValues,
+                                 model.numberOfMaps, fitter.SSerr[0], signalErrorValues);
+            for(unsigned i=0;i<NumberOfErrorMeasures;i++)
+              signalErrors[i] = signalErrorValues[i];
+          }
+        }
+      },
+      nullptr);
+  } catch(itk::ExceptionObject &e) {
+    DWModelingFitterLastError = e.GetDescription();
+    return -1;
+  } catch(std::exception &e) {
+    DWModelingFitterLastError = e.what();
+    return -1;
+  }
+  return 0;
+}
+
+}
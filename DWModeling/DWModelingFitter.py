@@ -0,0 +1,150 @@
+"""Python binding of the DWModelingFitter library, which fits the diffusion
+decay models of the DWModeling CLI to signals held in NumPy arrays.
+
+Example (in the Slicer Python console)::
+
+  import DWModelingFitter
+  parameters, errors = DWModelingFitter.fit(signals, bValues, 'MonoExponential')
+  adc = parameters[:,1]
+
+The signals are fitted in native code on all cores, with the GIL released,
+and the results are written directly into the returned arrays.
+"""
+
+import ctypes
+import ctypes.util
+import os
+
+import numpy as np
+
+Models = ['MonoExponential', 'BiExponential', 'Kurtosis', 'StretchedExponential', 'Gamma']
+FitMethods = ['LM', 'LogLinear', 'LogLinearThenLM', 'Dictionary', 'DictionaryThenLM']
+ErrorMeasures = ['RSquared', 'SSDFitted', 'SSD', 'ChiSquaredFitted', 'ChiSquared']
+
+_library = None
+
+
+def _libraryCandidates():
+  """Paths where the library is looked up: DWMODELING_FITTER_LIBRARY, the
+  directory of the DWModeling CLI when running in Slicer, this directory,
+  and the library search path.
+  """
+  if os.name == 'nt':
+    fileName = 'DWModelingFitter.dll'
+  elif os.uname()[0] == 'Darwin':
+    fileName = 'libDWModelingFitter.dylib'
+  else:
+    fileName = 'libDWModelingFitter.so'
+
+  candidates = []
+  if os.environ.get('DWMODELING_FITTER_LIBRARY'):
+    candidates.append(os.environ['DWMODELING_FITTER_LIBRARY'])
+  try:
+    import slicer
+    cliDirectory = os.path.dirname(slicer.modules.dwmodeling.path)
+    candidates.append(os.path.join(cliDirectory, fileName))
+    candidates.append(os.path.join(os.path.dirname(cliDirectory), fileName))
+  except (ImportError, AttributeError):
+    pass
+  candidates.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), fileName))
+  systemLibrary = ctypes.util.find_library('DWModelingFitter')
+  if systemLibrary:
+    candidates.append(systemLibrary)
+  return candidates
+
+
+def getLibrary():
+  """Load the DWModelingFitter library and declare its functions."""
+  global _library
+  if _library is not None:
+    return _library
+
+  candidates = _libraryCandidates()
+  for candidate in candidates:
+    if os.path.isabs(candidate) and not os.path.exists(candidate):
+      continue
+    try:
+      library = ctypes.CDLL(candidate)
+      break
+    except OSError:
+      continue
+  else:
+    raise OSError('DWModelingFitter library not found, tried: '+', '.join(candidates))
+
+  library.DWModelingFitterGetLastError.restype = ctypes.c_char_p
+  library.DWModelingFitterGetLastError.argtypes = []
+  library.DWModelingFitterGetNumberOfParameters.restype = ctypes.c_int
+  library.DWModelingFitterGetNumberOfParameters.argtypes = [ctypes.c_char_p]
+  library.DWModelingFitterGetParameterName.restype = ctypes.c_char_p
+  library.DWModelingFitterGetParameterName.argtypes = [ctypes.c_char_p, ctypes.c_int]
+  library.DWModelingFitterGetNumberOfErrorMeasures.restype = ctypes.c_int
+  library.DWModelingFitterGetNumberOfErrorMeasures.argtypes = []
+  floatPointer = np.ctypeslib.ndpointer(dtype=np.float32, flags='C_CONTIGUOUS')
+  library.DWModelingFitterFitSignals.restype = ctypes.c_int
+  library.DWModelingFitterFitSignals.argtypes = [floatPointer, ctypes.c_ulong, ctypes.c_int, floatPointer,
+                                                 ctypes.c_char_p, ctypes.c_char_p,
+                                                 ctypes.POINTER(ctypes.c_double), ctypes.c_int, ctypes.c_int,
+                                                 floatPointer, ctypes.c_void_p]
+  _library = library
+  return library
+
+
+def getParameterNames(model):
+  """Names of the parameters returned by fit() for the model, the first
+  being the signal scale.
+  """
+  library = getLibrary()
+  numberOfParameters = library.DWModelingFitterGetNumberOfParameters(model.encode())
+  if not numberOfParameters:
+    raise ValueError(library.DWModelingFitterGetLastError().decode())
+  return [library.DWModelingFitterGetParameterName(model.encode(), i).decode() for i in range(numberOfParameters)]
+
+
+def fit(signals, bValues, model='MonoExponential', fitMethod='LM', initialParameters=None,
+        dictionaryResolution=40, numberOfThreads=0, computeErrors=True):
+  """Fit the model to every row of signals.
+
+  signals is an (N, nb) array with the signal for each of the nb b-values;
+  float32 C-contiguous arrays are used without a copy. initialParameters
+  replaces the initial values of the parameters other than the scale, in
+  the units of the model (e.g., mm^2/s for the ADC). The fit methods are
+  those of the CLI.
+
+  Returns the (N, p) parameters, in the order given by getParameterNames()
+  and with diffusion coefficients scaled by 1e6 as in the CLI maps, and the
+  (N, 5) error measures in the order of ErrorMeasures (None if computeErrors
+  is False). Rows of signals that are zero at the first b-value or could not
+  be fitted are NaN.
+  """
+  library = getLibrary()
+  signals = np.ascontiguousarray(signals, dtype=np.float32)
+  bValues = np.ascontiguousarray(bValues, dtype=np.float32)
+  if signals.ndim != 2 or signals.shape[1] != bValues.size:
+    raise ValueError('signals should be an (N, %d) array, got %s' % (bValues.size, signals.shape))
+
+  numberOfParameters = library.DWModelingFitterGetNumberOfParameters(model.encode())
+  if not numberOfParameters:
+    raise ValueError(library.DWModelingFitterGetLastError().decode())
+
+  parameters = np.empty((signals.shape[0], numberOfParameters), dtype=np.float32)
+  errors = None
+  if computeErrors:
+    errors = np.empty((signals.shape[0], library.DWModelingFitterGetNumberOfErrorMeasures()), dtype=np.float32)
+
+  initialValues = None
+  if initialParameters is not None:
+    # the Gamma model returns the mode in addition to its parameters
+    numberOfModelParameters = numberOfParameters-1 if model == 'Gamma' else numberOfParameters
+    initialParameters = [0.]+list(initialParameters)
+    if len(initialParameters) != numberOfModelParameters:
+      raise ValueError('%d initial parameters expected for the %s model' % (numberOfModelParameters-1, model))
+    initialValues = (ctypes.c_double*len(initialParameters))(*initialParameters)
+
+  # ctypes releases the GIL for the duration of the call
+  status = library.DWModelingFitterFitSignals(signals, signals.shape[0], signals.shape[1], bValues,
+                                              model.encode(), fitMethod.encode(), initialValues,
+                                              dictionaryResolution, numberOfThreads, parameters,
+                                              errors.ctypes.data if errors is not None else None)
+  if status:
+    raise ValueError(library.DWModelingFitterGetLastError().decode())
+  return parameters, errors
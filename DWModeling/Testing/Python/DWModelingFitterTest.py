@@ -0,0 +1,116 @@
+"""Tests of the DWModelingFitter library through its Python binding.
+
+The library is looked up as by DWModelingFitter.getLibrary(); ctest sets
+DWMODELING_FITTER_LIBRARY to the built library. The tests are skipped if
+the library is not found.
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import DWModelingFitter
+
+BValues = np.array([0, 25, 50, 100, 200, 400, 600, 800, 1000, 1400], dtype=np.float32)
+
+
+def monoExponential(scale, adc):
+  return scale*np.exp(-BValues*adc)
+
+
+def biExponential(scale, fraction, slowDiffusion, fastDiffusion):
+  return scale*((1-fraction)*np.exp(-BValues*slowDiffusion)+fraction*np.exp(-BValues*fastDiffusion))
+
+
+class DWModelingFitterTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    try:
+      DWModelingFitter.getLibrary()
+    except OSError as e:
+      raise unittest.SkipTest(str(e))
+
+  def test_ParameterNames(self):
+    self.assertEqual(DWModelingFitter.getParameterNames('MonoExponential'), ['Scale', 'ADC'])
+    self.assertEqual(DWModelingFitter.getParameterNames('BiExponential'),
+                     ['Scale', 'FastDiffusionFraction', 'SlowDiffusion', 'FastDiffusion'])
+    # the mode is returned in addition to the Gamma parameters
+    self.assertEqual(len(DWModelingFitter.getParameterNames('Gamma')), 4)
+
+  def test_MonoExponential(self):
+    adcs = [0.0005, 0.001, 0.0015, 0.0025]
+    signals = np.array([monoExponential(1000., adc) for adc in adcs])
+    for fitMethod in ['LM', 'LogLinear']:
+      parameters, errors = DWModelingFitter.fit(signals, BValues, 'MonoExponential', fitMethod)
+      self.assertEqual(parameters.shape, (len(adcs), 2))
+      self.assertEqual(errors.shape, (len(adcs), len(DWModelingFitter.ErrorMeasures)))
+      # diffusion coefficients are scaled by 1e6, as in the CLI maps
+      np.testing.assert_allclose(parameters[:,0], 1000., rtol=1e-3)
+      np.testing.assert_allclose(parameters[:,1], np.array(adcs)*1e6, rtol=1e-3)
+      np.testing.assert_allclose(errors[:,DWModelingFitter.ErrorMeasures.index('RSquared')], 1., atol=1e-4)
+
+  def test_BiExponential(self):
+    signals = np.array([biExponential(1000., 0.3, 0.0008, 0.01),
+                        biExponential(500., 0.2, 0.0012, 0.02)])
+    parameters, errors = DWModelingFitter.fit(signals, BValues, 'BiExponential', computeErrors=False)
+    self.assertIsNone(errors)
+    np.testing.assert_allclose(parameters, [[1000., 0.3, 800., 10000.],
+                                            [500., 0.2, 1200., 20000.]], rtol=0.05)
+
+  def test_ZeroSignal(self):
+    signals = np.array([monoExponential(1000., 0.001),
+                        np.zeros(BValues.size),
+                        monoExponential(1000., 0.001)])
+    signals[2,0] = 0.
+    parameters, errors = DWModelingFitter.fit(signals, BValues, 'MonoExponential')
+    self.assertTrue(np.all(np.isfinite(parameters[0])))
+    self.assertTrue(np.all(np.isfinite(errors[0])))
+    # signals that are zero at the first b-value are not fitted
+    for row in [1, 2]:
+      self.assertTrue(np.all(np.isnan(parameters[row])))
+      self.assertTrue(np.all(np.isnan(errors[row])))
+
+  def test_NumberOfThreads(self):
+    # noisy signals, so that the fits take different numbers of iterations,
+    # in enough chunks to be distributed over the threads
+    random = np.random.RandomState(0)
+    adcs = random.uniform(0.0003, 0.003, 1000)
+    signals = np.array([monoExponential(1000., adc) for adc in adcs])
+    signals += random.normal(0., 10., signals.shape)
+    signals[::17,0] = 0.
+
+    reference = DWModelingFitter.fit(signals, BValues, 'BiExponential', numberOfThreads=1)
+    for numberOfThreads in [2, 7]:
+      results = DWModelingFitter.fit(signals, BValues, 'BiExponential', numberOfThreads=numberOfThreads)
+      for result, expected in zip(results, reference):
+        # bit-identical, NaN included
+        self.assertEqual(result.tobytes(), expected.tobytes())
+
+  def test_InitialParameters(self):
+    signals = np.array([monoExponential(1000., 0.001)])
+    parameters, errors = DWModelingFitter.fit(signals, BValues, 'MonoExponential', initialParameters=[0.002])
+    np.testing.assert_allclose(parameters[0,1], 1000., rtol=1e-3)
+    with self.assertRaises(ValueError):
+      DWModelingFitter.fit(signals, BValues, 'MonoExponential', initialParameters=[0.002, 1.])
+
+  def test_InvalidArguments(self):
+    signals = np.array([monoExponential(1000., 0.001)])
+    with self.assertRaises(ValueError):
+      DWModelingFitter.fit(signals, BValues, 'TriExponential')
+    with self.assertRaises(ValueError):
+      DWModelingFitter.getParameterNames('TriExponential')
+    with self.assertRaises(ValueError):
+      DWModelingFitter.fit(signals, BValues, 'MonoExponential', 'Simplex')
+    # log-linear fitting is not available for the BiExponential model
+    with self.assertRaises(ValueError):
+      DWModelingFitter.fit(signals, BValues, 'BiExponential', 'LogLinear')
+    with self.assertRaises(ValueError):
+      DWModelingFitter.fit(signals[:,:-1], BValues, 'MonoExponential')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,68 @@
+"""Tests that the maps of the DWModeling CLI do not depend on the number of
+threads used to fit the voxels.
+
+ctest sets DWMODELING_CLI to the built CLI, which is run on the bundled
+sampled phantom. The tests are skipped if the CLI is not given.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+PhantomFileName = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Data',
+                               'SampledPhantoms', '00943_SER18', 'Input', '00943_SER18.nrrd')
+
+# parameter map option of each model
+ModelOutputs = {
+  'MonoExponential': '--adcMonoExpDiff',
+  'BiExponential': '--slowDiff',
+  'Kurtosis': '--kurtosis',
+  }
+
+
+class DWModelingThreadsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cli = os.environ.get('DWMODELING_CLI')
+    if not self.cli:
+      raise unittest.SkipTest('DWMODELING_CLI is not set')
+    self.directory = tempfile.mkdtemp(prefix='DWModelingThreadsTest-')
+    self.addCleanup(shutil.rmtree, self.directory, True)
+
+  def runCLI(self, model, numberOfThreads, options=()):
+    """Fit the phantom and return the contents of the output files."""
+    outputs = [(ModelOutputs[model], 'map.nrrd'), ('--rsqrVolume', 'rsqr.nrrd'),
+               ('--fitStatus', 'status.nrrd')]
+    prefix = os.path.join(self.directory, '%s-%d-' % (model, numberOfThreads))
+    command = [self.cli, '--model', model, '--threads', str(numberOfThreads),
+               '--outputCompression', 'None']+list(options)
+    for option, fileName in outputs:
+      command += [option, prefix+fileName]
+    subprocess.check_call(command+[PhantomFileName])
+
+    contents = []
+    for option, fileName in outputs:
+      with open(prefix+fileName, 'rb') as f:
+        contents.append(f.read())
+    return contents
+
+  def checkNumberOfThreads(self, model, options=()):
+    reference = self.runCLI(model, 1, options)
+    for numberOfThreads in [2, 5]:
+      # the outputs are written uncompressed, so equal maps give equal files
+      self.assertEqual(self.runCLI(model, numberOfThreads, options), reference)
+
+  def test_MonoExponential(self):
+    self.checkNumberOfThreads('MonoExponential')
+
+  def test_BiExponential(self):
+    self.checkNumberOfThreads('BiExponential')
+
+  def test_KurtosisNeighbourInitialization(self):
+    self.checkNumberOfThreads('Kurtosis', ['--initialization', 'Neighbour'])
+
+
+if __name__ == '__main__':
+  unittest.main()
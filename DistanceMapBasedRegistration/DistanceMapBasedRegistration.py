@@ -1,8 +1,14 @@
 import os
+import sys
+import contextlib
+import hashlib
+import json
 import unittest
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import threading
+import time
 
 import SimpleITK as sitk
 import sitkUtils
@@ -52,7 +58,8 @@ class DistanceMapBasedRegistrationWidget(ScriptedLoadableModuleWidget):
     #
     # Parameters Area
     #
-    parametersCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.parametersCollapsibleButton = ctk.ctkCollapsibleButton()
+    parametersCollapsibleButton = self.parametersCollapsibleButton
     parametersCollapsibleButton.text = "Parameters"
     self.layout.addWidget(parametersCollapsibleButton)
 
@@ -179,6 +186,58 @@ class DistanceMapBasedRegistrationWidget(ScriptedLoadableModuleWidget):
     # command line
     #
 
+    #
+    # Debugging: keep the intermediate volumes of the label preprocessing
+    #
+    self.keepIntermediateVolumesCheckBox = qt.QCheckBox()
+    self.keepIntermediateVolumesCheckBox.checked = False
+    self.keepIntermediateVolumesCheckBox.setToolTip( "Add the cropped and smoothed labels to the scene (for debugging)" )
+    parametersFormLayout.addRow("Keep intermediate volumes: ", self.keepIntermediateVolumesCheckBox)
+
+    #
+    # Process the fixed and moving labels at the same time
+    #
+    self.concurrentBranchesCheckBox = qt.QCheckBox()
+    self.concurrentBranchesCheckBox.checked = True
+    self.concurrentBranchesCheckBox.setToolTip( "Preprocess and mesh the fixed and moving labels concurrently" )
+    parametersFormLayout.addRow("Concurrent processing: ", self.concurrentBranchesCheckBox)
+
+    #
+    # Reuse distance maps and surfaces computed for the same labels
+    #
+    self.useCacheCheckBox = qt.QCheckBox()
+    self.useCacheCheckBox.checked = True
+    self.useCacheCheckBox.setToolTip( "Reuse the distance maps and surfaces computed earlier for the same labels" )
+    parametersFormLayout.addRow("Use cache: ", self.useCacheCheckBox)
+
+    #
+    # Register from coarse to fine levels of the distance maps
+    #
+    self.multiResolutionCheckBox = qt.QCheckBox()
+    self.multiResolutionCheckBox.checked = False
+    self.multiResolutionCheckBox.setToolTip( "Run the affine and BSpline registration from coarse to fine resolution" )
+    parametersFormLayout.addRow("Multi-resolution registration: ", self.multiResolutionCheckBox)
+
+    #
+    # Restrict the distance maps and sampling to a band around the surface
+    #
+    self.narrowBandWidthSpinBox = qt.QDoubleSpinBox()
+    self.narrowBandWidthSpinBox.minimum = 0
+    self.narrowBandWidthSpinBox.maximum = 100
+    self.narrowBandWidthSpinBox.value = 0
+    self.narrowBandWidthSpinBox.suffix = ' mm'
+    self.narrowBandWidthSpinBox.specialValueText = 'Off'
+    self.narrowBandWidthSpinBox.setToolTip( "Clip the distance maps at this distance from the label surface, and sample only within this band" )
+    parametersFormLayout.addRow("Narrow band width: ", self.narrowBandWidthSpinBox)
+
+    #
+    # Show the deformable registration result through a precomputed grid
+    #
+    self.displacementGridCheckBox = qt.QCheckBox()
+    self.displacementGridCheckBox.checked = False
+    self.displacementGridCheckBox.setToolTip( "Sample the BSpline transform once on a grid around the fixed label and use it, and a precomputed deformed surface, to show the deformable registration result" )
+    parametersFormLayout.addRow("Precompute displacement grid: ", self.displacementGridCheckBox)
+
     self.registrationModeGroup = qt.QButtonGroup()
     self.noRegistrationRadio = qt.QRadioButton('Before registration')
     self.linearRegistrationRadio = qt.QRadioButton('After linear registration')
@@ -246,13 +305,27 @@ class DistanceMapBasedRegistrationWidget(ScriptedLoadableModuleWidget):
       self.parameterNode.SetAttribute('AffineTransformNodeID', self.affineTransformSelector.currentNode().GetID())
     if self.bsplineTransformSelector.currentNode():
       self.parameterNode.SetAttribute('BSplineTransformNodeID', self.bsplineTransformSelector.currentNode().GetID())
-    logic.run(self.parameterNode)
-
-    # resample moving volume
-    # logic.resample(self.parameterNode)
-
-    # configure the GUI
-    logic.showResults(self.parameterNode)
+    self.parameterNode.SetAttribute('KeepIntermediateVolumes', str(self.keepIntermediateVolumesCheckBox.checked))
+    self.parameterNode.SetAttribute('ConcurrentBranches', str(self.concurrentBranchesCheckBox.checked))
+    self.parameterNode.SetAttribute('UseCache', str(self.useCacheCheckBox.checked))
+    self.parameterNode.SetAttribute('RegistrationMode', 'MultiResolution' if self.multiResolutionCheckBox.checked else 'SingleResolution')
+    self.parameterNode.SetAttribute('NarrowBandWidth', str(self.narrowBandWidthSpinBox.value))
+    self.parameterNode.SetAttribute('DisplacementGrid', str(self.displacementGridCheckBox.checked))
+
+    # the GUI is kept responsive while the processing runs, so prevent
+    # starting another run or changing the inputs and the visualization of
+    # the nodes being processed in the meantime
+    self.parametersCollapsibleButton.enabled = False
+    try:
+      logic.run(self.parameterNode)
+
+      # resample moving volume
+      # logic.resample(self.parameterNode)
+
+      # configure the GUI
+      logic.showResults(self.parameterNode)
+    finally:
+      self.parametersCollapsibleButton.enabled = True
     self.noRegistrationRadio.checked = 1
     self.onVisualizationModeClicked(1)
 
@@ -272,6 +345,18 @@ class DistanceMapBasedRegistrationWidget(ScriptedLoadableModuleWidget):
     affineDisplayNode = affineTransform.GetDisplayNode()
     bsplineDisplayNode = bsplineTransform.GetDisplayNode()
 
+    # precomputed displacement grid and deformed surface, if any
+    gridTransform = None
+    deformedSurface = None
+    if self.parameterNode.GetAttribute('DisplacementGridTransformID'):
+      gridTransform = slicer.mrmlScene.GetNodeByID(self.parameterNode.GetAttribute('DisplacementGridTransformID'))
+      deformedSurface = slicer.mrmlScene.GetNodeByID(self.parameterNode.GetAttribute('MovingLabelSurfaceDeformedID'))
+    # set the moving surface visibility in all modes, since it may have been
+    # hidden by a grid that was cleared since
+    movingSurface.GetDisplayNode().SetVisibility(not (deformedSurface and mode == 3))
+    if deformedSurface:
+      deformedSurface.GetDisplayNode().SetVisibility(mode == 3)
+
     if mode == 1:
       movingVolume.SetAndObserveTransformNodeID('')
       movingSurface.SetAndObserveTransformNodeID('')
@@ -283,7 +368,13 @@ class DistanceMapBasedRegistrationWidget(ScriptedLoadableModuleWidget):
       affineDisplayNode.SetSliceIntersectionVisibility(1)
       bsplineDisplayNode.SetSliceIntersectionVisibility(0)
       affineDisplayNode.SetVisualizationMode(1)
-    if mode == 3:
+    if mode == 3 and gridTransform:
+      movingVolume.SetAndObserveTransformNodeID(gridTransform.GetID())
+      movingSurface.SetAndObserveTransformNodeID('')
+      affineDisplayNode.SetSliceIntersectionVisibility(0)
+      bsplineDisplayNode.SetSliceIntersectionVisibility(1)
+      bsplineDisplayNode.SetVisualizationMode(1)
+    elif mode == 3:
       movingVolume.SetAndObserveTransformNodeID(bsplineTransform.GetID())
       movingSurface.SetAndObserveTransformNodeID(bsplineTransform.GetID())
       affineDisplayNode.SetSliceIntersectionVisibility(0)
@@ -305,6 +396,13 @@ class DistanceMapBasedRegistrationLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    # smoothed labels of the last run, by label node ID; they are added to
+    # the scene only when needed for making the surface models
+    self.smoothedLabelImages = {}
+    self.profiler = StageProfiler()
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -353,43 +451,290 @@ class DistanceMapBasedRegistrationLogic(ScriptedLoadableModuleLogic):
     import SimpleITK as sitk
     import sitkUtils
 
-    (bbMin,bbMax) = self.getBoundingBox(fixedLabelNodeID, movingLabelNodeID)
+    self.profiler = StageProfiler()
 
-    logging.info("Before preprocessing")
+    # the labels are read once, as views of the scene arrays, and only the
+    # bounding box region is copied for the preprocessing
+    fixedLabelArray = slicer.util.arrayFromVolume(slicer.util.getNode(fixedLabelNodeID))
+    movingLabelArray = slicer.util.arrayFromVolume(slicer.util.getNode(movingLabelNodeID))
+    with self.profiler.stage('Bounding box', voxels=int(fixedLabelArray.size+movingLabelArray.size)):
+      (bbMin,bbMax) = self.getBoundingBox(fixedLabelArray, movingLabelArray)
 
-    fixedLabelDistanceMap = self.preProcessLabel(fixedLabelNodeID, bbMin, bbMax)
-    parameterNode.SetAttribute('FixedLabelDistanceMapID',fixedLabelDistanceMap.GetID())
-    fixedLabelSmoothed = slicer.util.getNode(slicer.mrmlScene.GetNodeByID(fixedLabelNodeID).GetName()+'-Smoothed')
-    parameterNode.SetAttribute('FixedLabelSmoothedID',fixedLabelSmoothed.GetID())
-
-    logging.info('Fixed label processing done')
+    logging.info("Before preprocessing")
 
-    movingLabelDistanceMap = self.preProcessLabel(movingLabelNodeID, bbMin, bbMax)
-    parameterNode.SetAttribute('MovingLabelDistanceMapID',movingLabelDistanceMap.GetID())
-    movingLabelSmoothed = slicer.util.getNode(slicer.mrmlScene.GetNodeByID(movingLabelNodeID).GetName()+'-Smoothed')
-    parameterNode.SetAttribute('MovingLabelSmoothedID',movingLabelSmoothed.GetID())
-    logging.info('Moving label processing done')
+    # the labels are preprocessed in memory, unless the SegmentationSmoothing
+    # CLI is requested
+    useCLI = parameterNode.GetAttribute('PreprocessingMode') == 'CLI'
+    keepIntermediateVolumes = parameterNode.GetAttribute('KeepIntermediateVolumes') == 'True'
+    # the fixed and moving branches are independent, so they run at the same
+    # time unless disabled
+    concurrent = parameterNode.GetAttribute('ConcurrentBranches') != 'False'
+
+    roles = [('Fixed',fixedLabelNodeID), ('Moving',movingLabelNodeID)]
+    labelImages = []
+    for (role,labelNodeID),labelArray in zip(roles,[fixedLabelArray,movingLabelArray]):
+      with self.profiler.stage('Crop', role=role, voxels=int(labelArray.size)) as details:
+        labelImages.append(self.getCroppedLabelImage(slicer.util.getNode(labelNodeID), labelArray, bbMin, bbMax))
+        details['outputSize'] = list(labelImages[-1].GetSize())
+
+    # reuse the distance maps computed earlier for the same labels
+    cache = self.getCache(parameterNode)
+    pending = []
+    for (role,labelNodeID),labelImage in zip(roles,labelImages):
+      cacheKey = cache.getLabelKey(labelImage, 'CLI' if useCLI else 'InMemory') if cache else ''
+      parameterNode.SetAttribute(role+'LabelCacheKey',cacheKey)
+      with self.profiler.stage('Cache lookup', role=role) as details:
+        cached = cache.loadLabel(cacheKey) if cache else None
+        details['hit'] = bool(cached)
+      if cached:
+        logging.info(role+' label preprocessing found in the cache')
+        self.setPreprocessedLabel(parameterNode, role, labelNodeID, (None,)+cached, keepIntermediateVolumes)
+      else:
+        pending.append((role,labelNodeID,labelImage))
+
+    if useCLI:
+      smoothingParameters = [self.cropLabel(labelNodeID, labelImage) for role,labelNodeID,labelImage in pending]
+      self.runCLIs([(slicer.modules.segmentationsmoothing, parameters) for parameters in smoothingParameters],
+                   concurrent, 'Smoothing labels', ['Smoothing CLI ('+role+')' for role,labelNodeID,labelImage in pending])
+      for (role,labelNodeID,labelImage),parameters in zip(pending,smoothingParameters):
+        with self.profiler.stage('Distance map', role=role):
+          labelDistanceMap = self.computeDistanceMap(labelNodeID, parameters['outputImageName'])
+        parameterNode.SetAttribute(role+'LabelSmoothedID',parameters['outputImageName'])
+        parameterNode.SetAttribute(role+'LabelDistanceMapID',labelDistanceMap.GetID())
+        if cache:
+          cache.storeLabel(parameterNode.GetAttribute(role+'LabelCacheKey'),
+                           sitkUtils.PullVolumeFromSlicer(slicer.util.getNode(parameters['outputImageName'])),
+                           sitkUtils.PullVolumeFromSlicer(labelDistanceMap))
+    else:
+      preprocessedImages = self.runInWorkers(self.smoothLabelImage,
+                                             [(labelImage,) for role,labelNodeID,labelImage in pending],
+                                             concurrent, 'Preprocessing labels')
+      for (role,labelNodeID,labelImage),images in zip(pending,preprocessedImages):
+        self.setPreprocessedLabel(parameterNode, role, labelNodeID, images, keepIntermediateVolumes)
+        if cache:
+          cache.storeLabel(parameterNode.GetAttribute(role+'LabelCacheKey'), images[1], images[2])
+
+    logging.info('Label processing done')
+
+    fixedLabelDistanceMap = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('FixedLabelDistanceMapID'))
+    movingLabelDistanceMap = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('MovingLabelDistanceMapID'))
+
+    # only the distances near the label surface are useful for the alignment,
+    # so optionally clip the distance maps to a band around the surface and
+    # sample only within that band
+    narrowBandWidth = float(parameterNode.GetAttribute('NarrowBandWidth') or '0')
+    for role,labelDistanceMap in [('Fixed',fixedLabelDistanceMap), ('Moving',movingLabelDistanceMap)]:
+      narrowBandMask = None
+      if narrowBandWidth > 0:
+        with self.profiler.stage('Narrow band', role=role):
+          narrowBandMask = self.applyNarrowBand(labelDistanceMap, narrowBandWidth)
+      parameterNode.SetAttribute(role+'LabelNarrowBandID', narrowBandMask.GetID() if narrowBandMask else '')
 
     # run registration
 
-    registrationParameters = {'fixedVolume':fixedLabelDistanceMap.GetID(), 'movingVolume':movingLabelDistanceMap.GetID(),'useRigid':True,'useAffine':True,'numberOfSamples':'10000','costMetric':'MSE','outputTransform':affineTransformNode.GetID()}
-    slicer.cli.run(slicer.modules.brainsfit, None, registrationParameters, wait_for_completion=True)
+    numberOfSamples = parameterNode.GetAttribute('NumberOfSamples') or '10000'
+    splineGridSize = parameterNode.GetAttribute('SplineGridSize') or '3,3,3'
+    maskParameters = self.getNarrowBandParameters(parameterNode.GetAttribute('FixedLabelNarrowBandID'),
+                                                  parameterNode.GetAttribute('MovingLabelNarrowBandID'))
 
-    parameterNode.SetAttribute('AffineTransformNodeID',affineTransformNode.GetID())
+    if parameterNode.GetAttribute('RegistrationMode') == 'MultiResolution':
+      self.runMultiResolutionRegistration(parameterNode, fixedLabelDistanceMap, movingLabelDistanceMap,
+                                          affineTransformNode, bsplineTransformNode)
+    else:
+      registrationParameters = {'fixedVolume':fixedLabelDistanceMap.GetID(), 'movingVolume':movingLabelDistanceMap.GetID(),'useRigid':True,'useAffine':True,'numberOfSamples':numberOfSamples,'costMetric':'MSE','outputTransform':affineTransformNode.GetID()}
+      registrationParameters.update(maskParameters)
+      self.runCLIs([(slicer.modules.brainsfit, registrationParameters)], title='Affine registration', stages=['Affine registration'])
 
-    logging.info('affineRegistrationCompleted!')
+      logging.info('affineRegistrationCompleted!')
 
-    registrationParameters = {'fixedVolume':fixedLabelDistanceMap.GetID(), 'movingVolume':movingLabelDistanceMap.GetID(),'useBSpline':True,'splineGridSize':'3,3,3','numberOfSamples':'10000','costMetric':'MSE','bsplineTransform':bsplineTransformNode.GetID(),'initialTransform':affineTransformNode.GetID()}
-    slicer.cli.run(slicer.modules.brainsfit, None, registrationParameters, wait_for_completion=True)
+      registrationParameters = {'fixedVolume':fixedLabelDistanceMap.GetID(), 'movingVolume':movingLabelDistanceMap.GetID(),'useBSpline':True,'splineGridSize':splineGridSize,'numberOfSamples':numberOfSamples,'costMetric':'MSE','bsplineTransform':bsplineTransformNode.GetID(),'initialTransform':affineTransformNode.GetID()}
+      registrationParameters.update(maskParameters)
+      self.runCLIs([(slicer.modules.brainsfit, registrationParameters)], title='Deformable registration', stages=['BSpline registration'])
 
-    parameterNode.SetAttribute('BSplineTransformNodeID',bsplineTransformNode.GetID())
+      logging.info('bsplineRegistrationCompleted!')
 
-    logging.info('bsplineRegistrationCompleted!')
+    parameterNode.SetAttribute('AffineTransformNodeID',affineTransformNode.GetID())
+    parameterNode.SetAttribute('BSplineTransformNodeID',bsplineTransformNode.GetID())
 
     logging.info('Processing completed')
+    self.saveProfile(parameterNode)
 
     return True
 
+  def runMultiResolutionRegistration(self,parameterNode,fixedLabelDistanceMap,movingLabelDistanceMap,
+                                     affineTransformNode,bsplineTransformNode):
+    """Run the affine and then the BSpline registration from coarse to fine
+    levels of a pyramid of the distance maps, each level initialized with the
+    result of the previous one. The pyramid and the registration are set by
+    the parameter node attributes:
+     * ShrinkFactors: shrink factor of each level, from coarse to fine
+       (default 4,2,1), for the axis with the finest spacing (see
+       getAxisShrinkFactors)
+     * SampleSchedule: number of samples of each level (default
+       NumberOfSamples scaled by the number of voxels of the level)
+     * SplineGridSize: BSpline grid size (default 3,3,3)
+     * EarlyStopTolerance: a stage stops when the MSE improves by less than
+       this fraction from one level to the next (default 0.01); if the MSE
+       gets worse, the result of the previous level is kept
+    The MSE of the distance maps after each stage is stored in the AffineMSE
+    and BSplineMSE attributes.
+    """
+
+    shrinkFactors = [int(f) for f in (parameterNode.GetAttribute('ShrinkFactors') or '4,2,1').split(',')]
+    numberOfSamples = int(parameterNode.GetAttribute('NumberOfSamples') or '10000')
+    sampleSchedule = parameterNode.GetAttribute('SampleSchedule')
+    if sampleSchedule:
+      sampleSchedule = [int(n) for n in sampleSchedule.split(',')]
+      if len(sampleSchedule) != len(shrinkFactors):
+        raise ValueError('SampleSchedule must have one entry per level of ShrinkFactors')
+    splineGridSize = parameterNode.GetAttribute('SplineGridSize') or '3,3,3'
+    earlyStopTolerance = float(parameterNode.GetAttribute('EarlyStopTolerance') or '0.01')
+
+    fixedImage = sitkUtils.PullVolumeFromSlicer(fixedLabelDistanceMap)
+    movingImage = sitkUtils.PullVolumeFromSlicer(movingLabelDistanceMap)
+
+    axisShrinkFactors = [self.getAxisShrinkFactors(fixedImage,f) for f in shrinkFactors]
+    if not sampleSchedule:
+      # the coarse levels have fewer voxels to sample from
+      sampleSchedule = [max(1000,numberOfSamples//(factors[0]*factors[1]*factors[2])) for factors in axisShrinkFactors]
+
+    narrowBandWidth = float(parameterNode.GetAttribute('NarrowBandWidth') or '0')
+
+    # distance maps (and narrow band masks) of the pyramid levels; the finest
+    # level is usually the full resolution distance map
+    levelNodes = []
+    for level,shrinkFactor in enumerate(shrinkFactors):
+      if shrinkFactor == 1:
+        levelNodes.append((fixedLabelDistanceMap,movingLabelDistanceMap,
+                           parameterNode.GetAttribute('FixedLabelNarrowBandID'),
+                           parameterNode.GetAttribute('MovingLabelNarrowBandID')))
+        continue
+      nodes = []
+      maskNodeIDs = []
+      for image,node in [(fixedImage,fixedLabelDistanceMap), (movingImage,movingLabelDistanceMap)]:
+        levelName = node.GetName()+'-Level'+str(level)
+        sitkUtils.PushVolumeToSlicer(sitk.BinShrink(image,self.getAxisShrinkFactors(image,shrinkFactor)), name=levelName)
+        nodes.append(slicer.util.getNode(levelName))
+        # the shrunk maps keep the distances in voxels of the full resolution map
+        maskNode = self.applyNarrowBand(nodes[-1], narrowBandWidth, min(image.GetSpacing())) if narrowBandWidth > 0 else None
+        maskNodeIDs.append(maskNode.GetID() if maskNode else '')
+      levelNodes.append(tuple(nodes+maskNodeIDs))
+
+    try:
+      stages = [('Affine', affineTransformNode, {'useRigid':True,'useAffine':True,'outputTransform':affineTransformNode.GetID()}),
+                ('BSpline', bsplineTransformNode, {'useBSpline':True,'splineGridSize':splineGridSize,'bsplineTransform':bsplineTransformNode.GetID()})]
+      initialTransformNode = None
+      for stage,transformNode,stageParameters in stages:
+        previousMSE = None
+        for level,(fixedLevelNode,movingLevelNode,fixedMaskID,movingMaskID) in enumerate(levelNodes):
+          registrationParameters = {'fixedVolume':fixedLevelNode.GetID(), 'movingVolume':movingLevelNode.GetID(),
+                                    'numberOfSamples':str(sampleSchedule[level]), 'costMetric':'MSE'}
+          registrationParameters.update(stageParameters)
+          registrationParameters.update(self.getNarrowBandParameters(fixedMaskID,movingMaskID))
+          if initialTransformNode:
+            registrationParameters['initialTransform'] = initialTransformNode.GetID()
+          self.runCLIs([(slicer.modules.brainsfit, registrationParameters)],
+                       title='%s registration (level %d of %d)' % (stage,level+1,len(levelNodes)),
+                       stages=['%s registration (level %d)' % (stage,level)])
+          # the next level refines the result of this one
+          initialTransformNode = transformNode
+
+          mse = self.computeMeanSquaredError(fixedImage, movingImage, transformNode)
+          logging.info('%s level %d: shrink factors %s, %d samples, MSE %g' % (stage,level,axisShrinkFactors[level],sampleSchedule[level],mse))
+          if previousMSE is not None and mse >= previousMSE:
+            # BRAINSFit wrote over the result of the previous level
+            transformNode.SetAndObserveTransformFromParent(previousTransform)
+            mse = previousMSE
+            logging.info(stage+' registration stopped early: the MSE got worse, the previous level is kept')
+            break
+          if previousMSE is not None and previousMSE-mse < earlyStopTolerance*previousMSE:
+            logging.info(stage+' registration stopped early: the MSE improvement stalled')
+            break
+          previousMSE = mse
+          previousTransform = self.copyTransform(transformNode)
+        parameterNode.SetAttribute(stage+'MSE', str(mse))
+        logging.info(stage+' registration completed')
+    finally:
+      for fixedLevelNode,movingLevelNode,fixedMaskID,movingMaskID in levelNodes:
+        if fixedLevelNode == fixedLabelDistanceMap:
+          continue
+        for node in [fixedLevelNode, movingLevelNode, slicer.mrmlScene.GetNodeByID(fixedMaskID), slicer.mrmlScene.GetNodeByID(movingMaskID)]:
+          if node:
+            slicer.mrmlScene.RemoveNode(node)
+
+  def getAxisShrinkFactors(self,image,shrinkFactor):
+    """Shrink factors of the axes of the image for a pyramid level. The
+    shrink factor applies to the axis with the finest spacing, and the other
+    axes are shrunk to the nearest spacing. Thick slices are thus kept until
+    the in-plane spacing has caught up with the slice spacing.
+    """
+    spacing = image.GetSpacing()
+    return [max(1,int(round(shrinkFactor*min(spacing)/axisSpacing))) for axisSpacing in spacing]
+
+  def copyTransform(self,transformNode):
+    """Deep copy of the transform of the node, which can be restored with
+    SetAndObserveTransformFromParent.
+    """
+    transform = transformNode.GetTransformFromParent()
+    copy = transform.MakeTransform()
+    copy.DeepCopy(transform)
+    return copy
+
+  def applyNarrowBand(self,distanceMapNode,width,voxelSpacing=None):
+    """Clip the distance map to the band closer than width (in mm) to the
+    surface in place, and return a new label node that masks this band.
+    The distances are in voxels of the isotropic smoothed label, of size
+    voxelSpacing (by default the spacing of the distance map itself; it
+    differs for the shrunk maps of the resolution levels).
+    """
+    distanceImage = sitkUtils.PullVolumeFromSlicer(distanceMapNode)
+    if voxelSpacing is None:
+      voxelSpacing = min(distanceImage.GetSpacing())
+    width = width/voxelSpacing
+    sitkUtils.PushVolumeToSlicer(sitk.Clamp(distanceImage, sitk.sitkFloat32, -width, width), targetNode=distanceMapNode)
+
+    # strictly within the band, so that the mask is the same when computed
+    # from a distance map that was already clipped
+    maskName = distanceMapNode.GetName()+'-NarrowBand'
+    maskImage = sitk.Cast(sitk.Abs(distanceImage) < width, sitk.sitkUInt8)
+    sitkUtils.PushVolumeToSlicer(maskImage, name=maskName, className='vtkMRMLLabelMapVolumeNode')
+    return slicer.util.getNode(maskName)
+
+  def getNarrowBandParameters(self,fixedMaskID,movingMaskID):
+    """BRAINSFit parameters that restrict the sampling to the narrow band
+    masks, if any.
+    """
+    if not fixedMaskID or not movingMaskID:
+      return {}
+    return {'maskProcessingMode':'ROI', 'fixedBinaryVolume':fixedMaskID, 'movingBinaryVolume':movingMaskID}
+
+  def computeMeanSquaredError(self,fixedImage,movingImage,transformNode):
+    """Mean squared difference of the fixed distance map and the moving
+    distance map resampled with the transform.
+    """
+    transformFileName = os.path.join(slicer.app.temporaryPath,'DistanceMapBasedRegistration-%d.h5' % os.getpid())
+    storageNode = transformNode.GetStorageNode()
+    storageFileName = storageNode.GetFileName() if storageNode else None
+    slicer.util.saveNode(transformNode,transformFileName)
+    if storageNode:
+      storageNode.SetFileName(storageFileName)
+    else:
+      # the storage node created by saveNode would point to the deleted file
+      createdStorageNode = transformNode.GetStorageNode()
+      if createdStorageNode:
+        transformNode.SetAndObserveStorageNodeID(None)
+        slicer.mrmlScene.RemoveNode(createdStorageNode)
+    try:
+      transform = sitk.ReadTransform(transformFileName)
+    finally:
+      os.remove(transformFileName)
+
+    resampledImage = sitk.Resample(movingImage, fixedImage, transform, sitk.sitkLinear, 0.0, sitk.sitkFloat32)
+    difference = sitk.Cast(fixedImage,sitk.sitkFloat32)-resampledImage
+    statistics = sitk.StatisticsImageFilter()
+    statistics.Execute(difference*difference)
+    return statistics.GetMean()
+
   def showResults(self,parameterNode):
     # duplicate moving volume
 
@@ -422,24 +767,47 @@ class DistanceMapBasedRegistrationLogic(ScriptedLoadableModuleLogic):
     movingImageCloneID = parameterNode.GetAttribute('MovingImageCloneID')
     if movingImageCloneID:
       slicer.mrmlScene.RemoveNode(slicer.mrmlScene.GetNodeByID(movingImageCloneID))
-    
-    movingImageClone = volumesLogic.CloneVolume(movingImageNode,'MovingImageCopy')
+
+    useDisplacementGrid = parameterNode.GetAttribute('DisplacementGrid') == 'True'
+    with self.profiler.stage('CloneVolume') as details:
+      if useDisplacementGrid:
+        movingImageClone = self.cloneVolumeReference(movingImageNode,'MovingImageCopy')
+      else:
+        movingImageClone = volumesLogic.CloneVolume(movingImageNode,'MovingImageCopy')
+      details['outputSize'] = list(movingImageClone.GetImageData().GetDimensions())
+      details['shared'] = useDisplacementGrid
     parameterNode.SetAttribute('MovingImageCloneID',movingImageClone.GetID())
 
-    lm = slicer.app.layoutManager()
-    lm.setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpView)
+    if useDisplacementGrid:
+      with self.profiler.stage('Displacement grid') as details:
+        details.update(self.computeDisplacementGrid(parameterNode))
+    else:
+      # a grid of an earlier run does not match the current transform
+      parameterNode.SetAttribute('DisplacementGridTransformID','')
+      if parameterNode.GetAttribute('MovingLabelSurfaceDeformedID'):
+        deformedSurface = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('MovingLabelSurfaceDeformedID'))
+        if deformedSurface:
+          deformedSurface.GetDisplayNode().SetVisibility(0)
+      # the moving surface was hidden if the grid was shown
+      movingModelDisplayNode.SetVisibility(1)
+
+    with self.profiler.stage('Layout setup'):
+      lm = slicer.app.layoutManager()
+      lm.setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpView)
+
+      sliceCompositeNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLSliceCompositeNode')
+      sliceCompositeNodes.SetReferenceCount(sliceCompositeNodes.GetReferenceCount()-1)
+
+      for i in range(sliceCompositeNodes.GetNumberOfItems()):
+        scn = sliceCompositeNodes.GetItemAsObject(i)
+        scn.SetForegroundVolumeID(fixedImageID)
+        scn.SetBackgroundVolumeID(movingImageID)
+        scn.SetLabelVolumeID('')
 
-    sliceCompositeNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLSliceCompositeNode')
-    sliceCompositeNodes.SetReferenceCount(sliceCompositeNodes.GetReferenceCount()-1)
+    # TODO: call the code to configure views based on the mode selected
 
-    for i in range(sliceCompositeNodes.GetNumberOfItems()):
-      scn = sliceCompositeNodes.GetItemAsObject(i)
-      scn.SetForegroundVolumeID(fixedImageID)
-      scn.SetBackgroundVolumeID(movingImageID)
-      scn.SetLabelVolumeID('')
+    self.saveProfile(parameterNode)
 
-    # TODO: call the code to configure views based on the mode selected
-    
     return
 
     # create surface model for the moving volume segmentation
@@ -447,13 +815,124 @@ class DistanceMapBasedRegistrationLogic(ScriptedLoadableModuleLogic):
     # (need to create another panel in the GUI for visualization)
     # enable transform visualization in-slice and 3d
 
+  def cloneVolumeReference(self,volumeNode,name):
+    """Add a volume node with the geometry of volumeNode that references its
+    image data instead of copying it, like a lazy CloneVolume.
+    """
+    clone = slicer.mrmlScene.CreateNodeByClass(volumeNode.GetClassName())
+    clone.UnRegister(None)
+    clone.SetName(slicer.mrmlScene.GenerateUniqueName(name))
+    slicer.mrmlScene.AddNode(clone)
+    clone.CopyOrientation(volumeNode)
+    clone.SetAndObserveImageData(volumeNode.GetImageData())
+    clone.CreateDefaultDisplayNodes()
+    sourceDisplayNode = volumeNode.GetDisplayNode()
+    if sourceDisplayNode and clone.GetDisplayNode() and hasattr(sourceDisplayNode,'GetWindow'):
+      clone.GetDisplayNode().SetAutoWindowLevel(sourceDisplayNode.GetAutoWindowLevel())
+      clone.GetDisplayNode().SetWindowLevel(sourceDisplayNode.GetWindow(),sourceDisplayNode.GetLevel())
+    return clone
+
+  def getLabelBoundsRAS(self,labelNode,margin):
+    """Return the RAS bounds (xmin,xmax,ymin,ymax,zmin,zmax) of the voxels of
+    the label, extended by margin (mm) on every side.
+    """
+    labelArray = slicer.util.arrayFromVolume(labelNode)
+    extents = [labelArray.any(axis=(0,1)), labelArray.any(axis=(0,2)), labelArray.any(axis=(1,2))]
+    ijkBounds = []
+    for extent in extents:
+      indices = extent.nonzero()[0]
+      if not len(indices):
+        raise ValueError('The label '+labelNode.GetName()+' is empty')
+      ijkBounds.append((int(indices[0]),int(indices[-1])))
+
+    ijkToRAS = vtk.vtkMatrix4x4()
+    labelNode.GetIJKToRASMatrix(ijkToRAS)
+    corners = [ijkToRAS.MultiplyPoint([float(i),float(j),float(k),1.])
+               for i in ijkBounds[0] for j in ijkBounds[1] for k in ijkBounds[2]]
+    bounds = []
+    for axis in range(3):
+      bounds += [min(corner[axis] for corner in corners)-margin, max(corner[axis] for corner in corners)+margin]
+    return bounds
+
+  def computeDisplacementGrid(self,parameterNode):
+    """Sample the BSpline transform on a grid covering the fixed label, and
+    deform the moving surface with it once. The grid transform, which is
+    interpolated instead of evaluating the BSpline at every point, is used to
+    show the moving volume after deformable registration, and the deformed
+    surface replaces the moving surface observing the BSpline transform.
+    The grid spacing (mm, default 2) and the margin around the label (mm,
+    default 10) are read from the DisplacementGridSpacing and
+    DisplacementGridMargin attributes. Returns the profile details.
+    """
+    bsplineTransform = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('BSplineTransformNodeID'))
+    fixedLabel = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('FixedLabelNodeID'))
+    spacing = float(parameterNode.GetAttribute('DisplacementGridSpacing') or 2.)
+    margin = float(parameterNode.GetAttribute('DisplacementGridMargin') or 10.)
+
+    # slice views resample the volume through the transform from parent,
+    # which is what the grid samples
+    bounds = self.getLabelBoundsRAS(fixedLabel,margin)
+    dimensions = [int((bounds[2*axis+1]-bounds[2*axis])/spacing)+2 for axis in range(3)]
+    toGrid = vtk.vtkTransformToGrid()
+    toGrid.SetInput(bsplineTransform.GetTransformFromParent())
+    toGrid.SetGridOrigin(bounds[0],bounds[2],bounds[4])
+    toGrid.SetGridSpacing(spacing,spacing,spacing)
+    toGrid.SetGridExtent(0,dimensions[0]-1,0,dimensions[1]-1,0,dimensions[2]-1)
+    toGrid.SetGridScalarTypeToFloat()
+    toGrid.Update()
+
+    gridTransform = slicer.vtkOrientedGridTransform()
+    gridTransform.SetDisplacementGridData(toGrid.GetOutput())
+    gridTransform.SetInterpolationModeToCubic()
+
+    gridTransformNode = None
+    if parameterNode.GetAttribute('DisplacementGridTransformID'):
+      gridTransformNode = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('DisplacementGridTransformID'))
+    if not gridTransformNode:
+      gridTransformNode = slicer.vtkMRMLGridTransformNode()
+      gridTransformNode.SetName(slicer.mrmlScene.GenerateUniqueName(bsplineTransform.GetName()+'-grid'))
+      slicer.mrmlScene.AddNode(gridTransformNode)
+    gridTransformNode.SetAndObserveTransformFromParent(gridTransform)
+    parameterNode.SetAttribute('DisplacementGridTransformID',gridTransformNode.GetID())
+
+    # the surface is deformed with the transform to parent, which for the
+    # BSpline computed as the resampling transform is an iterative inverse;
+    # it is evaluated here once rather than on every mode switch
+    movingSurface = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('MovingLabelSurfaceID'))
+    deformFilter = vtk.vtkTransformPolyDataFilter()
+    deformFilter.SetInputData(movingSurface.GetPolyData())
+    deformFilter.SetTransform(bsplineTransform.GetTransformToParent())
+    deformFilter.Update()
+
+    deformedSurface = None
+    if parameterNode.GetAttribute('MovingLabelSurfaceDeformedID'):
+      deformedSurface = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('MovingLabelSurfaceDeformedID'))
+    if not deformedSurface:
+      deformedSurface = slicer.vtkMRMLModelNode()
+      deformedSurface.SetName(movingSurface.GetName()+'-deformed')
+      slicer.mrmlScene.AddNode(deformedSurface)
+      deformedSurface.CreateDefaultDisplayNodes()
+      parameterNode.SetAttribute('MovingLabelSurfaceDeformedID',deformedSurface.GetID())
+    deformedSurface.SetAndObservePolyData(deformFilter.GetOutput())
+    displayNode = deformedSurface.GetDisplayNode()
+    displayNode.SetColor(movingSurface.GetDisplayNode().GetColor())
+    displayNode.SetSliceIntersectionVisibility(1)
+    displayNode.SetSliceIntersectionThickness(3)
+    displayNode.SetVisibility(0)
+
+    return {'gridSize': dimensions, 'gridSpacing': spacing,
+            'surfacePoints': deformedSurface.GetPolyData().GetNumberOfPoints()}
+
   def makeSurfaceModels(self,parameterNode):
     fixedLabel = slicer.util.getNode(parameterNode.GetAttribute('FixedLabelNodeID'))
     movingLabel = slicer.util.getNode(parameterNode.GetAttribute('MovingLabelNodeID'))
 
+    # the model is reused when Apply is clicked again, unless it was deleted
+    fixedModel = None
     fixedModelID = parameterNode.GetAttribute('FixedLabelSurfaceID')
     if fixedModelID:
-      fixedModel = slicer.util.getNode(fixedModelID)
+      fixedModel = slicer.mrmlScene.GetNodeByID(fixedModelID)
+    if fixedModel:
       logging.info('Reusing existing model: '+fixedModelID+' '+fixedModel.GetName())
     else:
       fixedModel = slicer.vtkMRMLModelNode()
@@ -462,75 +941,272 @@ class DistanceMapBasedRegistrationLogic(ScriptedLoadableModuleLogic):
       parameterNode.SetAttribute('FixedLabelSurfaceID',fixedModel.GetID())
       logging.info('Created a new model: '+fixedModel.GetID()+' '+fixedModel.GetName())
 
-    parameters = {'inputImageName':parameterNode.GetAttribute('FixedLabelSmoothedID'),'outputMeshName':fixedModel.GetID()}
-    slicer.cli.run(slicer.modules.quadedgesurfacemesher,None,parameters,wait_for_completion=True)
-    fixedModel.GetDisplayNode().SetColor(0.9,0.9,0)
+    fixedParameters = {'outputMeshName':fixedModel.GetID()}
 
+    movingModel = None
     movingModelID = parameterNode.GetAttribute('MovingLabelSurfaceID')
     if movingModelID:
-      movingModel = slicer.util.getNode(movingModelID)
-      logging.info('Reusing existing model: '+movingModelID+' '+movingModelID.GetName())
-    else:      
+      movingModel = slicer.mrmlScene.GetNodeByID(movingModelID)
+    if movingModel:
+      logging.info('Reusing existing model: '+movingModelID+' '+movingModel.GetName())
+    else:
       movingModel = slicer.vtkMRMLModelNode()
       slicer.mrmlScene.AddNode(movingModel)
       movingModel.SetName(movingLabel.GetName()+'-surface')
       parameterNode.SetAttribute('MovingLabelSurfaceID',movingModel.GetID())
       logging.info('Created a new model: '+movingModel.GetID()+' '+movingModel.GetName())
 
-    parameters = {'inputImageName':parameterNode.GetAttribute('MovingLabelSmoothedID'),'outputMeshName':movingModel.GetID()}
-    slicer.cli.run(slicer.modules.quadedgesurfacemesher,None,parameters,wait_for_completion=True)
+    movingParameters = {'outputMeshName':movingModel.GetID()}
+
+    # reuse the surfaces made earlier from the same labels
+    cache = self.getCache(parameterNode)
+    meshingRuns = []
+    for role,model,parameters in [('Fixed',fixedModel,fixedParameters), ('Moving',movingModel,movingParameters)]:
+      cacheKey = parameterNode.GetAttribute(role+'LabelCacheKey')
+      surface = cache.loadSurface(cacheKey) if cache and cacheKey else None
+      if surface:
+        logging.info(role+' label surface found in the cache')
+        model.SetAndObservePolyData(surface)
+        if not model.GetDisplayNode():
+          model.CreateDefaultDisplayNodes()
+      else:
+        parameters['inputImageName'] = self.getSmoothedLabelNodeID(parameterNode,role)
+        meshingRuns.append((role,model,parameters))
+
+    concurrent = parameterNode.GetAttribute('ConcurrentBranches') != 'False'
+    self.runCLIs([(slicer.modules.quadedgesurfacemesher, parameters) for role,model,parameters in meshingRuns],
+                 concurrent, 'Making surface models', ['Meshing ('+role+')' for role,model,parameters in meshingRuns])
+
+    for role,model,parameters in meshingRuns:
+      if model.GetPolyData():
+        self.profiler.getRecord('Meshing ('+role+')')['outputPoints'] = model.GetPolyData().GetNumberOfPoints()
+      cacheKey = parameterNode.GetAttribute(role+'LabelCacheKey')
+      if cache and cacheKey:
+        cache.storeSurface(cacheKey, model.GetPolyData())
+
+    fixedModel.GetDisplayNode().SetColor(0.9,0.9,0)
     movingModel.GetDisplayNode().SetColor(0,0.7,0.9)
 
     return
 
-  def getBoundingBox(self,fixedLabelNodeID,movingLabelNodeID):
-
-    ls = sitk.LabelStatisticsImageFilter()
-
-    fixedLabelNode = slicer.mrmlScene.GetNodeByID(fixedLabelNodeID)
-    movingLabelNode = slicer.mrmlScene.GetNodeByID(movingLabelNodeID)
-
-    fixedLabelAddress = sitkUtils.GetSlicerITKReadWriteAddress(fixedLabelNode.GetName())
-    movingLabelAddress = sitkUtils.GetSlicerITKReadWriteAddress(movingLabelNode.GetName())
+  def getCache(self,parameterNode):
+    """Return the cache of preprocessed labels and surfaces, or None if
+    caching is disabled.
+    """
+    if parameterNode.GetAttribute('UseCache') == 'False':
+      return None
+    cacheDirectory = parameterNode.GetAttribute('CacheDirectory')
+    if not cacheDirectory:
+      cacheDirectory = os.path.join(slicer.app.cachePath, 'DistanceMapBasedRegistration')
+    cacheSizeLimit = parameterNode.GetAttribute('CacheSizeLimit')
+    cacheSizeLimit = float(cacheSizeLimit) if cacheSizeLimit else DistanceMapCache.DefaultSizeLimit
+    return DistanceMapCache(cacheDirectory, cacheSizeLimit)
+
+  def setPreprocessedLabel(self,parameterNode,role,labelNodeID,images,keepIntermediateVolumes):
+    labelDistanceMap = self.pushPreprocessedLabel(labelNodeID, images, keepIntermediateVolumes)
+    labelSmoothed = slicer.mrmlScene.GetFirstNodeByName(slicer.mrmlScene.GetNodeByID(labelNodeID).GetName()+'-Smoothed') if keepIntermediateVolumes else None
+    # the smoothed label node is created on demand by makeSurfaceModels
+    parameterNode.SetAttribute(role+'LabelSmoothedID',labelSmoothed.GetID() if labelSmoothed else '')
+    parameterNode.SetAttribute(role+'LabelDistanceMapID',labelDistanceMap.GetID())
+
+  def runCLIs(self,cliRuns,concurrent=True,title='Processing',stages=None):
+    """Run the CLI modules given as (module, parameters) pairs without
+    blocking the GUI. If concurrent is set all of them are started at once,
+    otherwise one after the other. Each run is recorded by the profiler
+    under the corresponding name in stages (default: title). Returns the CLI
+    nodes.
+    """
+    cliNodes = []
+    if not cliRuns:
+      return cliNodes
+    if not stages:
+      stages = [title]*len(cliRuns)
+
+    def start(module,parameters):
+      logging.info('Starting '+module.name+': '+str(parameters))
+      startTime = time.time()
+      cliNodes.append(slicer.cli.run(module, None, parameters, wait_for_completion=False))
+      return startTime
+
+    if concurrent:
+      starts = [start(module,parameters) for module,parameters in cliRuns]
+      finishTimes = self.waitForCLIs(cliNodes, title)
+    else:
+      starts = []
+      finishTimes = []
+      for module,parameters in cliRuns:
+        starts.append(start(module,parameters))
+        finishTimes += self.waitForCLIs(cliNodes[-1:], title)
+
+    # the CLIs run in their own processes, so the memory of this process
+    # tells nothing about them; the peak of the child processes is the
+    # largest of all the CLIs that completed so far, not only of these
+    childrenPeakMemory = StageProfiler.getPeakMemory(children=True)
+    for i,((module,parameters),startTime) in enumerate(zip(cliRuns,starts)):
+      details = {'cli':module.name, 'childrenPeakMemory':childrenPeakMemory}
+      # concurrent runs are shown on separate tracks of the trace
+      if concurrent and len(cliRuns) > 1:
+        details['track'] = i+1
+      self.profiler.addRecord(stages[i], startTime, finishTimes[i], **details)
+    return cliNodes
+
+  def waitForCLIs(self,cliNodes,title):
+    """Wait for the CLI nodes to complete, and return the times at which they
+    completed.
+    """
+    finishTimes = [None]*len(cliNodes)
+    def isRunning():
+      for i,cliNode in enumerate(cliNodes):
+        if finishTimes[i] is None and not cliNode.IsBusy():
+          finishTimes[i] = time.time()
+      return None in finishTimes
+    def progress():
+      return sum([100. if not cliNode.IsBusy() else cliNode.GetProgress() for cliNode in cliNodes])/len(cliNodes)
+    self.waitForCompletion(isRunning, progress, title)
+
+    for cliNode in cliNodes:
+      if cliNode.GetStatus() & cliNode.ErrorsMask:
+        raise ValueError('CLI execution failed: '+cliNode.GetName()+' '+cliNode.GetErrorText())
+    return finishTimes
+
+  def saveProfile(self,parameterNode):
+    """Store the stage records in the StageProfile attribute of the parameter
+    node, and write them to ProfileFileName if set, in the ProfileFormat
+    (JSON or ChromeTrace) format.
+    """
+    parameterNode.SetAttribute('StageProfile', self.profiler.toJSON())
+    profileFileName = parameterNode.GetAttribute('ProfileFileName')
+    if profileFileName:
+      self.profiler.save(profileFileName, parameterNode.GetAttribute('ProfileFormat') or 'JSON')
+
+  def runInWorkers(self,function,argumentsList,concurrent=True,title='Processing'):
+    """Call function with each of the argument tuples in argumentsList in
+    worker threads, while keeping the GUI responsive. The function must not
+    access the scene. Returns the results in the order of argumentsList.
+    """
+    results = [None]*len(argumentsList)
+    errors = []
+    if not argumentsList:
+      return results
+
+    def work(i,arguments):
+      try:
+        results[i] = function(*arguments)
+      except Exception as e:
+        errors.append(e)
+
+    workers = [threading.Thread(target=work,args=(i,arguments)) for i,arguments in enumerate(argumentsList)]
+    def progress():
+      return 100.*len([worker for worker in workers if worker.ident is not None and not worker.is_alive()])/len(workers)
+
+    if concurrent:
+      for worker in workers:
+        worker.start()
+      self.waitForCompletion(lambda: any([worker.is_alive() for worker in workers]), progress, title)
+    else:
+      for worker in workers:
+        worker.start()
+        self.waitForCompletion(worker.is_alive, progress, title)
 
-    fixedLabelImage = sitk.ReadImage(fixedLabelAddress)
-    movingLabelImage = sitk.ReadImage(movingLabelAddress)
+    if errors:
+      raise errors[0]
+    return results
 
-    cast = sitk.CastImageFilter()
-    cast.SetOutputPixelType(2)
-    unionLabelImage = (cast.Execute(fixedLabelImage) + cast.Execute(movingLabelImage)) > 0
-    unionLabelImage = cast.Execute(unionLabelImage)
+  def waitForCompletion(self,isRunning,progress,title):
+    """Process events until isRunning() returns False, showing progress()
+    (in percent) in a progress dialog when the main window is available.
+    """
+    progressDialog = None
+    if slicer.util.mainWindow():
+      progressDialog = slicer.util.createProgressDialog(windowTitle='Distance Map Based Registration',
+                                                        labelText=title, maximum=100)
+    try:
+      while isRunning():
+        if progressDialog:
+          progressDialog.value = int(progress())
+        slicer.app.processEvents()
+        time.sleep(0.05)
+    finally:
+      if progressDialog:
+        progressDialog.close()
+
+  def getSmoothedLabelNodeID(self,parameterNode,role):
+    """Return the ID of the smoothed label node of the fixed or moving
+    (role) label, adding the label smoothed in memory to the scene if needed.
+    """
+    smoothedLabelID = parameterNode.GetAttribute(role+'LabelSmoothedID')
+    if smoothedLabelID and slicer.mrmlScene.GetNodeByID(smoothedLabelID):
+      return smoothedLabelID
+
+    labelNodeID = parameterNode.GetAttribute(role+'LabelNodeID')
+    labelNode = slicer.mrmlScene.GetNodeByID(labelNodeID)
+    smoothedLabelName = labelNode.GetName()+'-Smoothed'
+    sitkUtils.PushVolumeToSlicer(self.smoothedLabelImages[labelNodeID],name=smoothedLabelName)
+    smoothedLabel = slicer.util.getNode(smoothedLabelName)
+    parameterNode.SetAttribute(role+'LabelSmoothedID',smoothedLabel.GetID())
+    return smoothedLabel.GetID()
+
+  def getBoundingBox(self,fixedLabelArray,movingLabelArray):
+    """Return the crop sizes (lower and upper, in IJK order) of the bounding
+    box of the union of the labels, with a margin. The labels are given as
+    the (K,J,I) arrays of the label volumes.
+    """
 
-    ls.Execute(unionLabelImage,unionLabelImage)
-    bb = ls.GetBoundingBox(1)
+    if fixedLabelArray.shape != movingLabelArray.shape:
+      raise ValueError('The fixed and moving labels must have the same size')
+
+    # extent of the union along each axis, from any-reductions of the labels
+    # rather than an explicit union image
+    fixedJI = fixedLabelArray.any(axis=0)
+    movingJI = movingLabelArray.any(axis=0)
+    extents = [fixedJI.any(axis=0) | movingJI.any(axis=0),
+               fixedJI.any(axis=1) | movingJI.any(axis=1),
+               fixedLabelArray.any(axis=(1,2)) | movingLabelArray.any(axis=(1,2))]
+    bb = []
+    for extent in extents:
+      indices = extent.nonzero()[0]
+      if not len(indices):
+        raise ValueError('The fixed and moving labels are empty')
+      bb += [int(indices[0]),int(indices[-1])]
     logging.info('Bounding box:'+str(bb))
 
-    size = unionLabelImage.GetSize()
+    size = fixedLabelArray.shape[::-1]
     bbMin = (max(0,bb[0]-30),max(0,bb[2]-30),max(0,bb[4]-5))
     bbMax = (size[0]-min(size[0],bb[1]+30),size[1]-min(size[1],bb[3]+30),size[2]-(min(size[2],bb[5]+5)))
 
     return (bbMin,bbMax)
 
-  def preProcessLabel(self,labelNodeID,bbMin,bbMax):
-
-    logging.info('Label node ID: '+labelNodeID)
+  def getCroppedLabelImage(self,labelNode,labelArray,bbMin,bbMax):
+    """Return the bounding box region of the label array (a view of the
+    label node voxels) as a SimpleITK image, with the geometry of the label
+    node converted to LPS. Only the cropped region is copied.
+    """
+    import numpy
 
-    labelNode = slicer.util.getNode(labelNodeID)
+    size = labelArray.shape[::-1]
+    croppedArray = labelArray[bbMin[2]:size[2]-bbMax[2], bbMin[1]:size[1]-bbMax[1], bbMin[0]:size[0]-bbMax[0]]
+    croppedImage = sitk.GetImageFromArray(numpy.ascontiguousarray(croppedArray))
 
-    labelNodeAddress = sitkUtils.GetSlicerITKReadWriteAddress(labelNode.GetName())
+    ijkToRAS = vtk.vtkMatrix4x4()
+    labelNode.GetIJKToRASMatrix(ijkToRAS)
+    origin = ijkToRAS.MultiplyPoint([float(bbMin[0]),float(bbMin[1]),float(bbMin[2]),1.])
+    directions = vtk.vtkMatrix4x4()
+    labelNode.GetIJKToRASDirectionMatrix(directions)
 
-    logging.info('Label node address: '+str(labelNodeAddress))
+    croppedImage.SetOrigin((-origin[0],-origin[1],origin[2]))
+    croppedImage.SetSpacing(labelNode.GetSpacing())
+    croppedImage.SetDirection([(-1. if row < 2 else 1.)*directions.GetElement(row,column) for row in range(3) for column in range(3)])
 
-    labelImage = sitk.ReadImage(labelNodeAddress)
+    return croppedImage
 
-    logging.info('Read image: '+str(labelImage))
+  def cropLabel(self,labelNodeID,croppedImage):
+    """Add the cropped label to the scene and create the output node of the
+    SegmentationSmoothing CLI. Returns the parameters of the CLI.
+    """
 
-    crop = sitk.CropImageFilter()
-    crop.SetLowerBoundaryCropSize(bbMin)
-    crop.SetUpperBoundaryCropSize(bbMax)
-    croppedImage = crop.Execute(labelImage)
+    logging.info('Label node ID: '+labelNodeID)
 
-    logging.info('Cropped image done: '+str(croppedImage))
+    labelNode = slicer.util.getNode(labelNodeID)
 
     croppedLabelName = labelNode.GetName()+'-Cropped'
     sitkUtils.PushVolumeToSlicer(croppedImage,name=croppedLabelName)
@@ -548,16 +1224,20 @@ class DistanceMapBasedRegistrationLogic(ScriptedLoadableModuleLogic):
     # smooth the labels
     smoothingParameters = {'inputImageName':croppedLabel.GetID(), 'outputImageName':smoothLabel.GetID()}
     logging.info('Smoothing parameters:'+str(smoothingParameters))
-    cliNode = slicer.cli.run(slicer.modules.segmentationsmoothing, None, smoothingParameters, wait_for_completion = True)
 
-    # crop the bounding box
-    
+    return smoothingParameters
+
+  def computeDistanceMap(self,labelNodeID,smoothLabelID):
+
     '''
     TODO:
      * output volume node probably not needed here
      * intermediate nodes should probably be hidden
     '''
 
+    labelNode = slicer.util.getNode(labelNodeID)
+    smoothLabel = slicer.util.getNode(smoothLabelID)
+
     dt = sitk.SignedMaurerDistanceMapImageFilter()
     dt.SetSquaredDistance(False)
     distanceMapName = labelNode.GetName()+'-DistanceMap'
@@ -569,6 +1249,278 @@ class DistanceMapBasedRegistrationLogic(ScriptedLoadableModuleLogic):
 
     return slicer.util.getNode(distanceMapName)
 
+  def smoothLabelImage(self,croppedImage):
+    """Compute the smoothed label and its distance map from the cropped
+    label image. The smoothing is the same as in SegmentationSmoothing: the label is
+    resampled to isotropic resolution, smoothed with a Gaussian of sigma
+    equal to the largest spacing, and thresholded at 0.5. Does not access
+    the scene, so that it can run in a worker thread. Returns the cropped,
+    smoothed and distance map images.
+    """
+
+    # resample to the isotropic resolution of the smallest spacing
+    spacing = croppedImage.GetSpacing()
+    minSpacing = min(spacing)
+    maxSpacing = max(spacing)
+    size = croppedImage.GetSize()
+    outputSize = [int(size[i]*spacing[i]/minSpacing+.5) for i in range(3)]
+    resampledImage = sitk.Resample(croppedImage, outputSize, sitk.Transform(), sitk.sitkNearestNeighbor,
+                                   croppedImage.GetOrigin(), [minSpacing]*3, croppedImage.GetDirection(),
+                                   0, croppedImage.GetPixelID())
+
+    # convert to label 1 first, then smooth, then threshold at 0.5
+    with self.profiler.stage('Smoothing', voxels=numberOfVoxels(resampledImage)):
+      binaryImage = sitk.BinaryThreshold(resampledImage, 1, 255, 1, 0)
+      smoothedImage = sitk.SmoothingRecursiveGaussian(sitk.Cast(binaryImage, sitk.sitkFloat32), [maxSpacing]*3)
+      smoothedLabelImage = sitk.BinaryThreshold(smoothedImage, 0.5, 255, 1, 0)
+
+    with self.profiler.stage('Distance map', voxels=numberOfVoxels(smoothedLabelImage)):
+      dt = sitk.SignedMaurerDistanceMapImageFilter()
+      dt.SetSquaredDistance(False)
+      distanceImage = dt.Execute(smoothedLabelImage)
+
+    return (croppedImage,smoothedLabelImage,distanceImage)
+
+  def pushPreprocessedLabel(self,labelNodeID,images,keepIntermediateVolumes=False):
+    """Add the distance map computed by smoothLabelImage to the scene, and
+    the intermediate images if keepIntermediateVolumes is set. The cropped
+    image may be None. Returns the distance map node.
+    """
+
+    labelNode = slicer.util.getNode(labelNodeID)
+    (croppedImage,smoothedLabelImage,distanceImage) = images
+
+    self.smoothedLabelImages[labelNodeID] = smoothedLabelImage
+    if keepIntermediateVolumes:
+      # the cropped label is not available when reused from the cache
+      if croppedImage is not None:
+        sitkUtils.PushVolumeToSlicer(croppedImage,name=labelNode.GetName()+'-Cropped')
+      sitkUtils.PushVolumeToSlicer(smoothedLabelImage,name=labelNode.GetName()+'-Smoothed')
+
+    distanceMapName = labelNode.GetName()+'-DistanceMap'
+    with self.profiler.stage('Push to scene', voxels=numberOfVoxels(distanceImage)):
+      sitkUtils.PushVolumeToSlicer(distanceImage, name=distanceMapName)
+
+    return slicer.util.getNode(distanceMapName)
+
+
+def numberOfVoxels(image):
+  size = image.GetSize()
+  return size[0]*size[1]*size[2]
+
+#
+# StageProfiler
+#
+
+class StageProfiler(object):
+  """Records the wall time, the increase of the peak memory of the process
+  (None for stages run in other processes) and the details (voxel counts,
+  output sizes) of the stages of the registration. The records can be saved as JSON, or in the Chrome trace
+  event format to be viewed in chrome://tracing or Perfetto.
+  """
+
+  def __init__(self):
+    self.records = []
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def getPeakMemory(children=False):
+    """Peak resident memory of this process in bytes, or of the largest of
+    its terminated child processes if children is set. None if unknown.
+    """
+    try:
+      import resource
+    except ImportError:
+      return None
+    peakMemory = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peakMemory if sys.platform == 'darwin' else peakMemory*1024
+
+  @contextlib.contextmanager
+  def stage(self,name,**details):
+    """Record the code run in the with block as a stage. The details
+    dictionary is yielded, so that details known at the end of the stage
+    can be added.
+    """
+    startTime = time.time()
+    peakMemory = self.getPeakMemory()
+    try:
+      yield details
+    finally:
+      self.addRecord(name, startTime, time.time(), peakMemory, **details)
+
+  def addRecord(self,name,startTime,endTime,peakMemory=None,**details):
+    """Add the record of a stage, given the peak memory of the process at
+    the start of the stage, or None if the stage ran in other processes.
+    Returns the record.
+    """
+    endPeakMemory = self.getPeakMemory()
+    record = {'name':name, 'startTime':startTime, 'wallTime':endTime-startTime,
+              'peakMemoryDelta':endPeakMemory-peakMemory if peakMemory is not None and endPeakMemory is not None else None,
+              'thread':threading.current_thread().ident}
+    record.update(details)
+    with self.lock:
+      self.records.append(record)
+    return record
+
+  def getRecord(self,name):
+    """Return the last record of the named stage."""
+    with self.lock:
+      return [record for record in self.records if record['name'] == name][-1]
+
+  def toJSON(self):
+    with self.lock:
+      return json.dumps(self.records, indent=2)
+
+  def toChromeTrace(self):
+    events = []
+    with self.lock:
+      for record in self.records:
+        arguments = dict([(key,value) for key,value in record.items() if key not in ('name','startTime','wallTime','thread','track')])
+        events.append({'name':record['name'], 'cat':'DistanceMapBasedRegistration', 'ph':'X',
+                       'ts':int(record['startTime']*1e6), 'dur':int(record['wallTime']*1e6),
+                       'pid':os.getpid(), 'tid':record.get('track') or record['thread'], 'args':arguments})
+    return json.dumps({'traceEvents':events, 'displayTimeUnit':'ms'})
+
+  def save(self,fileName,format='JSON'):
+    if format not in ('JSON','ChromeTrace'):
+      raise ValueError('Unknown profile format: '+format)
+    with open(fileName,'w') as f:
+      f.write(self.toChromeTrace() if format == 'ChromeTrace' else self.toJSON())
+
+def makeDirectory(directory):
+  """Create the directory if it does not exist. Concurrent batch workers
+  may create the same directory, which is not an error.
+  """
+  try:
+    os.makedirs(directory)
+  except OSError:
+    if not os.path.isdir(directory):
+      raise
+
+#
+# DistanceMapCache
+#
+
+class DistanceMapCache(object):
+  """On-disk cache of the smoothed labels, distance maps and surfaces
+  computed by DistanceMapBasedRegistrationLogic. Entries are keyed by a hash
+  of the cropped label voxels, geometry and preprocessing settings, so
+  they are reused across Apply clicks and Slicer sessions. The least
+  recently used entries are removed when the cache grows above the size
+  limit (in MB).
+  """
+
+  # increment when the preprocessing changes, to invalidate the old entries
+  Version = 2
+  DefaultSizeLimit = 1024
+
+  def __init__(self,directory,sizeLimit=DefaultSizeLimit):
+    self.directory = directory
+    self.sizeLimit = sizeLimit
+    makeDirectory(self.directory)
+
+  def getLabelKey(self,labelImage,preprocessingMode):
+    import numpy
+    key = hashlib.sha1()
+    key.update(numpy.ascontiguousarray(sitk.GetArrayFromImage(labelImage)).tobytes())
+    key.update(str((labelImage.GetPixelIDValue(), labelImage.GetSize(), labelImage.GetSpacing(),
+                    labelImage.GetOrigin(), labelImage.GetDirection(),
+                    preprocessingMode, self.Version)).encode('utf-8'))
+    return key.hexdigest()
+
+  def loadLabel(self,key):
+    """Return the cached (smoothed label, distance map) images, or None."""
+    smoothedFileName = self.getFileName(key,'Smoothed.nrrd')
+    distanceMapFileName = self.getFileName(key,'DistanceMap.nrrd')
+    if not os.path.isfile(smoothedFileName) or not os.path.isfile(distanceMapFileName):
+      return None
+    try:
+      images = (sitk.ReadImage(smoothedFileName), sitk.ReadImage(distanceMapFileName))
+    except RuntimeError:
+      logging.warning('Failed to read cache entry '+key)
+      return None
+    self.touch(smoothedFileName)
+    self.touch(distanceMapFileName)
+    return images
+
+  def storeLabel(self,key,smoothedLabelImage,distanceImage):
+    self.write(key,'Smoothed.nrrd',lambda fileName: sitk.WriteImage(smoothedLabelImage,fileName,True))
+    self.write(key,'DistanceMap.nrrd',lambda fileName: sitk.WriteImage(distanceImage,fileName))
+    self.evict()
+
+  def loadSurface(self,key):
+    """Return the cached surface made from the label, or None."""
+    fileName = self.getFileName(key,'Surface.ply')
+    if not os.path.isfile(fileName):
+      return None
+    reader = vtk.vtkPLYReader()
+    reader.SetFileName(fileName)
+    reader.Update()
+    if not reader.GetOutput().GetNumberOfPoints():
+      return None
+    self.touch(fileName)
+    return reader.GetOutput()
+
+  def storeSurface(self,key,polyData):
+    if not polyData:
+      return
+    def writeSurface(fileName):
+      writer = vtk.vtkPLYWriter()
+      writer.SetInputData(polyData)
+      writer.SetFileName(fileName)
+      writer.SetFileTypeToBinary()
+      writer.Write()
+    self.write(key,'Surface.ply',writeSurface)
+    self.evict()
+
+  def getFileName(self,key,suffix):
+    return os.path.join(self.directory, key+'-'+suffix)
+
+  def write(self,key,suffix,writeFunction):
+    # write to a temporary file first, so that other sessions never read a
+    # partially written entry
+    fileName = self.getFileName(key,suffix)
+    temporaryFileName = fileName+'.'+str(os.getpid())+'.tmp'
+    try:
+      writeFunction(temporaryFileName)
+      if os.path.exists(fileName):
+        os.remove(fileName)
+      os.rename(temporaryFileName,fileName)
+    except (OSError,RuntimeError) as e:
+      logging.warning('Failed to write cache entry '+fileName+': '+str(e))
+      if os.path.exists(temporaryFileName):
+        os.remove(temporaryFileName)
+
+  def touch(self,fileName):
+    # the modification time records the last use
+    try:
+      os.utime(fileName,None)
+    except OSError:
+      pass
+
+  def evict(self):
+    """Remove the least recently used files until the cache fits the size
+    limit.
+    """
+    files = []
+    for name in os.listdir(self.directory):
+      fileName = os.path.join(self.directory,name)
+      if name.endswith('.tmp') or not os.path.isfile(fileName):
+        continue
+      fileStat = os.stat(fileName)
+      files.append((fileStat.st_mtime,fileStat.st_size,fileName))
+
+    totalSize = sum([size for mtime,size,fileName in files])
+    for mtime,size,fileName in sorted(files):
+      if totalSize <= self.sizeLimit*1024*1024:
+        break
+      try:
+        os.remove(fileName)
+        totalSize -= size
+        logging.info('Removed cache entry '+fileName)
+      except OSError:
+        pass
 
 class DistanceMapBasedRegistrationTest(ScriptedLoadableModuleTest):
   """
@@ -587,6 +1539,18 @@ class DistanceMapBasedRegistrationTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_DistanceMapBasedRegistration1()
+    self.setUp()
+    self.test_ProfilerChromeTrace()
+    self.setUp()
+    self.test_CacheEviction()
+    self.setUp()
+    self.test_ReadManifest()
+    self.setUp()
+    self.test_BatchResume()
+    self.setUp()
+    self.test_BatchWorkerFailure()
+    self.setUp()
+    self.test_NarrowBand()
 
   def test_DistanceMapBasedRegistration1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -624,10 +1588,497 @@ class DistanceMapBasedRegistrationTest(ScriptedLoadableModuleTest):
     self.assertTrue( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
 
+  def makeTemporaryDirectory(self):
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp(prefix='DistanceMapBasedRegistrationTest-')
+    self.addCleanup(shutil.rmtree,directory,True)
+    return directory
+
+  def writeManifest(self,directory,cases,fileName='cases.csv'):
+    import csv
+    manifestFileName = os.path.join(directory,fileName)
+    if fileName.endswith('.json'):
+      with open(manifestFileName,'w') as f:
+        json.dump(cases,f)
+    else:
+      with open(manifestFileName,'w') as f:
+        writer = csv.DictWriter(f,['id','fixedLabel','movingLabel'])
+        writer.writeheader()
+        for case in cases:
+          writer.writerow(case)
+    return manifestFileName
+
+  def getBatchArguments(self,manifestFileName,outputDirectory,**arguments):
+    import argparse
+    batchArguments = argparse.Namespace(manifest=manifestFileName, output_directory=outputDirectory,
+                                        processes=2, timeout=0, force=False, no_cache=True,
+                                        cache_directory=None, multi_resolution=False, narrow_band=0,
+                                        profile=False, case=None)
+    for key,value in arguments.items():
+      setattr(batchArguments,key,value)
+    return batchArguments
+
+  def getWorkerArguments(self,outputDirectory,script):
+    """Command line of a worker process that runs script instead of the
+    registration, with caseID and caseDirectory defined.
+    """
+    header = ('import json, os, sys, time\n'
+              'caseID = sys.argv[sys.argv.index("--case")+1]\n'
+              'caseDirectory = os.path.join(sys.argv[1], caseID)\n')
+    return [sys.executable, '-c', header+script, outputDirectory]
+
+  def test_ProfilerChromeTrace(self):
+    profiler = StageProfiler()
+    profiler.addRecord('Distance map (Fixed)',100.,101.5,voxels=1000,track='Fixed')
+    with profiler.stage('Registration',level=1) as details:
+      details['iterations'] = 10
+
+    self.assertEqual(profiler.getRecord('Distance map (Fixed)')['voxels'], 1000)
+    # unknown for stages that ran in other processes
+    self.assertIsNone(profiler.getRecord('Distance map (Fixed)')['peakMemoryDelta'])
+    self.assertEqual(len(json.loads(profiler.toJSON())), 2)
+
+    trace = json.loads(profiler.toChromeTrace())
+    self.assertEqual(trace['displayTimeUnit'], 'ms')
+    events = trace['traceEvents']
+    self.assertEqual([event['name'] for event in events], ['Distance map (Fixed)','Registration'])
+    for event in events:
+      self.assertEqual(event['ph'], 'X')
+      self.assertEqual(event['pid'], os.getpid())
+    # complete events in microseconds, on the track of the stage if given
+    self.assertEqual(events[0]['ts'], 100000000)
+    self.assertEqual(events[0]['dur'], 1500000)
+    self.assertEqual(events[0]['tid'], 'Fixed')
+    self.assertEqual(events[1]['tid'], threading.current_thread().ident)
+    # the details are the arguments of the event
+    self.assertEqual(events[0]['args']['voxels'], 1000)
+    self.assertNotIn('track', events[0]['args'])
+    self.assertEqual(events[1]['args']['level'], 1)
+    self.assertEqual(events[1]['args']['iterations'], 10)
+
+    with self.assertRaises(ValueError):
+      profiler.save(os.path.join(self.makeTemporaryDirectory(),'profile.txt'),'Text')
+
+  def test_CacheEviction(self):
+    directory = self.makeTemporaryDirectory()
+    cache = DistanceMapCache(os.path.join(directory,'cache'),sizeLimit=1)
+    self.assertTrue(os.path.isdir(cache.directory))
+
+    # four entries of 400 kB, last used in the order a, b, c, d
+    megabyte = 1024*1024
+    now = time.time()
+    for i,key in enumerate(['a','b','c','d']):
+      fileName = cache.getFileName(key,'Label.nrrd')
+      with open(fileName,'wb') as f:
+        f.write(b'\0'*(megabyte*4//10))
+      os.utime(fileName,(now-100+i,now-100+i))
+    # partially written entries of other sessions are left alone
+    temporaryFileName = cache.getFileName('e','Label.nrrd')+'.1234.tmp'
+    with open(temporaryFileName,'wb') as f:
+      f.write(b'\0'*megabyte)
+
+    # using an entry makes it the most recently used
+    cache.touch(cache.getFileName('a','Label.nrrd'))
+    cache.evict()
+    remaining = sorted(os.listdir(cache.directory))
+    self.assertEqual(remaining, sorted([os.path.basename(cache.getFileName(key,'Label.nrrd')) for key in ['a','d']]+
+                                       [os.path.basename(temporaryFileName)]))
+
+  def test_ReadManifest(self):
+    directory = self.makeTemporaryDirectory()
+
+    cases = [{'id':'a', 'fixedLabel':'a-fixed.nrrd', 'movingLabel':'a-moving.nrrd'},
+             {'id':'', 'fixedLabel':'b-fixed.nrrd', 'movingLabel':'b-moving.nrrd'}]
+    for fileName in ['cases.csv','cases.json']:
+      manifest = readManifest(self.writeManifest(directory,cases,fileName))
+      self.assertEqual([case['id'] for case in manifest], ['a','case0002'])
+      self.assertEqual(manifest[0]['fixedLabel'], os.path.join(directory,'a-fixed.nrrd'))
+      self.assertEqual(manifest[1]['movingLabel'], os.path.join(directory,'b-moving.nrrd'))
+      self.assertFalse(manifest[0].get('fixedImage'))
+
+    missingColumn = [{'id':'a', 'fixedLabel':'a-fixed.nrrd'}]
+    with self.assertRaises(ValueError):
+      readManifest(self.writeManifest(directory,missingColumn,'missing.json'))
+    with open(os.path.join(directory,'missing.csv'),'w') as f:
+      f.write('id,fixedLabel\na,a-fixed.nrrd\n')
+    with self.assertRaises(ValueError):
+      readManifest(os.path.join(directory,'missing.csv'))
+
+    duplicateIDs = [cases[0],cases[0]]
+    for fileName in ['duplicates.csv','duplicates.json']:
+      with self.assertRaises(ValueError):
+        readManifest(self.writeManifest(directory,duplicateIDs,fileName))
+
+  def test_BatchResume(self):
+    import csv
+    directory = self.makeTemporaryDirectory()
+    outputDirectory = os.path.join(directory,'output')
+    cases = [{'id':'done', 'fixedLabel':'fixed.nrrd', 'movingLabel':'moving.nrrd'},
+             {'id':'new', 'fixedLabel':'fixed.nrrd', 'movingLabel':'moving.nrrd'}]
+    manifestFileName = self.writeManifest(directory,cases)
+
+    # the case completed in an earlier batch is not registered again
+    makeDirectory(os.path.join(outputDirectory,'done'))
+    writeCaseStatus(os.path.join(outputDirectory,'done'), {'id':'done', 'status':'completed', 'elapsedTime':1.})
+    worker = self.getWorkerArguments(outputDirectory,
+      'json.dump({"id":caseID, "status":"completed", "elapsedTime":0.5,\n'
+      '           "timings":{"registration":0.5}}, open(os.path.join(caseDirectory,"status.json"),"w"))\n')
+    self.assertEqual(runBatch(self.getBatchArguments(manifestFileName,outputDirectory),worker), 0)
+    self.assertFalse(os.path.exists(os.path.join(outputDirectory,'done','log.txt')))
+    self.assertTrue(os.path.exists(os.path.join(outputDirectory,'new','log.txt')))
+
+    with open(os.path.join(outputDirectory,'report.csv')) as f:
+      report = dict([(row['id'],row) for row in csv.DictReader(f)])
+    self.assertEqual(report['done']['status'], 'completed')
+    self.assertEqual(report['new']['status'], 'completed')
+    self.assertEqual(float(report['new']['registration']), 0.5)
+
+    # with force, all cases are registered again
+    failingWorker = self.getWorkerArguments(outputDirectory,'sys.exit(3)\n')
+    self.assertEqual(runBatch(self.getBatchArguments(manifestFileName,outputDirectory,force=True),failingWorker), 1)
+    self.assertEqual(readCaseStatus(os.path.join(outputDirectory,'done'))['status'], 'failed')
+
+  def test_BatchWorkerFailure(self):
+    directory = self.makeTemporaryDirectory()
+    outputDirectory = os.path.join(directory,'output')
+    cases = [{'id':'crashed', 'fixedLabel':'fixed.nrrd', 'movingLabel':'moving.nrrd'},
+             {'id':'hanging', 'fixedLabel':'fixed.nrrd', 'movingLabel':'moving.nrrd'}]
+    manifestFileName = self.writeManifest(directory,cases)
+
+    # the crashed worker exits without a status, the hanging one is killed
+    # after the timeout, leaving its status as running; like the launcher,
+    # it starts a child process, which must be killed with it
+    orphanDirectory = os.path.join(directory,'orphan')
+    worker = self.getWorkerArguments(outputDirectory,
+      'import subprocess\n'
+      'if caseID == "crashed":\n'
+      '  sys.exit(3)\n'
+      'json.dump({"id":caseID, "status":"running"}, open(os.path.join(caseDirectory,"status.json"),"w"))\n'
+      'subprocess.Popen([sys.executable, "-c", "import os, sys, time; time.sleep(5); os.mkdir(sys.argv[1])", '
+      +json.dumps(orphanDirectory)+'])\n'
+      'time.sleep(60)\n')
+    startTime = time.time()
+    self.assertEqual(runBatch(self.getBatchArguments(manifestFileName,outputDirectory,timeout=2.),worker), 1)
+    self.assertLess(time.time()-startTime, 30.)
+    time.sleep(max(0.,startTime+7.-time.time()))
+    self.assertFalse(os.path.exists(orphanDirectory))
+
+    for caseID in ['crashed','hanging']:
+      status = readCaseStatus(os.path.join(outputDirectory,caseID))
+      self.assertEqual(status['status'], 'failed')
+      self.assertIn('worker exited with code', status['error'])
+    self.assertIn('code 3', readCaseStatus(os.path.join(outputDirectory,'crashed'))['error'])
+
+  def test_NarrowBand(self):
+    # label filling the lower half along x of a grid of 0.5 mm voxels, so
+    # that the distances are in units of 0.5 mm
+    spacing = 0.5
+    labelImage = sitk.Paste(sitk.Image([40,4,4],sitk.sitkUInt8), sitk.Image([20,4,4],sitk.sitkUInt8)+1,
+                            [20,4,4], [0,0,0], [0,0,0])
+    labelImage.SetSpacing([spacing]*3)
+    distanceImage = sitk.SignedMaurerDistanceMapImageFilter().Execute(labelImage)
+    sitkUtils.PushVolumeToSlicer(distanceImage, name='DistanceMap')
+    distanceMapNode = slicer.util.getNode('DistanceMap')
+
+    width = 2.
+    maskNode = DistanceMapBasedRegistrationLogic().applyNarrowBand(distanceMapNode, width)
+
+    # the band is width mm on each side of the surface, within a voxel
+    bandThickness = slicer.util.arrayFromVolume(maskNode)[0,0].sum()*spacing
+    self.assertAlmostEqual(bandThickness, 2*width, delta=spacing)
+    self.assertAlmostEqual(slicer.util.arrayFromVolume(distanceMapNode).max(), width/spacing)
 
-    '''
+#
+# Batch registration
+#
+# Registers the label pairs listed in a manifest without the GUI, e.g.
+#
+#   Slicer --no-splash --no-main-window --python-script DistanceMapBasedRegistration.py \
+#     --manifest cases.csv --output-directory results --processes 4
+#
+# The manifest is a CSV file with a header, or a JSON list of objects, with
+# the fixedLabel and movingLabel columns and the optional id, fixedImage and
+# movingImage columns. Relative paths are relative to the manifest. Each case
+# runs in its own Slicer process, and the transforms and a status.json file
+# are written to the case subdirectory of the output directory. Cases that
+# completed in an earlier batch are skipped, so a failed or interrupted batch
+# can be resumed by running it again. A report of all cases is written to
+# report.csv in the output directory.
+#
 
-    TODO:
-     * add main() so that registration could be run from command line
+def readManifest(manifestFileName):
+  import csv
+  import json
+
+  if manifestFileName.lower().endswith('.json'):
+    with open(manifestFileName) as f:
+      cases = json.load(f)
+  else:
+    with open(manifestFileName) as f:
+      cases = [dict(row) for row in csv.DictReader(f)]
+
+  manifestDirectory = os.path.dirname(os.path.abspath(manifestFileName))
+  for i,case in enumerate(cases):
+    if not case.get('fixedLabel') or not case.get('movingLabel'):
+      raise ValueError('Case '+str(i+1)+' of '+manifestFileName+' has no fixedLabel or movingLabel')
+    if not case.get('id'):
+      case['id'] = 'case%04d' % (i+1)
+    for key in ['fixedLabel','movingLabel','fixedImage','movingImage']:
+      if case.get(key):
+        case[key] = os.path.join(manifestDirectory,case[key])
+  if len(set([case['id'] for case in cases])) != len(cases):
+    raise ValueError('The case IDs of '+manifestFileName+' are not unique')
+  return cases
+
+def readCaseStatus(caseDirectory):
+  import json
+  try:
+    with open(os.path.join(caseDirectory,'status.json')) as f:
+      return json.load(f)
+  except (IOError,ValueError):
+    return None
+
+def writeCaseStatus(caseDirectory,status):
+  import json
+  fileName = os.path.join(caseDirectory,'status.json')
+  with open(fileName+'.tmp','w') as f:
+    json.dump(status,f,indent=2)
+  if os.path.exists(fileName):
+    os.remove(fileName)
+  os.rename(fileName+'.tmp',fileName)
+
+def registerCase(case,caseDirectory,args):
+  """Run the registration of one case in this Slicer process, and save the
+  transforms to caseDirectory.
+  """
 
-    '''
+  def loadVolume(fileName,labelmap):
+    try:
+      volumeNode = slicer.util.loadLabelVolume(fileName) if labelmap else slicer.util.loadVolume(fileName)
+    except RuntimeError:
+      volumeNode = None
+    if not volumeNode:
+      raise IOError('Failed to read '+fileName)
+    return volumeNode
+
+  timings = {}
+  startTime = time.time()
+
+  parameterNode = slicer.vtkMRMLScriptedModuleNode()
+  parameterNode.SetAttribute('FixedLabelNodeID', loadVolume(case['fixedLabel'],True).GetID())
+  parameterNode.SetAttribute('MovingLabelNodeID', loadVolume(case['movingLabel'],True).GetID())
+  if case.get('fixedImage'):
+    parameterNode.SetAttribute('FixedImageNodeID', loadVolume(case['fixedImage'],False).GetID())
+  if case.get('movingImage'):
+    parameterNode.SetAttribute('MovingImageNodeID', loadVolume(case['movingImage'],False).GetID())
+
+  affineTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode','Affine')
+  bsplineTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLBSplineTransformNode','BSpline')
+  parameterNode.SetAttribute('AffineTransformNodeID', affineTransformNode.GetID())
+  parameterNode.SetAttribute('BSplineTransformNodeID', bsplineTransformNode.GetID())
+
+  parameterNode.SetAttribute('UseCache', str(not args.no_cache))
+  if args.cache_directory:
+    parameterNode.SetAttribute('CacheDirectory', args.cache_directory)
+  if args.multi_resolution:
+    parameterNode.SetAttribute('RegistrationMode', 'MultiResolution')
+  if args.narrow_band:
+    parameterNode.SetAttribute('NarrowBandWidth', str(args.narrow_band))
+  if args.profile:
+    parameterNode.SetAttribute('ProfileFileName', os.path.join(caseDirectory,'profile.json'))
+  timings['load'] = time.time()-startTime
+
+  registrationStartTime = time.time()
+  logic = DistanceMapBasedRegistrationLogic()
+  logic.run(parameterNode)
+  timings['registration'] = time.time()-registrationStartTime
+
+  saveStartTime = time.time()
+  for transformNode,fileName in [(affineTransformNode,'Affine.h5'), (bsplineTransformNode,'BSpline.h5')]:
+    if not slicer.util.saveNode(transformNode,os.path.join(caseDirectory,fileName)):
+      raise IOError('Failed to write '+os.path.join(caseDirectory,fileName))
+  timings['save'] = time.time()-saveStartTime
+
+  return timings
+
+def runCase(manifestFileName,caseID,args):
+  """Register one case of the manifest, recording the outcome in its
+  status.json file. Returns the exit code of the worker process.
+  """
+  import traceback
+
+  case = [case for case in readManifest(manifestFileName) if case['id'] == caseID][0]
+  caseDirectory = os.path.join(args.output_directory,caseID)
+  makeDirectory(caseDirectory)
+
+  startTime = time.time()
+  status = {'id':caseID, 'status':'running', 'startTime':startTime}
+  writeCaseStatus(caseDirectory,status)
+  try:
+    status['timings'] = registerCase(case,caseDirectory,args)
+    status['status'] = 'completed'
+  except Exception as e:
+    logging.error('Case '+caseID+' failed:\n'+traceback.format_exc())
+    status['status'] = 'failed'
+    status['error'] = str(e)
+  status['elapsedTime'] = time.time()-startTime
+  writeCaseStatus(caseDirectory,status)
+
+  return 0 if status['status'] == 'completed' else 1
+
+def getWorkerArguments(args):
+  """Command line of the Slicer process that registers one case, without
+  the --case argument.
+  """
+  workerArguments = [slicer.app.launcherExecutableFilePath, '--no-splash', '--no-main-window',
+                     '--python-script', os.path.abspath(__file__),
+                     '--manifest', os.path.abspath(args.manifest),
+                     '--output-directory', os.path.abspath(args.output_directory)]
+  if args.no_cache:
+    workerArguments.append('--no-cache')
+  if args.cache_directory:
+    workerArguments += ['--cache-directory', os.path.abspath(args.cache_directory)]
+  if args.multi_resolution:
+    workerArguments.append('--multi-resolution')
+  if args.narrow_band:
+    workerArguments += ['--narrow-band', str(args.narrow_band)]
+  if args.profile:
+    workerArguments.append('--profile')
+  return workerArguments
+
+def startWorkerProcess(arguments,logFile):
+  """Start a worker in its own process group, so that killWorkerProcess
+  also stops the processes it starts, e.g. the Slicer application started
+  by the launcher.
+  """
+  import subprocess
+
+  if sys.platform == 'win32':
+    groupArguments = {'creationflags':subprocess.CREATE_NEW_PROCESS_GROUP}
+  else:
+    groupArguments = {'start_new_session':True}
+  return subprocess.Popen(arguments, stdout=logFile, stderr=subprocess.STDOUT, **groupArguments)
+
+def killWorkerProcess(process):
+  """Kill a worker started by startWorkerProcess and all its descendants."""
+  import subprocess
+
+  if sys.platform == 'win32':
+    subprocess.call(['taskkill','/T','/F','/PID',str(process.pid)],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  else:
+    import signal
+    try:
+      os.killpg(process.pid,signal.SIGKILL)
+    except ProcessLookupError:
+      pass
+  # in case the tree could not be killed
+  if process.poll() is None:
+    process.kill()
+  process.wait()
+
+def runBatch(args,workerArguments=None):
+  """Run the cases of the manifest that did not complete yet, at most
+  args.processes of them at the same time, each in its own Slicer process.
+  workerArguments replaces the command line of the worker processes, to
+  which --case and the case ID are appended. Returns the exit code: 1 if
+  any case failed.
+  """
+  import csv
+  import subprocess
+
+  cases = readManifest(args.manifest)
+  makeDirectory(args.output_directory)
+
+  pending = []
+  for case in cases:
+    status = readCaseStatus(os.path.join(args.output_directory,case['id']))
+    if status and status['status'] == 'completed' and not args.force:
+      logging.info('Skipping completed case '+case['id'])
+    else:
+      pending.append(case)
+  logging.info('Registering %d of %d cases with %d processes' % (len(pending),len(cases),args.processes))
+
+  if workerArguments is None:
+    workerArguments = getWorkerArguments(args)
+
+  running = []
+  while pending or running:
+    while pending and len(running) < args.processes:
+      case = pending.pop(0)
+      caseDirectory = os.path.join(args.output_directory,case['id'])
+      makeDirectory(caseDirectory)
+      # replaces the status of an earlier batch, so that a worker that
+      # crashes before writing its own is not taken as completed
+      writeCaseStatus(caseDirectory,{'id':case['id'], 'status':'running', 'startTime':time.time()})
+      logFile = open(os.path.join(caseDirectory,'log.txt'),'w')
+      try:
+        process = startWorkerProcess(workerArguments+['--case',case['id']], logFile)
+      except Exception:
+        logFile.close()
+        raise
+      running.append((case,process,logFile,time.time()))
+      logging.info('Started case '+case['id'])
+
+    for item in list(running):
+      (case,process,logFile,startTime) = item
+      if process.poll() is None:
+        if args.timeout and time.time()-startTime > args.timeout:
+          killWorkerProcess(process)
+        else:
+          continue
+      logFile.close()
+      running.remove(item)
+
+      # the worker records its outcome, unless it crashed or was killed
+      caseDirectory = os.path.join(args.output_directory,case['id'])
+      status = readCaseStatus(caseDirectory)
+      if not status or status['status'] == 'running':
+        status = {'id':case['id'], 'status':'failed', 'elapsedTime':time.time()-startTime,
+                  'error':'worker exited with code %d' % process.returncode}
+        writeCaseStatus(caseDirectory,status)
+      logging.info('Case %s %s in %.1fs' % (case['id'],status['status'],status.get('elapsedTime',0)))
+
+    time.sleep(0.5)
+
+  # report all the cases of the manifest, including the earlier batches
+  numberOfFailedCases = 0
+  with open(os.path.join(args.output_directory,'report.csv'),'w') as f:
+    writer = csv.writer(f)
+    writer.writerow(['id','status','elapsedTime','load','registration','save','error'])
+    for case in cases:
+      status = readCaseStatus(os.path.join(args.output_directory,case['id'])) or {'status':'missing'}
+      if status['status'] != 'completed':
+        numberOfFailedCases += 1
+      timings = status.get('timings',{})
+      writer.writerow([case['id'], status['status'], status.get('elapsedTime','')]+
+                      [timings.get(key,'') for key in ['load','registration','save']]+[status.get('error','')])
+
+  logging.info('%d of %d cases completed' % (len(cases)-numberOfFailedCases,len(cases)))
+  return 1 if numberOfFailedCases else 0
+
+def main(argv):
+  import argparse
+
+  parser = argparse.ArgumentParser(description='Distance map based registration of the label pairs listed in a manifest.')
+  parser.add_argument('--manifest', required=True, help='CSV or JSON file listing the fixedLabel, movingLabel and optional id, fixedImage and movingImage of each case')
+  parser.add_argument('--output-directory', required=True, help='directory for the transforms, status and report of the cases')
+  parser.add_argument('--processes', type=int, default=1, help='number of cases registered at the same time')
+  parser.add_argument('--timeout', type=float, default=0, help='seconds after which a case is stopped and marked as failed (0: no limit)')
+  parser.add_argument('--force', action='store_true', help='register the cases that completed in an earlier batch again')
+  parser.add_argument('--no-cache', action='store_true', help='do not reuse the preprocessed labels of earlier runs')
+  parser.add_argument('--cache-directory', help='directory of the preprocessed label cache')
+  parser.add_argument('--multi-resolution', action='store_true', help='register from coarse to fine resolution')
+  parser.add_argument('--narrow-band', type=float, default=0, help='width (mm) of the band around the label surfaces used for registration (0: whole distance maps)')
+  parser.add_argument('--profile', action='store_true', help='write the stage profile of each case to profile.json')
+  parser.add_argument('--case', help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+
+  if args.case:
+    return runCase(args.manifest,args.case,args)
+  return runBatch(args)
+
+if __name__ == '__main__':
+  import sys
+  sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,11 @@
+#include <algorithm>
+#include <atomic>
+#include <cmath>
+#include <fstream>
+#include <sstream>
 #include <iostream>
+#include <thread>
+#include <vector>
 
 #include "itkImageFileReader.h"
 #include "itkImageFileWriter.h"
@@ -6,15 +13,42 @@
 #include "itkTriangleCell.h"
 
 #include "itkBinaryThresholdImageFilter.h"
+#include "itkRegionOfInterestImageFilter.h"
+#include "itkImageRegionConstIterator.h"
+#include "itkImageRegionConstIteratorWithIndex.h"
+#include "itkMinimumMaximumImageCalculator.h"
+#include "itkCastImageFilter.h"
+#include "itkImageIOFactory.h"
 #include "itkBinaryMask3DMeshSource.h"
 #include "itkQuadEdgeMeshDecimationCriteria.h"
 #include "itkSquaredEdgeLengthDecimationQuadEdgeMeshFilter.h"
+#include "itkMultiThreaderBase.h"
+#include "itkTimeProbe.h"
+#include "itksys/SystemTools.hxx"
 
 #include "itkMeshFileWriter.h"
 
 #include "vtkPLYWriter.h"
+#include "vtkXMLMultiBlockDataWriter.h"
+#include "vtkMultiBlockDataSet.h"
+#include "vtkInformation.h"
+#include "vtkCompositeDataSet.h"
 #include "vtkSmartPointer.h"
 #include "vtkPolyData.h"
+#include "vtkPoints.h"
+#include "vtkCellArray.h"
+#include "vtkIdTypeArray.h"
+#include "vtkImageData.h"
+#include "vtkPointData.h"
+#include "vtkUnsignedCharArray.h"
+#include "vtkQuadricDecimation.h"
+#include "vtkVersion.h"
+#if VTK_MAJOR_VERSION > 8 || (VTK_MAJOR_VERSION == 8 && VTK_MINOR_VERSION >= 2)
+#define QUADEDGESURFACEMESHER_HAS_FLYING_EDGES
+#include "vtkDiscreteFlyingEdges3D.h"
+#else
+#include "vtkDiscreteMarchingCubes.h"
+#endif
 
 #include "itkTriangleMeshToBinaryImageFilter.h"
 #include "itkImageDuplicator.h"
@@ -25,8 +59,6 @@ const unsigned int Dimension = 3;
 typedef double PixelType;
 
 typedef itk::Image<PixelType,   Dimension>   ImageType; // float to use uniform for all images
-typedef itk::ImageFileReader<ImageType> ReaderType;
-typedef itk::BinaryThresholdImageFilter<ImageType,ImageType> ThreshType;
 
 typedef itk::QuadEdgeMesh < double,3 > MeshType;
 
@@ -38,34 +70,325 @@ typedef itk::MeshFileWriter<MeshType> MeshWriterType;
 typedef itk::BinaryMask3DMeshSource< ImageType, MeshType >   MeshSourceType;
 typedef itk::TriangleMeshToBinaryImageFilter<MeshType,ImageType> Mesh2ImageType;
 
+// the input label image is read once, and each label is cropped from it and
+// converted to a binary image for the backend
+typedef itk::Image<unsigned short, Dimension> InputLabelImageType;
+typedef itk::ImageFileReader<InputLabelImageType> InputLabelReaderType;
+typedef itk::Image<unsigned char, Dimension> LabelImageType;
+
+// Index bounds and number of voxels of one label in the input image
+struct LabelBounds
+{
+  LabelBounds() : numberOfVoxels(0) {}
+
+  void Add(const InputLabelImageType::IndexType &index)
+  {
+    for(unsigned int d=0;d<3;d++){
+      if(!numberOfVoxels || index[d]<lower[d])
+        lower[d] = index[d];
+      if(!numberOfVoxels || index[d]>upper[d])
+        upper[d] = index[d];
+    }
+    numberOfVoxels++;
+  }
+
+  unsigned long numberOfVoxels;
+  InputLabelImageType::IndexType lower;
+  InputLabelImageType::IndexType upper;
+};
+
+// Surface of one label, in RAS, with the statistics of its meshing
+struct LabelSurface
+{
+  LabelSurface() : label(0), numberOfVoxels(0), extractedPoints(0), extractedCells(0), seconds(0) {}
+
+  int label;
+  InputLabelImageType::RegionType region;
+  unsigned long numberOfVoxels;
+  unsigned long extractedPoints;
+  unsigned long extractedCells;
+  vtkSmartPointer<vtkPolyData> surface;
+  double seconds;
+  std::string error;
+};
+
+InputLabelImageType::Pointer ReadLabelImage(const std::string&);
 vtkSmartPointer<vtkPolyData> ITKMesh2PolyData(MeshType::Pointer);
-void PrintSurfaceStatistics(vtkPolyData*);
-void WriteMesh(MeshType::Pointer, const char*);
-void MeshLPStoRAS(MeshType::Pointer mesh);
+void MeshLabel(InputLabelImageType::Pointer, const std::string&, float, LabelSurface&);
+void MeshWithQuadEdge(ImageType::Pointer, float, LabelSurface&);
+void MeshWithFlyingEdges(LabelImageType::Pointer, float, LabelSurface&);
+void WritePolyData(vtkPolyData*, const char*);
+void WriteMultiBlock(const std::vector<LabelSurface>&, const char*);
+std::string GetLabelFileName(const std::string&, int);
 
 int main(int argc, char **argv){
   PARSE_ARGS;
 
-  ImageType::Pointer mask;
+  InputLabelImageType::Pointer inputImage;
+  try{
+    inputImage = ReadLabelImage(inputImageName);
+  } catch(itk::ExceptionObject &e){
+    std::cerr << "Failed to read " << inputImageName << ": " << e.GetDescription() << std::endl;
+    return EXIT_FAILURE;
+  }
+  InputLabelImageType::RegionType inputRegion = inputImage->GetLargestPossibleRegion();
+
+  // find the bounding box of every label in a single pass over the input,
+  // so that each label is meshed within its box rather than the full volume
+  std::vector<LabelBounds> bounds(itk::NumericTraits<InputLabelImageType::PixelType>::max()+1);
+  {
+    itk::ImageRegionConstIteratorWithIndex<InputLabelImageType> it(inputImage, inputRegion);
+    for(it.GoToBegin();!it.IsAtEnd();++it){
+      if(it.Get())
+        bounds[it.Get()].Add(it.GetIndex());
+    }
+  }
 
-  ReaderType::Pointer reader = ReaderType::New();
-  reader->SetFileName(inputImageName.c_str());
-  
-  ThreshType::Pointer thresh = ThreshType::New();
-  thresh->SetInput(reader->GetOutput());
-  thresh->SetLowerThreshold(labelId);
-  thresh->SetUpperThreshold(labelId);
-  thresh->SetInsideValue(1);  
-  thresh->Update();
+  // labels to mesh: all labels present, the listed labels or the single label
+  std::vector<int> labelsToMesh;
+  if(allLabels){
+    for(size_t l=1;l<bounds.size();l++){
+      if(bounds[l].numberOfVoxels)
+        labelsToMesh.push_back(l);
+    }
+    if(labelsToMesh.empty()){
+      std::cerr << "No labels found in the input" << std::endl;
+      return EXIT_FAILURE;
+    }
+  } else if(!labels.empty()){
+    labelsToMesh = labels;
+  } else {
+    labelsToMesh.push_back(labelId);
+  }
 
+  std::vector<LabelSurface> surfaces;
+  for(size_t i=0;i<labelsToMesh.size();i++){
+    int label = labelsToMesh[i];
+    if(label<1 || label>=int(bounds.size())){
+      std::cerr << "Labels must be between 1 and " << bounds.size()-1 << ": " << label << std::endl;
+      return EXIT_FAILURE;
+    }
+    if(!bounds[label].numberOfVoxels){
+      std::cerr << "Warning: label " << label << " not found in the input" << std::endl;
+      continue;
+    }
+
+    // bounding box with a margin of one voxel, so that the surface is closed
+    LabelSurface surface;
+    surface.label = label;
+    surface.numberOfVoxels = bounds[label].numberOfVoxels;
+    for(unsigned int d=0;d<3;d++){
+      long lower = std::max<long>(bounds[label].lower[d]-1, inputRegion.GetIndex()[d]);
+      long upper = std::min<long>(bounds[label].upper[d]+1, inputRegion.GetIndex()[d]+inputRegion.GetSize()[d]-1);
+      surface.region.SetIndex(d, lower);
+      surface.region.SetSize(d, upper-lower+1);
+    }
+    surfaces.push_back(surface);
+  }
+  if(surfaces.empty()){
+    std::cerr << "None of the labels to mesh was found in the input" << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  // mesh the labels in worker threads, each taking the next label when done;
+  // the largest labels are started first so that they do not finish last
+  std::vector<size_t> order(surfaces.size());
+  for(size_t i=0;i<order.size();i++)
+    order[i] = i;
+  std::stable_sort(order.begin(), order.end(), [&surfaces](size_t a, size_t b)
+    { return surfaces[a].region.GetNumberOfPixels() > surfaces[b].region.GetNumberOfPixels(); });
+
+  unsigned threadsToUse = numberOfThreads;
+  if(numberOfThreads <= 0)
+    threadsToUse = itk::MultiThreaderBase::GetGlobalDefaultNumberOfThreads();
+  threadsToUse = std::max<unsigned>(1, std::min<size_t>(threadsToUse, surfaces.size()));
+
+  // std::thread rather than the ITK thread pool, as the filters of each
+  // label use the pool themselves
+  std::atomic<size_t> nextSurface(0);
+  std::vector<std::thread> workers;
+  for(unsigned t=0;t<threadsToUse;t++){
+    workers.push_back(std::thread([&](){
+      for(size_t i = nextSurface++; i < order.size(); i = nextSurface++)
+        MeshLabel(inputImage, backend, decimationConst, surfaces[order[i]]);
+    }));
+  }
+  for(size_t t=0;t<workers.size();t++)
+    workers[t].join();
+
+  bool failed = false;
+  std::cout << "Label\tVoxels\tMC points\tMC cells\tPoints\tCells\tSeconds" << std::endl;
+  for(size_t i=0;i<surfaces.size();i++){
+    const LabelSurface &surface = surfaces[i];
+    if(!surface.error.empty()){
+      std::cerr << "Meshing of label " << surface.label << " failed: " << surface.error << std::endl;
+      failed = true;
+      continue;
+    }
+    std::cout << surface.label << "\t" << surface.numberOfVoxels << "\t" <<
+      surface.extractedPoints << "\t" << surface.extractedCells << "\t" <<
+      surface.surface->GetNumberOfPoints() << "\t" << surface.surface->GetNumberOfCells() << "\t" <<
+      surface.seconds << std::endl;
+  }
+  if(failed)
+    return EXIT_FAILURE;
+
+  // a single multi-block file with one block per label, or one surface file
+  // per label, named after the output with the label appended when more than
+  // one label is meshed
+  if(itksys::SystemTools::LowerCase(itksys::SystemTools::GetFilenameLastExtension(outputMeshName)) == ".vtm"){
+    WriteMultiBlock(surfaces, outputMeshName.c_str());
+  } else if(labelsToMesh.size() == 1 && !allLabels){
+    WritePolyData(surfaces[0].surface, outputMeshName.c_str());
+  } else {
+    for(size_t i=0;i<surfaces.size();i++)
+      WritePolyData(surfaces[i].surface, GetLabelFileName(outputMeshName, surfaces[i].label).c_str());
+  }
+
+  if(!statisticsFileName.empty()){
+    std::ofstream statistics(statisticsFileName.c_str());
+    statistics << "Label,Voxels,ExtractedPoints,ExtractedCells,Points,Cells,Seconds" << std::endl;
+    for(size_t i=0;i<surfaces.size();i++){
+      const LabelSurface &surface = surfaces[i];
+      statistics << surface.label << "," << surface.numberOfVoxels << "," <<
+        surface.extractedPoints << "," << surface.extractedCells << "," <<
+        surface.surface->GetNumberOfPoints() << "," << surface.surface->GetNumberOfCells() << "," <<
+        surface.seconds << std::endl;
+    }
+    if(!statistics){
+      std::cerr << "Failed to write the statistics to " << statisticsFileName << std::endl;
+      return EXIT_FAILURE;
+    }
+  }
+
+  return EXIT_SUCCESS;
+
+}
+
+// Read an image of label values that fit the unsigned short input label
+// image. Other pixel types are read as such, and converted after checking
+// that all values are integers between 0 and 65535, so that labels are
+// never wrapped or truncated.
+template <class TPixel>
+InputLabelImageType::Pointer ReadAndConvertLabelImage(const std::string& fileName){
+  typedef itk::Image<TPixel, Dimension> FileImageType;
+  typedef itk::ImageFileReader<FileImageType> FileReaderType;
+  typename FileReaderType::Pointer reader = FileReaderType::New();
+  reader->SetFileName(fileName.c_str());
+  reader->Update();
+  typename FileImageType::Pointer image = reader->GetOutput();
+
+  typedef itk::MinimumMaximumImageCalculator<FileImageType> CalculatorType;
+  typename CalculatorType::Pointer calculator = CalculatorType::New();
+  calculator->SetImage(image);
+  calculator->Compute();
+  const double minimum = calculator->GetMinimum(), maximum = calculator->GetMaximum();
+  if(minimum < 0 || maximum > itk::NumericTraits<InputLabelImageType::PixelType>::max()){
+    std::ostringstream message;
+    message << "Label values must be between 0 and " << itk::NumericTraits<InputLabelImageType::PixelType>::max()
+      << ", the input has values from " << minimum << " to " << maximum;
+    itkGenericExceptionMacro(<< message.str());
+  }
+  if(!itk::NumericTraits<TPixel>::is_integer){
+    itk::ImageRegionConstIterator<FileImageType> it(image, image->GetLargestPossibleRegion());
+    for(it.GoToBegin();!it.IsAtEnd();++it){
+      if(it.Get() != std::floor(it.Get()))
+        itkGenericExceptionMacro(<< "Label values must be integers, the input has the value " << it.Get());
+    }
+  }
+
+  typedef itk::CastImageFilter<FileImageType, InputLabelImageType> CastType;
+  typename CastType::Pointer cast = CastType::New();
+  cast->SetInput(image);
+  cast->Update();
+  return cast->GetOutput();
+}
+
+InputLabelImageType::Pointer ReadLabelImage(const std::string& fileName){
+  itk::ImageIOBase::Pointer io = itk::ImageIOFactory::CreateImageIO(
+        fileName.c_str(), itk::IOFileModeEnum::ReadMode);
+  if(!io)
+    itkGenericExceptionMacro(<< "Unsupported image format");
+  io->SetFileName(fileName);
+  io->ReadImageInformation();
+  if(io->GetNumberOfComponents() != 1)
+    itkGenericExceptionMacro(<< "The input must be a scalar label image, it has "
+                             << io->GetNumberOfComponents() << " components");
+
+  switch(io->GetComponentType()){
+    case itk::IOComponentEnum::UCHAR:
+    case itk::IOComponentEnum::USHORT:{
+      // read directly, all values fit
+      InputLabelReaderType::Pointer reader = InputLabelReaderType::New();
+      reader->SetFileName(fileName.c_str());
+      reader->SetImageIO(io);
+      reader->Update();
+      return reader->GetOutput();
+    }
+    case itk::IOComponentEnum::CHAR:
+    case itk::IOComponentEnum::SHORT:
+    case itk::IOComponentEnum::INT:
+      return ReadAndConvertLabelImage<int>(fileName);
+    default:
+      // unsigned and 64-bit integers, and floating point labels
+      return ReadAndConvertLabelImage<double>(fileName);
+  }
+}
+
+// Crop the label to its region, threshold it to a binary image and mesh it
+// with the selected backend. Errors are reported in the surface, since this
+// runs in a worker thread.
+void MeshLabel(InputLabelImageType::Pointer inputImage, const std::string& backend, float decimationConst,
+               LabelSurface& surface){
+  itk::TimeProbe probe;
+  probe.Start();
+  try{
+    typedef itk::RegionOfInterestImageFilter<InputLabelImageType,InputLabelImageType> ROIType;
+    ROIType::Pointer roi = ROIType::New();
+    roi->SetInput(inputImage);
+    roi->SetRegionOfInterest(surface.region);
+
+    if(backend == "FlyingEdges"){
+      typedef itk::BinaryThresholdImageFilter<InputLabelImageType,LabelImageType> LabelThreshType;
+      LabelThreshType::Pointer thresh = LabelThreshType::New();
+      thresh->SetInput(roi->GetOutput());
+      thresh->SetLowerThreshold(surface.label);
+      thresh->SetUpperThreshold(surface.label);
+      thresh->SetInsideValue(1);
+      thresh->SetOutsideValue(0);
+      thresh->Update();
+      MeshWithFlyingEdges(thresh->GetOutput(), decimationConst, surface);
+    } else {
+      typedef itk::BinaryThresholdImageFilter<InputLabelImageType,ImageType> ThreshType;
+      ThreshType::Pointer thresh = ThreshType::New();
+      thresh->SetInput(roi->GetOutput());
+      thresh->SetLowerThreshold(surface.label);
+      thresh->SetUpperThreshold(surface.label);
+      thresh->SetInsideValue(1);
+      thresh->SetOutsideValue(0);
+      thresh->Update();
+      MeshWithQuadEdge(thresh->GetOutput(), decimationConst, surface);
+    }
+  } catch(itk::ExceptionObject &e){
+    surface.error = e.GetDescription();
+  } catch(std::exception &e){
+    surface.error = e.what();
+  }
+  probe.Stop();
+  surface.seconds = probe.GetTotal();
+}
+
+// Marching cubes on the binary mask and squared edge length decimation of
+// the ITK QuadEdge mesh to decimationConst of the cells.
+void MeshWithQuadEdge(ImageType::Pointer mask, float decimationConst, LabelSurface& surface){
   MeshSourceType::Pointer meshSource = MeshSourceType::New();
 
-  meshSource->SetInput( thresh->GetOutput());
+  meshSource->SetInput(mask);
   meshSource->SetObjectValue(1);
   meshSource->Update();
 
-  std::cout << "MC surface points: " << meshSource->GetNumberOfNodes() << std::endl;
-  std::cout << "MC surface cells: " << meshSource->GetNumberOfCells() << std::endl;
+  surface.extractedPoints = meshSource->GetNumberOfNodes();
+  surface.extractedCells = meshSource->GetNumberOfCells();
 
   // decimate the mesh
   typedef itk::NumberOfFacesCriterion< MeshType > CriterionType;
@@ -74,46 +397,74 @@ int main(int argc, char **argv){
 
   CriterionType::Pointer criterion = CriterionType::New();
   criterion->SetTopologicalChange( false );
-  std::cout << "Target number of cells after decimation: " << 
-    (unsigned) (decimationConst*meshSource->GetNumberOfCells()) << std::endl;
   criterion->SetNumberOfElements( unsigned(decimationConst*meshSource->GetNumberOfCells()));
   
-  MeshType::Pointer mcmesh = meshSource->GetOutput();
- 
   DecimationType::Pointer decimate = DecimationType::New();
   decimate->SetInput( meshSource->GetOutput() );
   decimate->SetCriterion( criterion );
   decimate->Update();
 
-  MeshType::Pointer dMesh = decimate->GetOutput();
-
-  MeshLPStoRAS(dMesh);
-
-  std::cout << "Decimation complete" << std::endl;
-  std::cout << "Decimated surface points: " << dMesh->GetPoints()->Size() << std::endl;
-  std::cout << "Decimated surface cells: " << dMesh->GetCells()->Size() << std::endl;
-  WriteMesh(dMesh, outputMeshName.c_str());
-
-  return EXIT_SUCCESS;
-
+  surface.surface = ITKMesh2PolyData(decimate->GetOutput());
 }
 
+// Surface of the label extracted from the image with the discrete flying
+// edges (or marching cubes, with older VTK) filter, which is multithreaded,
+// and decimated with quadric decimation to the same number of cells as the
+// QuadEdge backend.
+void MeshWithFlyingEdges(LabelImageType::Pointer label, float decimationConst, LabelSurface& surface){
+  // wrap the ITK buffer without copying; the image geometry is applied to
+  // the surface points afterwards, since vtkImageData has no direction
+  LabelImageType::SizeType size = label->GetLargestPossibleRegion().GetSize();
+  vtkSmartPointer<vtkUnsignedCharArray> scalars = vtkSmartPointer<vtkUnsignedCharArray>::New();
+  scalars->SetArray(label->GetBufferPointer(), size[0]*size[1]*size[2], 1);
+  vtkSmartPointer<vtkImageData> image = vtkSmartPointer<vtkImageData>::New();
+  image->SetDimensions(size[0], size[1], size[2]);
+  image->GetPointData()->SetScalars(scalars);
+
+#ifdef QUADEDGESURFACEMESHER_HAS_FLYING_EDGES
+  vtkSmartPointer<vtkDiscreteFlyingEdges3D> extractor = vtkSmartPointer<vtkDiscreteFlyingEdges3D>::New();
+#else
+  vtkSmartPointer<vtkDiscreteMarchingCubes> extractor = vtkSmartPointer<vtkDiscreteMarchingCubes>::New();
+#endif
+  extractor->SetInputData(image);
+  extractor->SetValue(0, 1);
+  extractor->ComputeNormalsOff();
+  extractor->ComputeGradientsOff();
+  extractor->ComputeScalarsOff();
+  extractor->Update();
+
+  surface.extractedPoints = extractor->GetOutput()->GetNumberOfPoints();
+  surface.extractedCells = extractor->GetOutput()->GetNumberOfCells();
+
+  vtkSmartPointer<vtkQuadricDecimation> decimate = vtkSmartPointer<vtkQuadricDecimation>::New();
+  decimate->SetInputConnection(extractor->GetOutputPort());
+  decimate->SetTargetReduction(1.-decimationConst);
+  decimate->Update();
 
-void MeshLPStoRAS(MeshType::Pointer mesh){
-  PointsIterator pIt = mesh->GetPoints()->Begin();
-  PointsIterator pEnd = mesh->GetPoints()->End();
-  unsigned i = 0;
-
-  while(pIt!=pEnd){
-    MeshType::PointType p = pIt.Value();
-    p[0] *= -1.;
-    p[1] *= -1;
-    mesh->SetPoint(i, p);
-    pIt++;
-    i++;
+  vtkSmartPointer<vtkPolyData> dSurface = decimate->GetOutput();
+
+  // index to LPS physical space, and then to RAS
+  vtkPoints* points = dSurface->GetPoints();
+  LabelImageType::PointType origin = label->GetOrigin();
+  LabelImageType::SpacingType spacing = label->GetSpacing();
+  LabelImageType::DirectionType direction = label->GetDirection();
+  for(vtkIdType i=0;i<points->GetNumberOfPoints();i++){
+    double index[3], p[3];
+    points->GetPoint(i, index);
+    for(unsigned int k=0;k<3;k++){
+      p[k] = origin[k];
+      for(unsigned int d=0;d<3;d++)
+        p[k] += direction[k][d]*index[d]*spacing[d];
+    }
+    points->SetPoint(i, -p[0], -p[1], p[2]);
   }
+  points->Modified();
+
+  surface.surface = dSurface;
 }
 
+// Convert the mesh to vtkPolyData, from LPS to RAS. The triangles are
+// passed as a single connectivity array rather than cell by cell.
 vtkSmartPointer<vtkPolyData> ITKMesh2PolyData(MeshType::Pointer mesh){
   vtkSmartPointer<vtkPolyData> surface = vtkSmartPointer<vtkPolyData>::New();
   vtkSmartPointer<vtkPoints> surfacePoints = vtkSmartPointer<vtkPoints>::New();
@@ -125,31 +476,65 @@ vtkSmartPointer<vtkPolyData> ITKMesh2PolyData(MeshType::Pointer mesh){
 
   while(pIt!=pItEnd){
     MeshType::PointType pt = pIt->Value();
-    surfacePoints->SetPoint(pIt->Index(), pt[0], pt[1], pt[2]);
+    surfacePoints->SetPoint(pIt->Index(), -pt[0], -pt[1], pt[2]);
     ++pIt;
   }
 
   surface->SetPoints(surfacePoints);
-  surface->Allocate();
 
+  vtkIdType numberOfCells = mesh->GetCells()->Size();
+  vtkSmartPointer<vtkIdTypeArray> connectivity = vtkSmartPointer<vtkIdTypeArray>::New();
+  connectivity->SetNumberOfValues(4*numberOfCells);
+  vtkIdType* cIds = connectivity->GetPointer(0);
   while(cIt!=cItEnd){
     MeshType::CellType *cell = cIt->Value();
     MeshType::CellType::PointIdIterator pidIt = cell->PointIdsBegin(); 
-    vtkIdType cIds[3];
-    cIds[0] = *pidIt;
-    cIds[1] = *(pidIt+1);
-    cIds[2] = *(pidIt+2);
-    surface->InsertNextCell(VTK_TRIANGLE, 3, cIds);
+    cIds[0] = 3;
+    cIds[1] = *pidIt;
+    cIds[2] = *(pidIt+1);
+    cIds[3] = *(pidIt+2);
+    cIds += 4;
 
     ++cIt;
   }
+  vtkSmartPointer<vtkCellArray> triangles = vtkSmartPointer<vtkCellArray>::New();
+  triangles->SetCells(numberOfCells, connectivity);
+  surface->SetPolys(triangles);
+
   return surface;
 }
 
-void WriteMesh(MeshType::Pointer mesh, const char* fname){
-  vtkSmartPointer<vtkPolyData> vtksurf = ITKMesh2PolyData(mesh);
+void WritePolyData(vtkPolyData* surface, const char* fname){
   vtkSmartPointer<vtkPLYWriter> pdw = vtkSmartPointer<vtkPLYWriter>::New();
   pdw->SetFileName(fname);
-  pdw->SetInputData(vtksurf);
+  pdw->SetInputData(surface);
   pdw->Update();
 }
+
+void WriteMultiBlock(const std::vector<LabelSurface>& surfaces, const char* fname){
+  vtkSmartPointer<vtkMultiBlockDataSet> blocks = vtkSmartPointer<vtkMultiBlockDataSet>::New();
+  blocks->SetNumberOfBlocks(surfaces.size());
+  for(size_t i=0;i<surfaces.size();i++){
+    std::ostringstream name;
+    name << "Label " << surfaces[i].label;
+    blocks->SetBlock(i, surfaces[i].surface);
+    blocks->GetMetaData(static_cast<unsigned int>(i))->Set(vtkCompositeDataSet::NAME(), name.str().c_str());
+  }
+
+  vtkSmartPointer<vtkXMLMultiBlockDataWriter> mbw = vtkSmartPointer<vtkXMLMultiBlockDataWriter>::New();
+  mbw->SetFileName(fname);
+  mbw->SetInputData(blocks);
+  mbw->Write();
+}
+
+// Output file name of one label when several are meshed: the label is
+// appended to the file name, e.g., surface_label3.ply
+std::string GetLabelFileName(const std::string& outputMeshName, int label){
+  std::ostringstream fileName;
+  std::string path = itksys::SystemTools::GetFilenamePath(outputMeshName);
+  if(!path.empty())
+    fileName << path << "/";
+  fileName << itksys::SystemTools::GetFilenameWithoutLastExtension(outputMeshName) << "_label" << label <<
+    itksys::SystemTools::GetFilenameLastExtension(outputMeshName);
+  return fileName.str();
+}
@@ -1,4 +1,6 @@
 #include <algorithm> // for std::min and std::max
+#include <cmath>
+#include <vector>
 
 #include "itkSmoothingRecursiveGaussianImageFilter.h"
 #include "itkBinaryThresholdImageFilter.h"
@@ -6,25 +8,101 @@
 #include "itkImageFileReader.h"
 #include "itkResampleImageFilter.h"
 #include "itkNearestNeighborInterpolateImageFunction.h"
+#include "itkRegionOfInterestImageFilter.h"
+#include "itkImageRegionConstIterator.h"
+#include "itkImageRegionConstIteratorWithIndex.h"
+#include "itkImageRegionIterator.h"
 
 #include "SegmentationSmoothingCLP.h"
 
-int main( int argc, char * argv[] )
+typedef itk::Image<unsigned char, 3> ImageType;
+typedef itk::Image<float, 3> FloatImageType;
+
+// Index bounds of the voxels of one structure in the input image
+struct LabelBounds
 {
-  PARSE_ARGS;
+  LabelBounds() : found(false) {}
 
-  const unsigned int Dimension = 3;
+  void Add(const ImageType::IndexType &index)
+  {
+    for(unsigned int d=0;d<3;d++){
+      if(!found || index[d]<lower[d])
+        lower[d] = index[d];
+      if(!found || index[d]>upper[d])
+        upper[d] = index[d];
+    }
+    found = true;
+  }
 
-  typedef itk::Image<unsigned char, 3> ImageType;
-  typedef itk::Image<float, 3> FloatImageType;
+  bool found;
+  ImageType::IndexType lower;
+  ImageType::IndexType upper;
+};
 
-  typedef itk::ImageFileReader<ImageType> ReaderType;
-  typedef itk::SmoothingRecursiveGaussianImageFilter<ImageType,FloatImageType> SmootherType;
-  typedef itk::ImageFileWriter<ImageType> WriterType;
+// Threshold the structure within the input region, resample it to the
+// output grid region and smooth it. The output region is given in the index
+// space of the full field of view output grid, which has the origin and
+// direction of the input image.
+FloatImageType::Pointer SmoothStructure(ImageType::Pointer inputImage, const ImageType::RegionType &inputRegion,
+                                        int lowerLabel, int upperLabel,
+                                        const ImageType::SpacingType &outputSpacing, const ImageType::RegionType &outputRegion,
+                                        const ImageType::SpacingType &smoothSpacing)
+{
+  typedef itk::RegionOfInterestImageFilter<ImageType,ImageType> ROIType;
   typedef itk::BinaryThresholdImageFilter<ImageType,ImageType> LabelThreshType;
-  typedef itk::BinaryThresholdImageFilter<FloatImageType,ImageType> SmoothedThreshType;
   typedef itk::ResampleImageFilter<ImageType,ImageType> ResamplerType;
   typedef itk::NearestNeighborInterpolateImageFunction<ImageType> InterpolatorType;
+  typedef itk::SmoothingRecursiveGaussianImageFilter<ImageType,FloatImageType> SmootherType;
+  typedef itk::IdentityTransform<double,3> TransformType;
+
+  ROIType::Pointer roi = ROIType::New();
+  roi->SetInput(inputImage);
+  roi->SetRegionOfInterest(inputRegion);
+
+  // convert to label 1 first; nearest neighbor resampling gives the same
+  // result on the thresholded label, at a fraction of the voxels
+  LabelThreshType::Pointer labelThresh = LabelThreshType::New();
+  labelThresh->SetInput(roi->GetOutput());
+  labelThresh->SetInsideValue(1);
+  labelThresh->SetOutsideValue(0);
+  labelThresh->SetLowerThreshold(lowerLabel);
+  labelThresh->SetUpperThreshold(upperLabel);
+
+  ImageType::PointType outputOrigin = inputImage->GetOrigin();
+  for(unsigned int d=0;d<3;d++){
+    for(unsigned int k=0;k<3;k++){
+      outputOrigin[k] += inputImage->GetDirection()[k][d]*outputRegion.GetIndex()[d]*outputSpacing[d];
+    }
+  }
+
+  TransformType::Pointer eye = TransformType::New();
+  eye->SetIdentity();
+
+  InterpolatorType::Pointer interp = InterpolatorType::New();
+  ResamplerType::Pointer resampler = ResamplerType::New();
+  resampler->SetOutputSpacing(outputSpacing);
+  resampler->SetOutputDirection(inputImage->GetDirection());
+  resampler->SetOutputOrigin(outputOrigin);
+  resampler->UseReferenceImageOff();
+  resampler->SetInterpolator(interp);
+  resampler->SetSize(outputRegion.GetSize());
+  resampler->SetTransform(eye);
+  resampler->SetInput(labelThresh->GetOutput());
+
+  SmootherType::Pointer smoother = SmootherType::New();
+  smoother->SetInput(resampler->GetOutput());
+  smoother->SetSigmaArray(smoothSpacing);
+  smoother->Update();
+
+  return smoother->GetOutput();
+}
+
+int main( int argc, char * argv[] )
+{
+  PARSE_ARGS;
+
+  typedef itk::ImageFileReader<ImageType> ReaderType;
+  typedef itk::ImageFileWriter<ImageType> WriterType;
 
   ReaderType::Pointer reader = ReaderType::New();
   reader->SetFileName(inputImageName.c_str());
@@ -44,83 +122,150 @@ int main( int argc, char * argv[] )
   smoothSpacing[2] = maxSpacing;
 
   ImageType::SizeType outputSize, inputSize;
-  inputSize = inputImage->GetLargestPossibleRegion().GetSize();
+  ImageType::RegionType inputRegion = inputImage->GetLargestPossibleRegion();
+  inputSize = inputRegion.GetSize();
   typedef ImageType::SizeType::SizeValueType SizeValueType;
   outputSize[0] = static_cast<SizeValueType>(inputSize[0]*inputSpacing[0]/outputSpacing[0] + .5);
   outputSize[1] = static_cast<SizeValueType>(inputSize[1]*inputSpacing[1]/outputSpacing[0] + .5);
   outputSize[2] = static_cast<SizeValueType>(inputSize[2]*inputSpacing[2]/outputSpacing[0] + .5);
 
-  typedef itk::IdentityTransform<double,3> TransformType;
-  TransformType::Pointer eye = TransformType::New();
-  eye->SetIdentity();
+  // structures to smooth: each is a range of input labels and the value it
+  // gets in the output
+  struct Structure
+  {
+    int lowerLabel;
+    int upperLabel;
+    unsigned char outputValue;
+    LabelBounds bounds;
+  };
+  std::vector<Structure> structures;
+  if(!labels.empty()){
+    for(size_t i=0;i<labels.size();i++){
+      if(labels[i]<1 || labels[i]>255){
+        std::cerr << "Labels must be between 1 and 255: " << labels[i] << std::endl;
+        return EXIT_FAILURE;
+      }
+      Structure structure = {labels[i], labels[i], static_cast<unsigned char>(labels[i])};
+      structures.push_back(structure);
+    }
+  } else if(labelNumber==-1){
+    Structure structure = {1, 255, 1};
+    structures.push_back(structure);
+  } else {
+    Structure structure = {labelNumber, labelNumber, 1};
+    structures.push_back(structure);
+  }
 
-  InterpolatorType::Pointer interp = InterpolatorType::New();
-  ResamplerType::Pointer resampler = ResamplerType::New();
-  resampler->SetOutputSpacing(outputSpacing);
-  resampler->SetOutputDirection(inputImage->GetDirection());
-  resampler->SetOutputOrigin(inputImage->GetOrigin());
-  resampler->UseReferenceImageOff();
-  resampler->SetInterpolator(interp);  
-  resampler->SetSize(outputSize);
-  resampler->SetTransform(eye);
-  resampler->SetInput(inputImage);
-  try{
-    resampler->Update();
-  } catch(itk::ExceptionObject &e){
-    std::cout << "Resampling failed" << std::endl;
+  // find the bounding box of each structure in a single pass over the input
+  std::vector<int> structureOfLabel(256, -1);
+  for(size_t s=0;s<structures.size();s++){
+    for(int l=std::max(structures[s].lowerLabel,0);l<=std::min(structures[s].upperLabel,255);l++)
+      structureOfLabel[l] = s;
   }
-  if(0){
-    typedef itk::ImageFileWriter<ImageType > WriterType;
-    WriterType::Pointer imageWriter = WriterType::New();
-    imageWriter->SetInput(resampler->GetOutput() );
-    imageWriter->SetFileName( outputImageName.c_str() );
-    imageWriter->UseCompressionOn();
-    imageWriter->Update();
+  {
+    itk::ImageRegionConstIteratorWithIndex<ImageType> it(inputImage, inputRegion);
+    for(it.GoToBegin();!it.IsAtEnd();++it){
+      int s = structureOfLabel[it.Get()];
+      if(s!=-1)
+        structures[s].bounds.Add(it.GetIndex());
+    }
   }
 
-  // convert to label 1 first, then smooth, then threshold at 0.5
-  LabelThreshType::Pointer labelThresh = LabelThreshType::New();
-  labelThresh->SetInput(resampler->GetOutput());
-  labelThresh->SetInsideValue(1);
-  if(labelNumber==-1){
-    labelThresh->SetUpperThreshold(255);
-    labelThresh->SetLowerThreshold(1);
-  } else {
-    labelThresh->SetUpperThreshold(labelNumber);
-    labelThresh->SetLowerThreshold(labelNumber);
+  // regions of the structures: the bounding box with a margin of 3 sigma,
+  // where the smoothed label drops well below the 0.5 threshold, in the input
+  // and in the isotropic output grid
+  std::vector<ImageType::RegionType> inputRegions(structures.size()), outputRegions(structures.size());
+  ImageType::IndexType outputLower, outputUpper;
+  bool anyFound = false;
+  for(size_t s=0;s<structures.size();s++){
+    if(!structures[s].bounds.found){
+      std::cerr << "Warning: label " << structures[s].lowerLabel;
+      if(structures[s].upperLabel!=structures[s].lowerLabel)
+        std::cerr << "-" << structures[s].upperLabel;
+      std::cerr << " not found in the input" << std::endl;
+      continue;
+    }
+    for(unsigned int d=0;d<3;d++){
+      long margin = static_cast<long>(std::ceil(3.*maxSpacing/inputSpacing[d])) + 1;
+      long lower = std::max<long>(structures[s].bounds.lower[d]-margin, inputRegion.GetIndex()[d]);
+      long upper = std::min<long>(structures[s].bounds.upper[d]+margin, inputRegion.GetIndex()[d]+inputSize[d]-1);
+      inputRegions[s].SetIndex(d, lower);
+      inputRegions[s].SetSize(d, upper-lower+1);
+
+      // output voxels whose nearest input voxel is within the input region
+      double ratio = inputSpacing[d]/outputSpacing[d];
+      long outputStart = std::max<long>(static_cast<long>(std::floor(lower*ratio)), 0);
+      long outputEnd = std::min<long>(static_cast<long>(std::ceil((upper+1)*ratio)), outputSize[d]-1);
+      outputRegions[s].SetIndex(d, outputStart);
+      outputRegions[s].SetSize(d, outputEnd-outputStart+1);
+      if(!anyFound || outputStart<outputLower[d])
+        outputLower[d] = outputStart;
+      if(!anyFound || outputEnd>outputUpper[d])
+        outputUpper[d] = outputEnd;
+    }
+    anyFound = true;
   }
 
-  try{
-    labelThresh->Update();
-  } catch(itk::ExceptionObject &e){
-    std::cout << "label threshold failed" << std::endl;
+  // the output covers the full input field of view at isotropic resolution,
+  // or only the union of the structure regions if cropping is requested
+  ImageType::RegionType outputRegion;
+  outputRegion.SetSize(outputSize);
+  if(cropOutput && anyFound){
+    for(unsigned int d=0;d<3;d++)
+      outputRegion.SetSize(d, outputUpper[d]-outputLower[d]+1);
+  } else {
+    outputLower.Fill(0);
   }
 
-  SmootherType::Pointer smoother = SmootherType::New();
-  smoother->SetInput(labelThresh->GetOutput());  
-  smoother->SetSigmaArray(smoothSpacing);  
-  std::cout << " Sigma : " << inputSpacing <<std::endl;
-  try{
-    smoother->Update();
-  } catch(itk::ExceptionObject &e){
-    std::cout << "smoothing failed" << std::endl;
+  ImageType::PointType outputOrigin = inputImage->GetOrigin();
+  for(unsigned int d=0;d<3;d++){
+    for(unsigned int k=0;k<3;k++){
+      outputOrigin[k] += inputImage->GetDirection()[k][d]*outputLower[d]*outputSpacing[d];
+    }
   }
 
-  SmoothedThreshType::Pointer smoothThresh = SmoothedThreshType::New();
-  smoothThresh->SetInput(smoother->GetOutput());
-  smoothThresh->SetInsideValue(1);
-  smoothThresh->SetUpperThreshold(255);
-  smoothThresh->SetLowerThreshold(0.5);
-  try{
-    smoothThresh->Update();
-  } catch(itk::ExceptionObject &e){
-    std::cout << "smooth thresh failed" << std::endl;
+  ImageType::Pointer outputImage = ImageType::New();
+  outputImage->SetRegions(outputRegion);
+  outputImage->SetSpacing(outputSpacing);
+  outputImage->SetOrigin(outputOrigin);
+  outputImage->SetDirection(inputImage->GetDirection());
+  outputImage->Allocate();
+  outputImage->FillBuffer(0);
+
+  std::cout << " Sigma : " << smoothSpacing << std::endl;
+
+  // smooth each structure within its region, and threshold at 0.5 into the
+  // output; where structures overlap the later one in the list wins
+  for(size_t s=0;s<structures.size();s++){
+    if(!structures[s].bounds.found)
+      continue;
+
+    FloatImageType::Pointer smoothed;
+    try{
+      smoothed = SmoothStructure(inputImage, inputRegions[s], structures[s].lowerLabel, structures[s].upperLabel,
+                                 outputSpacing, outputRegions[s], smoothSpacing);
+    } catch(itk::ExceptionObject &e){
+      std::cerr << "Smoothing of label " << structures[s].lowerLabel << " failed: " << e << std::endl;
+      return EXIT_FAILURE;
+    }
+
+    ImageType::RegionType pasteRegion = outputRegions[s];
+    ImageType::IndexType pasteIndex;
+    for(unsigned int d=0;d<3;d++)
+      pasteIndex[d] = pasteRegion.GetIndex()[d]-outputLower[d];
+    pasteRegion.SetIndex(pasteIndex);
+
+    itk::ImageRegionConstIterator<FloatImageType> smoothedIt(smoothed, smoothed->GetLargestPossibleRegion());
+    itk::ImageRegionIterator<ImageType> outputIt(outputImage, pasteRegion);
+    for(smoothedIt.GoToBegin(),outputIt.GoToBegin();!smoothedIt.IsAtEnd();++smoothedIt,++outputIt){
+      if(smoothedIt.Get()>=0.5)
+        outputIt.Set(structures[s].outputValue);
+    }
   }
 
   {
-    typedef itk::ImageFileWriter<ImageType > WriterType;
     WriterType::Pointer imageWriter = WriterType::New();
-    imageWriter->SetInput(smoothThresh->GetOutput() );
+    imageWriter->SetInput(outputImage);
     imageWriter->SetFileName( outputImageName.c_str() );
     imageWriter->UseCompressionOn();
     imageWriter->Update();